@@ -1,17 +1,46 @@
-from typing import List, Tuple, Optional
+""" 估值web app的API
+
+在项目根目录下启动（src是一个包，所有模块都以src.为根导入）：
+    python -m src.api                                       # 开发时，监听127.0.0.1:8001
+    uvicorn src.api:app --host 0.0.0.0 --port 80 --workers 4   # 部署
+"""
+from typing import List, Tuple, Optional, Callable, Dict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import asyncio
+import math
 
 import uvicorn
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Query, Request
 from pydantic import BaseModel
 from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, Response
 
-import aqi_db as adb
-import security
-import rim
+from src import aqi_db as adb
+from src import screener
+from src import security
+from src.business import profit_ability
+from src.stock_data import security_master
+from src.response_cache import ResponseCacheMiddleware
 
 
 app = FastAPI()
 
+# pandas相关的计算和数据加载都放到这个有界线程池中执行，以免阻塞事件循环
+executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='rim-api')
+
+# 各个数据集的预热状态：'loading'，'ready' 或者错误信息
+warm_up_state: Dict[str, str] = {}
+
+# 批量接口一次至多查询的公司数
+MAX_BATCH_CODES = 1000
+
+# 选股接口每页至多返回的公司数
+MAX_SCREENER_PAGE_SIZE = 500
+
+# 证券检索接口至多返回的证券数
+MAX_SEARCH_LIMIT = 50
+
 # 允许跨域
 origins = [
     "http://localhost.tiangolo.com",
@@ -20,6 +49,9 @@ origins = [
     "http://localhost:8080",
 ]
 
+# 以数据版本为ETag的响应缓存；先于CORSMiddleware添加，位于其内层，缓存的响应不包含跨域的响应头
+app.add_middleware(ResponseCacheMiddleware)
+
 # 允许跨域
 app.add_middleware(
     CORSMiddleware,
@@ -30,19 +62,91 @@ app.add_middleware(
 )
 
 
+async def run_in_executor(fn: Callable, *args):
+    """ 在有界线程池中执行fn(*args)
+    """
+    return await asyncio.get_event_loop().run_in_executor(executor, partial(fn, *args))
+
+
+def _on_warmed_up(name: str, future: asyncio.Future) -> None:
+    warm_up_state[name] = 'ready' if future.exception() is None else repr(future.exception())
+
+
+@app.on_event("startup")
+async def warm_up():
+    """ 启动时先登记新证券（此后API只读master.db），再并行预热所有数据集，预热在后台进行，进度见 /health
+    """
+    loop = asyncio.get_event_loop()
+    try:
+        await run_in_executor(security_master.register_sources)
+    except Exception as e:
+        print(f"登记新证券失败: {e!r}")
+    datasets = {**adb.DATASETS, 'securities_payload': security.get_securities_payload,
+                'security_index': security.get_security_index}
+    warm_up_executor = ThreadPoolExecutor(max_workers=len(datasets), thread_name_prefix='rim-warm-up')
+    for name, loader in datasets.items():
+        warm_up_state[name] = 'loading'
+        loop.run_in_executor(warm_up_executor, loader).add_done_callback(partial(_on_warmed_up, name))
+    warm_up_executor.shutdown(wait=False)
+
+
+@app.on_event("shutdown")
+def shutdown():
+    executor.shutdown(wait=False)
+
+
+@app.get("/health")
+async def read_health():
+    ready = all(state == 'ready' for state in warm_up_state.values())
+    return JSONResponse({'ready': ready, 'datasets': warm_up_state}, status_code=200 if ready else 503)
+
+
 @app.get("/securities")
-def read_securities():
-    return {"hello world": security.get_securities(adb.get_securities)}
+async def read_securities(request: Request):
+    """ 股票列表，响应体是预先序列化和压缩好的，见security.get_securities_payload
+    """
+    payload = await run_in_executor(security.get_securities_payload)
+    encoding = security.choose_encoding(request.headers.get('accept-encoding', ''), payload)
+    etag = f'"{payload.etag}-{encoding}"'
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding'}
+    if etag in (tag.strip() for tag in request.headers.get('if-none-match', '').split(',')):
+        return Response(status_code=304, headers=headers)
+    if encoding != 'identity':
+        headers['Content-Encoding'] = encoding
+    return Response(payload.bodies[encoding], media_type='application/json', headers=headers)
+
+
+@app.get("/v1.0/securities/search")
+async def search_securities(q: str, limit: int = 10):
+    """
+    按代码、名称或拼音简称的前缀检索证券，用于输入时的自动补全，见security.SecurityIndex
+
+    :param q: 前缀，不区分大小写，例如 '6000'、'平安'、'payh'
+    :param limit: 至多返回多少个证券
+    """
+    if not 1 <= limit <= MAX_SEARCH_LIMIT:
+        raise HTTPException(status_code=400, detail=f"limit must be in [1, {MAX_SEARCH_LIMIT}]")
+    index = await run_in_executor(security.get_security_index)
+    return JSONResponse({'results': [{'code': code, 'display_name': display_name, 'name': name}
+                                     for code, display_name, name in index.search(q, limit)]})
 
 
 @app.get("/profit-forecast/")
-def read_profit_forecast(code: str):
-    return {f"{code} profit forecast": rim.get_profit_forecast(code, adb.get_profit_forecast)}
+async def read_profit_forecast(code: str):
+    forecast = await run_in_executor(adb.get_profit_forecast)
+    try:
+        return {f"{code} profit forecast": forecast.loc[adb.security_id(code)].to_dict()}
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"{code} profit forecast not found")
 
 
 @app.get("/financial-indicator/")
-def read_indicator2018(code: str):
-    return {f"{code} 2018 financial indicator": rim.get_indicator2018(code, adb.get_indicator2018)}
+async def read_indicator2018(code: str):
+    indicator = await run_in_executor(adb.get_indicator)
+    try:
+        return {f"{code} 2018 financial indicator": indicator.loc[adb.security_id(code)].to_dict()}
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"{code} 2018 financial indicator not found")
 
 
 class RE(BaseModel):
@@ -63,13 +167,16 @@ class RIMValue(BaseModel):
 
 
 @app.get("/rim-value/", response_model=RIMValue)
-def read_rim_value(code: str):
-    return rim.calculate_rim_value(code)
+async def read_rim_value(code: str):
+    try:
+        return (await run_in_executor(adb.get_rim_value))(code)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"{code} rim value not found")
 
 
 @app.get("/profitability/8yr-roe/")
-def read_years_roe(code: str):
-    return profit_ability.calculate_yrs_roe(code)
+async def read_years_roe(code: str):
+    return await run_in_executor(profit_ability.calculate_yrs_roe, code)
 
 
 class MGMSValue(BaseModel):
@@ -82,8 +189,11 @@ class MGMSValue(BaseModel):
 
 
 @app.get("/profitability/mg-ms", response_model=MGMSValue)
-def read_years_roe(code: str):
-    return profit_ability.get_mg_ms(code)
+async def read_mg_ms(code: str):
+    mg_ms = await run_in_executor(profit_ability.get_mg_ms, code)
+    if mg_ms is None:
+        raise HTTPException(status_code=404, detail=f"{code} mg ms not found")
+    return mg_ms
 
 
 class RIMProposal(BaseModel):
@@ -102,14 +212,21 @@ class RIMProposal(BaseModel):
     g2_default: float = 0.02
 
 
-@app.get("/v1.0/rim-proposal", response_model=RIMProposal)
-def read_rim_proposal(code: str):
-    p = rim.build_rim_proposal(code)
+def _rim_proposal_dict(code: str, p) -> dict:
     return {'code': code, 'industry_roe': p.industry_roe,
             'analysis_eps': [('2019', p.eps_2019), ('2020', p.eps_2020), ('2021 ', p.eps_2021)],
             'last_bps': ('2018', p.bps_2018), 'last_eps': ('2018', p.eps_2018)}
 
 
+@app.get("/v1.0/rim-proposal", response_model=RIMProposal)
+async def read_rim_proposal(code: str):
+    try:
+        p = (await run_in_executor(adb.get_rim_proposal))(code)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"{code} rim proposal not found")
+    return _rim_proposal_dict(code, p)
+
+
 class PublicCompanyInfo(BaseModel):
     code: str
     market_value: float                 # 市值，单位~亿元
@@ -119,10 +236,18 @@ class PublicCompanyInfo(BaseModel):
     history: List[str] = ['To Do', ]                 # 上市历史
 
 
-@app.get("/v1.0/a_public_company_info", response_model=PublicCompanyInfo)
-def read_a_public_company_info(code: str):
-    market_value = adb.get_market_value()(code)
-    company_info = adb.get_company_info()(code)
+def _build_a_public_company_info(code: str) -> dict:
+    return _public_company_info_dict(code, adb.get_market_value()(code), adb.get_company_info()(code))
+
+
+def _build_public_company_infos(codes: List[str]) -> List[Optional[dict]]:
+    return [_public_company_info_dict(code, market_value, company_info)
+            if market_value is not None and company_info is not None else None
+            for code, market_value, company_info in zip(codes, adb.get_market_values_by_codes(codes),
+                                                        adb.get_company_info_by_codes(codes))]
+
+
+def _public_company_info_dict(code: str, market_value: adb.MarketValue, company_info: adb.CompanyInfo) -> dict:
     return {'code': code,
             'market_value': market_value.market_cap,
             'industry': company_info.industry_1 + '/' + company_info.industry_2,
@@ -131,6 +256,137 @@ def read_a_public_company_info(code: str):
                 if company_info.province not in ['重庆', '上海', '北京', '天津'] else company_info.province}
 
 
+@app.get("/v1.0/a_public_company_info", response_model=PublicCompanyInfo)
+async def read_a_public_company_info(code: str):
+    try:
+        return await run_in_executor(_build_a_public_company_info, code)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"{code} public company info not found")
+
+
+# 批量接口：每个单个公司的接口都有对应的批量接口，GET时codes为逗号分隔的公司代码，POST时请求体为{"codes": [...]}。
+# 返回 {"results": [...]}，与codes一一对应：找到的为{"code": ..., "data": 同单个公司接口的返回值}，
+# 找不到的为{"code": ..., "error": ...}，单个公司的错误不影响其余公司。
+
+class CodeList(BaseModel):
+    codes: List[str]
+
+
+def _split_codes(codes: str) -> List[str]:
+    return [code.strip() for code in codes.split(',') if code.strip()]
+
+
+def _json_safe(value):
+    """ NaN转换为None：JSON不允许NaN，一个公司的缺失数据不应使整个批量响应失败
+    """
+    if isinstance(value, float):
+        return None if math.isnan(value) else value
+    if isinstance(value, dict):
+        return {k: _json_safe(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_json_safe(v) for v in value]
+    return value
+
+
+def _rim_proposal_item(code: str, p) -> dict:
+    return RIMProposal(**_rim_proposal_dict(code, p)).dict()
+
+
+def _public_company_info_item(_, info: dict) -> dict:
+    return PublicCompanyInfo(**info).dict()
+
+
+async def _read_batch(codes: List[str], fetch: Callable[[List[str]], List], build: Callable,
+                      name: str) -> JSONResponse:
+    """
+    :param codes: 公司代码
+    :param fetch: 批量查询函数，返回与codes一一对应的列表，不存在的为None
+    :param build: (code, 查询结果) -> 返回给客户端的数据
+    :param name: 数据的名称，用于错误信息
+    """
+    if len(codes) > MAX_BATCH_CODES:
+        raise HTTPException(status_code=400, detail=f"at most {MAX_BATCH_CODES} codes per request")
+
+    def read() -> List[dict]:
+        return [{'code': code, 'data': _json_safe(build(code, result))} if result is not None
+                else {'code': code, 'error': f"{code} {name} not found"}
+                for code, result in zip(codes, fetch(codes))]
+    # 结果已经是JSON的基本类型，直接序列化，省去jsonable_encoder对每个字段的遍历
+    return JSONResponse({'results': await run_in_executor(read)})
+
+
+@app.get("/v1.0/batch/rim-proposal")
+async def read_rim_proposals(codes: str):
+    return await _read_batch(_split_codes(codes), adb.get_rim_proposals_by_codes, _rim_proposal_item, 'rim proposal')
+
+
+@app.post("/v1.0/batch/rim-proposal")
+async def post_rim_proposals(body: CodeList):
+    return await _read_batch(body.codes, adb.get_rim_proposals_by_codes, _rim_proposal_item, 'rim proposal')
+
+
+@app.get("/v1.0/batch/rim-value")
+async def read_rim_values(codes: str):
+    return await _read_batch(_split_codes(codes), adb.get_rim_values_by_codes, lambda _, v: v, 'rim value')
+
+
+@app.post("/v1.0/batch/rim-value")
+async def post_rim_values(body: CodeList):
+    return await _read_batch(body.codes, adb.get_rim_values_by_codes, lambda _, v: v, 'rim value')
+
+
+@app.get("/v1.0/batch/profitability/mg-ms")
+async def read_mg_ms_batch(codes: str):
+    return await _read_batch(_split_codes(codes), profit_ability.get_mg_ms_by_codes, lambda _, v: v, 'mg ms')
+
+
+@app.post("/v1.0/batch/profitability/mg-ms")
+async def post_mg_ms_batch(body: CodeList):
+    return await _read_batch(body.codes, profit_ability.get_mg_ms_by_codes, lambda _, v: v, 'mg ms')
+
+
+@app.get("/v1.0/batch/a_public_company_info")
+async def read_public_company_infos(codes: str):
+    return await _read_batch(_split_codes(codes), _build_public_company_infos, _public_company_info_item,
+                             'company info')
+
+
+@app.post("/v1.0/batch/a_public_company_info")
+async def post_public_company_infos(body: CodeList):
+    return await _read_batch(body.codes, _build_public_company_infos, _public_company_info_item,
+                             'company info')
+
+
+def _split_columns(text: str) -> List[str]:
+    return [c.strip() for c in text.split(',') if c.strip()]
+
+
+@app.get("/v1.0/screener")
+async def read_screener(filter: List[str] = Query([]), sort: str = '', page: int = 1, page_size: int = 50,
+                        columns: str = ''):
+    """
+    全市场选股，见screener
+
+    :param filter: 筛选条件，可以重复，同时满足，例如 value_to_price > 1.3 and mm >= 80 and not is_financial
+    :param sort: 排序键，以逗号分隔，前缀'-'代表降序，例如 -value_to_price,code
+    :param page: 页码，从1开始；超过最后一页时返回空的items，total为符合条件的公司数
+    :param page_size: 每页的公司数
+    :param columns: 返回的栏位，以逗号分隔，默认为全部栏位
+    :return: 筛选条件、排序键或栏位不合法，page小于1或者page_size超出范围时返回400
+    """
+    if page < 1 or not 1 <= page_size <= MAX_SCREENER_PAGE_SIZE:
+        raise HTTPException(status_code=400,
+                            detail=f"page must be >= 1 and page_size must be in [1, {MAX_SCREENER_PAGE_SIZE}]")
+
+    def read() -> dict:
+        return _json_safe(screener.screen(adb.get_screener_table(), filter, _split_columns(sort), page, page_size,
+                                          _split_columns(columns)))
+    try:
+        return JSONResponse(await run_in_executor(read))
+    except screener.ExpressionError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
 if __name__ == "__main__":
     uvicorn.run(app, host="127.0.0.1", port=8001)
     # uvicorn.run(app, host="172.19.217.132", port=80)
@@ -1,81 +1,108 @@
-from functools import lru_cache
-import datetime
-from typing import Tuple, List, Callable, NamedTuple
+from functools import lru_cache, partial
+from typing import Tuple, List, Callable, NamedTuple, Dict, Iterable, Optional
 from collections import namedtuple
 
-import sqlalchemy
+import numpy as np
 import pandas as pd
 
+from src.stock_data import engines, schema, snapshot
+from src.stock_data.panel import Panel
+from src.stock_data.security_master import get_security_master, read_security_master
+from src.stock_data.versioned_cache import versioned_cache
+
 
 def get_securities():
-    return pd.read_sql('securities', con=sqlalchemy.create_engine('sqlite:///../data/jq.db'))
+    return pd.read_sql('securities', con=engines.get_engine('jq'))
 
 
-@lru_cache(maxsize=1)
-def get_profit_forecast(today: str):
-    assert today is not None    # 这个参数是为了cache需要，只要在一个日子中，就不需要重复从数据库拿数据
-    df = pd.read_sql('profit_forecast', con=sqlalchemy.create_engine('sqlite:///../data/em1.db'))\
-        .set_index('code')\
-        .drop('index', axis=1)
-    return df[['eps_2019', 'eps_2020', 'eps_2021']].apply(pd.to_numeric, errors='coerce', downcast='float')
+def security_id(code: str) -> int:
+    """ 任意格式的证券代码在证券主表中的security_id，不存在时抛出KeyError；以security_id为索引的数据集用它来查询
+    """
+    return get_security_master().id_of(code)
 
 
-@lru_cache(maxsize=1)
-def get_indicator(year: str = '2018'):
-    assert year == '2018'
-    indicator: pd.DataFrame = pd.read_sql('indicator2018', con=sqlalchemy.create_engine('sqlite:///../data/ts.db'))
-    indicator['ts_code'] = indicator['ts_code'].map(lambda x: x[:6])
-    return indicator.set_index('ts_code')\
-        .drop('index', axis=1)
+def _by_security_id(items: Iterable[Tuple[str, object]]) -> List[Optional[object]]:
+    """ 把(证券代码, 值)转换为以security_id为下标的列表，没有值的证券为None
+    """
+    master = read_security_master()
+    items = list(items)
+    values = [None] * len(master)
+    for i, (_, value) in zip(master.ids([code for code, _ in items]).tolist(), items):
+        if i >= 0:
+            values[i] = value
+    return values
 
 
-def _today() -> str:
-    return datetime.datetime.now().strftime("%Y-%m-%d")
+def _lookup(values: List[Optional[object]], code: str):
+    """ 以证券代码查询_by_security_id返回的列表，不存在时抛出KeyError
+    """
+    i = security_id(code)
+    value = values[i] if i < len(values) else None
+    if value is None:
+        raise KeyError(code)
+    return value
 
 
-@lru_cache(maxsize=1)
-def get_financial_indicator(today: str = _today()) -> pd.DataFrame:
+def _getter(values: List[Optional[object]]) -> Callable[[str], object]:
+    return partial(_lookup, values)
+
+
+def _lookup_many(values: List[Optional[object]], codes: List[str]) -> List[Optional[object]]:
+    """ _lookup的批量版本：一次向量化地把全部代码转换为security_id，返回与codes一一对应的列表，不存在的为None
+    """
+    n = len(values)
+    return [values[i] if 0 <= i < n else None for i in get_security_master().ids(codes).tolist()]
+
+
+@versioned_cache('em', 'master')
+def get_profit_forecast():
+    df = pd.read_sql('SELECT code, eps_2019, eps_2020, eps_2021 FROM profit_forecast', con=engines.get_engine('em'))
+    # 未迁移的em1.db或迁移时保留为TEXT的栏位中可能有'-'之类的文本，视为空值
+    return read_security_master().index_by_id(df.set_index('code').apply(pd.to_numeric, errors='coerce')
+                                              .astype('float32'))
+
+
+@versioned_cache('ts', 'master')
+def get_indicator(year: str = '2018'):
+    assert year == '2018'
+    indicator: pd.DataFrame = snapshot.load_table('ts', 'indicator2018', ['ts_code', 'eps', 'bps'])
+    return read_security_master().index_by_id(indicator.set_index('ts_code'))
+
+
+@versioned_cache('ts')
+def get_financial_indicator() -> Panel:
     """
     get the tushare financial indicator from ts.db
     That is a table with ts_code, end_date and grossprofit_margin column
-
-    Parameters
-    ----------
-    today : str
-        today这个参数是为了cache需要，只要在一个日子中，就不需要重复从数据库拿数据
+    ts.db被写入之后才会重新读取
 
     Returns
     -------
-    table : DataFrame
+    table : Panel
         剔除了毛利率异常的数据（grossprofit_margin<=0 or grossprofit_margin>=100)
         按ts_code、end_date字典序排序
     """
-    return pd.read_sql('SELECT ts_code, end_date, grossprofit_margin FROM financial_indicator \
-                        WHERE 0 <= grossprofit_margin and grossprofit_margin <= 100\
-                        ORDER BY ts_code, end_date',
-                       con=sqlalchemy.create_engine('sqlite:///../../data/ts.db'))\
-        .set_index(['ts_code', 'end_date'])
+    df = snapshot.load_table('ts', 'financial_indicator', ['ts_code', 'end_date', 'grossprofit_margin'])
+    return Panel.from_frame(df[(0 <= df['grossprofit_margin']) & (df['grossprofit_margin'] <= 100)]
+                            .set_index(['ts_code', 'end_date']))
 
 
-@lru_cache(maxsize=1)
-def get_ts_statement(name: str, today: str = _today()) -> pd.DataFrame:
+@versioned_cache('ts', maxsize=4)      # balancesheet、income等报表各一项
+def get_ts_statement(name: str) -> Panel:
     """
-    get the statement from ts.db
+    get the statement from ts.db, ts.db被写入之后才会重新读取
 
     Parameters
     ----------
     name: str
         statement name, for example, 'balancesheet'
-    today : str
-        today这个参数是为了cache需要，只要在一个日子中，就不需要重复从数据库拿数据
 
     Returns
     -------
-    table : DataFrame
+    table : Panel
     """
-    return pd.read_sql(f'SELECT * FROM {name}',
-                       con=sqlalchemy.create_engine('sqlite:///../../data/ts.db'))\
-        .set_index(['ts_code', 'end_date'])
+    df = snapshot.load_table('ts', name).set_index(['ts_code', 'end_date'])
+    return Panel.from_frame(df, schema.real_columns('ts', name, df.columns))
 
 
 def get_financial_indicator_by_code(code: str) -> pd.DataFrame:
@@ -85,7 +112,7 @@ def get_financial_indicator_by_code(code: str) -> pd.DataFrame:
     输出规定:
     列名同tushare的财务指标表格，包含了code的所有数据
     """
-    return get_financial_indicator().loc[code]
+    return get_financial_indicator().get(code)
 
 
 def save_profitability_index_to_db(data: List[Tuple[str, float, int, float, int]]) -> None:
@@ -98,21 +125,27 @@ def save_profitability_index_to_db(data: List[Tuple[str, float, int, float, int]
     :return: None
     """
     p = pd.DataFrame(data, columns=['ts_code', 'mg', 'mg_rank', 'ms', 'ms_rank']).set_index('ts_code')
-    p.to_sql('profitability_index', con=sqlalchemy.create_engine('sqlite:///../../data/indicator.db'),
+    p.to_sql('profitability_index', con=engines.get_engine('indicator'),
              if_exists='replace')
 
 
-@lru_cache(maxsize=1)
-def read_profitability_index(today: str = _today()) -> pd.DataFrame:
+@versioned_cache('indicator', 'master')
+def read_profitability_index() -> pd.DataFrame:
     """
     从indicator数据库中读取盈利能力指标，包括了盈利增长指标和其全市场百分位，盈利稳定性指标和其全市场百分位
+    indicator.db或master.db被写入之后才会重新读取
 
-    :param today: 日期字符串
-                    此参数主要是为了cache，一般盈利能力指标在日内是不会变化的
-    :return: index为ts_code的DataFrame，有4各栏位mg, mg_rank, ms and ms_rank
+    :return: index为security_id的DataFrame，有4各栏位mg, mg_rank, ms and ms_rank
     """
-    return pd.read_sql('profitability_index', con=sqlalchemy.create_engine('sqlite:///../../data/indicator.db'))\
-        .set_index('ts_code')
+    return read_security_master().index_by_id(pd.read_sql('profitability_index', con=engines.get_engine('indicator'))
+                                              .set_index('ts_code'))
+
+
+@lru_cache(maxsize=1)
+def _load_sw_industry_roe() -> pd.DataFrame:
+    df = pd.read_csv(engines.get_data_path('wind_sw_industry_roe.csv'), encoding='GBK')[['代码', '行业名称', 'mean']]
+    df['代码'] = df['代码'].str[:6]
+    return df.set_index('代码')
 
 
 def get_sw_industry_roe() -> Callable[[str], Tuple[str, str, float]]:
@@ -129,16 +162,13 @@ def get_sw_industry_roe() -> Callable[[str], Tuple[str, str, float]]:
 
     Post condition:
     ===============================================================================================
-    查询过后，相关的全行业净资产收益率被保存在闭包中
+    调用本函数时不读取文件，闭包第一次被调用时才读取，此后全行业净资产收益率被保存在内存中
     :return: 闭包函数
                 输入参数申万行业指数，输出是元组，第一项行业指数，第二项行业名称，第三项行业净资产收益率
     """
-    df = pd.read_csv('../data/wind_sw_industry_roe.csv', encoding='GBK')[['代码', '行业名称', 'mean']]
-    df['代码'] = df['代码'].map(lambda x: x[:6])
-    df = df.set_index('代码')
     return lambda industry_index: (industry_index,
-                                   df.loc[industry_index]['行业名称'],
-                                   df.loc[industry_index]['mean'] / 100)
+                                   _load_sw_industry_roe().loc[industry_index]['行业名称'],
+                                   _load_sw_industry_roe().loc[industry_index]['mean'] / 100)
 
 
 def get_sw_industry() -> Callable[[str], str]:
@@ -150,54 +180,293 @@ def get_sw_industry() -> Callable[[str], str]:
 
     Post condition
     ====================================================================================================
+    调用本函数时不读取数据库，闭包第一次被调用时才读取
     :return: 闭包函数
                 输入参数是上市公司代码，输出是申万二级行业代码
     """
-    df = pd.read_sql_table('industries', con=sqlalchemy.create_engine('sqlite:///../data/jq.db'))
-    df = df.set_index('code')
-    return lambda code: df.loc[_to_jq_code(code)]['sw_l2']
+    return lambda code: _load_sw_industry().loc[security_id(code)]['sw_l2']
+
+
+@versioned_cache('jq', 'master')
+def _load_sw_industry() -> pd.DataFrame:
+    return read_security_master().index_by_id(pd.read_sql_table('industries', con=engines.get_engine('jq'))
+                                              .set_index('code'))
+
+
+CompanyInfo = namedtuple('CompanyInfo', ['website', 'province', 'city', 'industry_1', 'industry_2', 'main_business'])
+MarketValue = namedtuple('MarketValue', ['market_cap', 'pe_ratio', 'pb_ratio', 'ps_ratio', 'pcf_ratio'])
 
 
-def get_company_info() -> Callable[[str], NamedTuple]:
+@versioned_cache('jq', 'master')
+def _load_company_info() -> List[Optional[CompanyInfo]]:
+    df = pd.read_sql(f"SELECT code, {', '.join(CompanyInfo._fields)} FROM company_info", con=engines.get_engine('jq'))
+    return _by_security_id((code, CompanyInfo(*values)) for code, *values in df.itertuples(index=False, name=None))
+
+
+def get_company_info() -> Callable[[str], CompanyInfo]:
     """ 获取上市公司的基本信息
 
     Precondition
     =====================================================================================================
-    ../data/jq.db 存在
+    数据目录下jq.db 存在
     jq.db中存在'company_info'表，其内容同 https://www.joinquant.com/help/api/help?name=JQData#上市公司基本信息
 
     Post condition
     ====================================================================================================
+    全表只在jq.db被写入后重新读取，以security_id为下标保存在内存中
     :return: 闭包函数
                 输入参数是上市公司代码，输出是上市公司信息
     """
-    df = pd.read_sql_table('company_info', con=sqlalchemy.create_engine('sqlite:///../data/jq.db'))
-    df = df.set_index('code')[['website', 'province', 'city', 'industry_1', 'industry_2', 'main_business']]
-    return lambda code: namedtuple('CompanyInfo', df.loc[_to_jq_code(code)].index)(*df.loc[_to_jq_code(code)])
+    return _getter(_load_company_info())
+
+
+def get_company_info_by_codes(codes: List[str]) -> List[Optional[CompanyInfo]]:
+    """ 批量获取上市公司的基本信息，与codes一一对应，不存在的为None
+    """
+    return _lookup_many(_load_company_info(), codes)
+
 
+@versioned_cache('jq', 'master')
+def _load_market_value() -> List[Optional[MarketValue]]:
+    df = pd.read_sql(f"SELECT code, {', '.join(MarketValue._fields)} FROM market_value", con=engines.get_engine('jq'))
+    return _by_security_id((code, MarketValue(*values)) for code, *values in df.itertuples(index=False, name=None))
 
-def get_market_value() -> Callable[[str], NamedTuple]:
+
+def get_market_value() -> Callable[[str], MarketValue]:
     """ 获取上市公司的最近交易日的市值和相关信息
 
     Precondition
     =====================================================================================================
-    ../data/jq.db 存在
+    数据目录下jq.db 存在
     jq.db中存在'market_value'表，其内容同 https://www.joinquant.com/help/api/help?name=JQData#市值数据（每日更新）
 
     Post condition
     ====================================================================================================
+    全表只在jq.db被写入后重新读取，以security_id为下标保存在内存中
     :return: 闭包函数
                 输入参数是上市公司代码，输出是上市公司最近交易日的市值和相关信息
     """
-    df = pd.read_sql_table('market_value', con=sqlalchemy.create_engine('sqlite:///../data/jq.db'))
-    df = df.set_index('code')[['market_cap', 'pe_ratio', 'pb_ratio', 'ps_ratio', 'pcf_ratio']]
-    return lambda code: namedtuple('market_value', df.loc[_to_jq_code(code)].index)(*df.loc[_to_jq_code(code)])
+    return _getter(_load_market_value())
+
+
+def get_market_values_by_codes(codes: List[str]) -> List[Optional[MarketValue]]:
+    """ 批量获取上市公司最近交易日的市值，与codes一一对应，不存在的为None
+    """
+    return _lookup_many(_load_market_value(), codes)
+
+
+RIM_FIELDS = ['rr', 'gr', 'value', 'discounted_re2019', 'discounted_re2020', 'discounted_re2021', 'discounted_cv']
+
 
+class RimValueTable:
+    """ 以security_id为下标的剩余收益估值，代替每家公司一个嵌套dict的列表
 
-def _to_jq_code(code: str) -> str:
-    """ 上市公司代码转换为jq风格
+    全部估值按(security_id, rr, gr)排序保存在一个float64二维数组中，security_id为i的行是offsets[i]:offsets[i+1]；
+    下标访问时才组装成api.RIMValue格式的dict，没有估值的证券为None，因此可以直接交给_lookup和_lookup_many
     """
-    return f"{code}.XSHG" if code[0] == '6' else f"{code}.XSHE"
+    __slots__ = ('offsets', 'bps2018', 'values')
+
+    def __init__(self, offsets: np.ndarray, bps2018: np.ndarray, values: np.ndarray):
+        self.offsets = offsets
+        self.bps2018 = bps2018
+        self.values = values
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame, ids: np.ndarray, n: int) -> 'RimValueTable':
+        """
+        :param df: rim_value表，已按(code, rr, gr)排序
+        :param ids: 每一行的security_id，不在证券主表中的为-1
+        :param n: 证券主表的长度
+        """
+        keep = ids >= 0
+        order = np.argsort(ids[keep], kind='stable')
+        ids = ids[keep][order]
+        offsets = np.searchsorted(ids, np.arange(n + 1), side='left').astype(np.int32)
+        # 每家公司的bps2018取其第一行
+        bps2018 = np.full(n, np.nan)
+        present = np.diff(offsets) > 0
+        bps2018[present] = df['bps2018'].values.astype(np.float64)[keep][order][offsets[:-1][present]]
+        return cls(offsets, bps2018, df[RIM_FIELDS].values.astype(np.float64)[keep][order])
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> Optional[dict]:
+        start, end = self.offsets[i], self.offsets[i + 1]
+        if start == end:
+            return None
+        rows = self.values[start:end].tolist()
+        return {'bps2018': self.bps2018[i].item(),
+                'rr': sorted(set(row[0] for row in rows)),
+                'gr': sorted(set(row[1] for row in rows)),
+                're': [dict(zip(RIM_FIELDS, row)) for row in rows]}
+
+    def memory_usage(self) -> int:
+        """ 占用的内存（字节）
+        """
+        return int(self.offsets.nbytes + self.bps2018.nbytes + self.values.nbytes)
+
+
+@versioned_cache('indicator', 'master')
+def _load_rim_value() -> RimValueTable:
+    df = pd.read_sql('SELECT * FROM rim_value ORDER BY code, rr, gr',
+                     con=engines.get_engine('indicator'))
+    master = read_security_master()
+    return RimValueTable.from_frame(df, master.ids(df['code'].values), len(master))
+
+
+def get_rim_value() -> Callable[[str], dict]:
+    """ 获取批量任务（business.rim.calc_and_save_rim_values）预先计算好的剩余收益估值
+
+    Precondition
+    =====================================================================================================
+    数据目录下indicator.db 存在，其中存在'rim_value'表
+
+    Post condition
+    ====================================================================================================
+    :return: 闭包函数
+                输入参数是上市公司代码，输出是不同(rr, gr)假设下的剩余收益估值，格式同api.RIMValue
+    """
+    return _getter(_load_rim_value())
+
+
+def get_rim_values_by_codes(codes: List[str]) -> List[Optional[dict]]:
+    """ 批量获取剩余收益估值，与codes一一对应，不存在的为None
+    """
+    return _lookup_many(_load_rim_value(), codes)
+
+
+ValuationFeature = namedtuple('ValuationFeature', ['code', 'bps_2018', 'eps_2018', 'eps_2019', 'eps_2020', 'eps_2021',
+                                                   'sw_l2', 'industry_name', 'industry_roe', 'market_cap'])
+
+
+@versioned_cache('indicator', 'master')
+def _load_valuation_feature() -> List[Optional[ValuationFeature]]:
+    df = pd.read_sql(f"SELECT {', '.join(ValuationFeature._fields)} FROM valuation_feature",
+                     con=engines.get_engine('indicator'))
+    return _by_security_id((values[0], ValuationFeature(*values)) for values in df.itertuples(index=False, name=None))
+
+
+def _find_valuation_feature(code: str) -> ValuationFeature:
+    return _lookup(_load_valuation_feature(), code)
+
+
+def get_valuation_feature() -> Callable[[str], ValuationFeature]:
+    """ 获取批量任务（business.rim.calc_and_save_rim_values）按数据版本预先构建好的估值特征
+
+    Precondition
+    =====================================================================================================
+    数据目录下indicator.db 存在，其中存在'valuation_feature'表，每个公司一行，栏位同ValuationFeature
+
+    Post condition
+    ====================================================================================================
+    调用本函数时不读取数据库；全表只在indicator.db被写入后重新读取，以security_id为下标保存在内存中，
+    每次查询只是一次下标运算
+    :return: 闭包函数
+                输入参数是上市公司代码，输出是ValuationFeature，缺失的数据为nan
+    """
+    return _find_valuation_feature
+
+
+def _to_rim_proposal(feature: Optional[ValuationFeature]) -> Optional[ValuationFeature]:
+    if feature is None or pd.isna(feature.industry_roe):     # 没有行业净资产收益率的公司不提供估值建议
+        return None
+    return feature._replace(**{field: 0 for field in ('eps_2019', 'eps_2020', 'eps_2021')
+                               if pd.isna(getattr(feature, field))})
+
+
+def _find_rim_proposal(code: str) -> ValuationFeature:
+    proposal = _to_rim_proposal(_find_valuation_feature(code))
+    if proposal is None:
+        raise KeyError(code)
+    return proposal
+
+
+def get_rim_proposal() -> Callable[[str], NamedTuple]:
+    """ 获取RIM估值建议数据，数据来自估值特征表（见get_valuation_feature）
+
+    Precondition
+    =====================================================================================================
+    数据目录下indicator.db 存在，其中存在'valuation_feature'表
+
+    Post condition
+    ====================================================================================================
+    :return: 闭包函数
+                输入参数是上市公司代码，输出是RIM估值建议数据，包含rim.RimProposal的全部字段；
+                没有eps预测值的年度为零
+    """
+    return _find_rim_proposal
+
+
+def get_rim_proposals_by_codes(codes: List[str]) -> List[Optional[ValuationFeature]]:
+    """ 批量获取RIM估值建议数据，与codes一一对应，不存在的为None
+    """
+    return [_to_rim_proposal(feature) for feature in _lookup_many(_load_valuation_feature(), codes)]
+
+
+# 选股表中剩余收益估值所用的假设，同api.RIMProposal的默认值
+SCREENER_RR = 0.10
+SCREENER_GR = 0.02
+
+# 申万二级行业中的金融行业
+FINANCIAL_INDUSTRIES = ('银行', '证券', '保险', '多元金融')
+
+
+@versioned_cache('indicator', 'jq', 'master')
+def get_screener_table() -> pd.DataFrame:
+    """ 选股表：每个公司一行，关联估值特征、剩余收益估值、盈利能力指标、市值和公司信息，见screener
+
+    Precondition
+    =====================================================================================================
+    indicator.db中存在'valuation_feature'、'rim_value'和'profitability_index'表；
+    jq.db中存在'market_value'和'company_info'表
+
+    Post condition
+    ====================================================================================================
+    indicator.db、jq.db或master.db被写入之后才会重新读取
+    :return: index为security_id的DataFrame，任何一个数据集中出现过的公司都有一行，缺失的数据为空值。栏位包括：
+             code, bps_2018, eps_2018~eps_2021, sw_l2, industry_name, industry_roe（估值特征）,
+             rim_value（rr=SCREENER_RR, gr=SCREENER_GR时的估值）, mg, mg_rank, ms, ms_rank, mm（盈利能力）,
+             market_cap, pe_ratio, pb_ratio, ps_ratio, pcf_ratio（市值）, industry_1, industry_2（公司信息）,
+             value_to_price（rim_value / 股价，股价以pb_ratio * bps_2018近似）, is_financial（是否金融行业）
+    """
+    master = read_security_master()
+    indicator, jq = engines.get_engine('indicator'), engines.get_engine('jq')
+    features = pd.read_sql('SELECT * FROM valuation_feature', con=indicator)\
+        .set_index('code')\
+        .drop(columns=['data_version', 'market_cap'])
+    rim_value = pd.read_sql('SELECT code, rr, gr, value AS rim_value FROM rim_value', con=indicator)
+    rim_value = rim_value[np.isclose(rim_value['rr'], SCREENER_RR) & np.isclose(rim_value['gr'], SCREENER_GR)]\
+        .set_index('code')[['rim_value']]
+    market_value = pd.read_sql(f"SELECT code, {', '.join(MarketValue._fields)} FROM market_value", con=jq)\
+        .set_index('code')
+    company_info = pd.read_sql('SELECT code, industry_1, industry_2 FROM company_info', con=jq).set_index('code')
+
+    df = master.index_by_id(features).join([master.index_by_id(rim_value), read_profitability_index(),
+                                            master.index_by_id(market_value), master.index_by_id(company_info)],
+                                           how='outer')
+    df.insert(0, 'code', master.codes[df.index.values].astype(object))
+    df['mm'] = df[['mg_rank', 'ms_rank']].max(axis=1, skipna=False)
+    df['value_to_price'] = (df['rim_value'] / (df['pb_ratio'] * df['bps_2018'])).replace([np.inf, -np.inf], np.nan)
+    df['is_financial'] = df['industry_name'].astype(object).fillna('').str.startswith(FINANCIAL_INDUSTRIES)\
+        .astype(bool)
+    return df
+
+
+# API所用的数据集及其加载函数。模块导入时不做任何I/O，数据集在第一次使用时加载，服务启动时则并行预热
+DATASETS: Dict[str, Callable[[], object]] = {
+    'security_master': get_security_master,
+    'profit_forecast': get_profit_forecast,
+    'indicator': get_indicator,
+    'profitability_index': read_profitability_index,
+    'company_info': _load_company_info,
+    'market_value': _load_market_value,
+    'rim_value': _load_rim_value,
+    'valuation_feature': _load_valuation_feature,
+    'sw_industry': _load_sw_industry,
+    'sw_industry_roe': _load_sw_industry_roe,
+    'screener': get_screener_table,
+}
 
 
 if __name__ == "__main__":
@@ -0,0 +1,71 @@
+""" 启动时间基准测试
+
+测量在新的Python进程中 import 某个模块（默认为src.api）所需的时间，结果追加到数据目录下的 benchmark/import_time.csv，
+便于跟踪启动时间的变化。
+
+用法（在项目根目录下）：
+    python -m src.bench_import [模块名] [重复次数]          # 例如 python -m src.bench_import src.aqi_db 20
+"""
+import csv
+import datetime
+import os
+import statistics
+import subprocess
+import sys
+from typing import List
+
+from src.stock_data import engines
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure_import(module: str = 'src.api', repeat: int = 10) -> List[float]:
+    """
+    在新的Python进程中import模块，测量所需的时间
+
+    :param module: 模块名，以src.为根，例如'src.api'
+    :param repeat: 重复次数
+    :return: 每次import所需的秒数
+    """
+    code = f'import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)'
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT_DIR, os.environ.get('PYTHONPATH', '')]))
+    return [float(subprocess.run([sys.executable, '-c', code], cwd=ROOT_DIR, env=env, check=True,
+                                 stdout=subprocess.PIPE, universal_newlines=True).stdout)
+            for _ in range(repeat)]
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR, check=True,
+                              stdout=subprocess.PIPE, universal_newlines=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def record(module: str, timings: List[float]) -> str:
+    """
+    把测量结果追加到 benchmark/import_time.csv
+
+    :return: csv文件路径
+    """
+    path = engines.get_data_path(os.path.join('benchmark', 'import_time.csv'))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    is_new = not os.path.exists(path)
+    with open(path, 'a', newline='') as f:
+        writer = csv.writer(f)
+        if is_new:
+            writer.writerow(['time', 'revision', 'module', 'repeat', 'median', 'min', 'max'])
+        writer.writerow([datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), _git_revision(), module,
+                         len(timings), f'{statistics.median(timings):.4f}', f'{min(timings):.4f}',
+                         f'{max(timings):.4f}'])
+    return path
+
+
+if __name__ == "__main__":
+    name = sys.argv[1] if len(sys.argv) > 1 else 'src.api'
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    result = measure_import(name, n)
+    print(f"import {name}: median {statistics.median(result):.4f}s, min {min(result):.4f}s, "
+          f"max {max(result):.4f}s ({n}次)")
+    print(f"结果已保存到 {record(name, result)}")
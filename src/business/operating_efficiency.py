@@ -1,86 +1,145 @@
-from typing import List, Tuple, Iterator, NoReturn
-from functools import reduce
+""" 经营效率指标
+
+经营资产（operating assets, OA）、经营负债（operating liabilities, OL）、净经营资产（NOA = OA - OL）、
+经营资产周转率（ATO = 营业收入 / 年初和年末NOA的平均值）以及ATO的年度增加值（ΔATO）
+"""
+from typing import List
 
 from toolz import pipe
 import pandas as pd
 import numpy as np
 
 from src.stock_data import rim_db as rdb
+from src.stock_data.security_master import SecurityMaster, load_security_master, take
+
+
+OA_SUBJECTS: List[str] = ['notes_receiv', 'accounts_receiv', 'oth_receiv', 'prepayment', 'inventories', 'amor_exp',
+                          'nca_within_1y', 'oth_cur_assets', 'oth_assets', 'lt_rec', 'fix_assets', 'cip',
+                          'const_materials', 'fixed_assets_disp', 'produc_bio_assets', 'oil_and_gas_assets',
+                          'intan_assets', 'r_and_d', 'goodwill', 'lt_amor_exp', 'defer_tax_assets', 'oth_nca',
+                          'hfs_assets']
+
+OL_SUBJECTS: List[str] = ['notes_payable', 'acct_payable', 'adv_receipts', 'payroll_payable', 'taxes_payable',
+                          'oth_payable', 'acc_exp', 'deferred_inc', 'oth_cur_liab', 'lt_payable', 'specific_payables',
+                          'estimated_liab', 'defer_tax_liab', 'defer_inc_non_cur_liab', 'oth_ncl',
+                          'lt_payroll_payable', 'hfs_sales']
+
 
+def _sum_subjects(statement: pd.DataFrame, subjects: List[str]) -> np.ndarray:
+    """
+    把若干科目按行求和，空值视为0；部分科目在数据库中是文本类型，统一转换为浮点数
 
-def _calc_delta_ato() -> List[Tuple[str, float, float]]:
+    :param statement: 资产负债表
+    :param subjects: 科目列表
+    :return: 每一行的合计数
     """
-    计算上市公司的经营资产周转率的增加值
+    values = np.column_stack([pd.to_numeric(statement[subject], errors='coerce').values for subject in subjects])
+    return np.nansum(values, axis=1)
+
 
-    :param today: datetime.date or str
+def _calc_noa(balancesheet: pd.DataFrame) -> pd.DataFrame:
+    """
+    计算非金融上市公司年报的经营资产、经营负债和净经营资产
 
-    :return:
+    :param balancesheet: DataFrame，多重索引为ts_code/end_date，栏位包含comp_type、OA_SUBJECTS和OL_SUBJECTS
+    :return: DataFrame，多重索引为ts_code/end_date，仅包含年报（end_date为12月31日），栏位为oa, ol, noa
     """
-    pass
+    statement = balancesheet[(balancesheet['comp_type'] == '1')
+                             & (balancesheet.index.get_level_values('end_date').str[4:] == '1231')]
+    statement = statement[~statement.index.duplicated(keep='first')]
+    oa = _sum_subjects(statement, OA_SUBJECTS)
+    ol = _sum_subjects(statement, OL_SUBJECTS)
+    return pd.DataFrame({'oa': oa, 'ol': ol, 'noa': oa - ol}, index=statement.index)
 
 
-def _calc_and_save_delta_ato() -> NoReturn:
+def _calc_delta_ato(noa: pd.DataFrame, income: pd.DataFrame) -> pd.DataFrame:
+    """
+    计算上市公司最近一个年度的经营资产周转率及其相对上一年度的增加值
+
+    ATO(t) = revenue(t) / ((NOA(t) + NOA(t-1)) / 2)，平均NOA不大于0时无意义
+    ΔATO(t) = ATO(t) - ATO(t-1)，因此需要连续3年的资产负债表和最近2年的利润表
+
+    :param noa: _calc_noa返回的DataFrame
+    :param income: DataFrame，多重索引为ts_code/end_date，栏位包含revenue
+    :return: DataFrame，index为ts_code，栏位为end_date, oa, ol, noa, revenue, ato, ato_last_year, delta_ato；
+             数据不足以计算ΔATO的公司不包含在内
+    """
+    revenue = pd.to_numeric(income['revenue'], errors='coerce')
+    df = noa.join(revenue[~revenue.index.duplicated(keep='first')], how='left').sort_index()
+
+    codes = df.index.get_level_values('ts_code').values
+    years = df.index.get_level_values('end_date').str[:4].astype(int).values
+    noa_values = df['noa'].values
+
+    # 与上一行是同一个公司且相差一年
+    consecutive = np.zeros(len(df), dtype=bool)
+    consecutive[1:] = (codes[1:] == codes[:-1]) & (years[1:] == years[:-1] + 1)
+
+    average_noa = np.full(len(df), np.nan)
+    average_noa[1:] = (noa_values[1:] + noa_values[:-1]) / 2
+    average_noa[~consecutive | (average_noa <= 0)] = np.nan
+    ato = df['revenue'].values / average_noa
+
+    ato_last_year = np.full(len(df), np.nan)
+    ato_last_year[1:] = ato[:-1]
+    ato_last_year[~consecutive] = np.nan
+
+    # 每个公司只取最近一个年度
+    latest = np.ones(len(df), dtype=bool)
+    latest[:-1] = codes[:-1] != codes[1:]
+    delta_ato = ato - ato_last_year
+    selected = latest & np.isfinite(delta_ato)
+
+    return pd.DataFrame({'end_date': df.index.get_level_values('end_date').values[selected],
+                         'oa': df['oa'].values[selected],
+                         'ol': df['ol'].values[selected],
+                         'noa': noa_values[selected],
+                         'revenue': df['revenue'].values[selected],
+                         'ato': ato[selected],
+                         'ato_last_year': ato_last_year[selected],
+                         'delta_ato': delta_ato[selected]},
+                        index=pd.Index(codes[selected], name='ts_code'))
+
+
+def _rank_in_industry(delta_ato: pd.DataFrame, industry: pd.DataFrame, master: SecurityMaster) -> pd.DataFrame:
+    """
+    计算ΔATO在申万二级行业内的排序
+
+    :param delta_ato: _calc_delta_ato返回的DataFrame
+    :param industry: index为6位数公司代码的DataFrame，包含sw_l2栏位，见rim_db.get_sw_industry
+    :param master: 证券主表，两个数据集按security_id关联
+    :return: 在delta_ato的基础上增加sw_l2, industry_rank, industry_count栏位；
+             industry_rank为1代表行业内ΔATO最大，没有行业分类的公司排序为空
+    """
+    sw_l2 = take(master.index_by_id(industry), master.ids(delta_ato.index))['sw_l2'].values
+    df = delta_ato.assign(sw_l2=sw_l2)
+    grouped = df.groupby('sw_l2')['delta_ato']
+    return df.assign(industry_rank=grouped.rank(method='min', ascending=False),
+                     industry_count=grouped.transform('count'))
+
+
+def _calc_and_save_delta_ato() -> int:
     """
     根据最近报告的资产负债表，计算并保存非金上市公司的年度经营资产周转率、增加值以及增加值的行业排序
 
-    :return: NoReturn
+    :return: 保存了多少个公司的指标
+
+    Notes:
+    This is a impure function.
+    --------
     """
-    oa_subjects: List[str] = ['notes_receiv', 'accounts_receiv', 'oth_receiv', 'prepayment', 'inventories', 'amor_exp',
-                              'nca_within_1y', 'oth_cur_assets', 'oth_assets', 'lt_rec', 'fix_assets', 'cip',
-                              'const_materials', 'fixed_assets_disp', 'produc_bio_assets', 'oil_and_gas_assets',
-                              'intan_assets', 'r_and_d', 'goodwill', 'lt_amor_exp', 'defer_tax_assets', 'oth_nca']
-
-    def _iterate_by_code(statements: pd.DataFrame) -> Iterator[pd.DataFrame]:
-        return (group.sort_values(by='end_date')[-3:] for idx, group in statements.groupby(level='ts_code'))
-
-    def _calc_amount(security: pd.DataFrame, subjects: List[str]) -> float:
-        return [(security.index[0], reduce(lambda x, y: x + float(security[y][0]), subjects, 0)) for i in range(2)]
-
-    def _add_oa(statement):
-        statement['oa'] = statement['notes_receiv'] + statement['accounts_receiv'] + statement['oth_receiv'] \
-                          + statement['prepayment'] + statement['inventories'] + statement['amor_exp'] \
-                          + statement['nca_within_1y'] + statement['oth_cur_assets'] + statement['oth_assets'] \
-                          + statement['lt_rec'] + statement['fix_assets'] + statement['cip'] \
-                          + statement['const_materials'] + statement['fixed_assets_disp'] \
-                          + statement['produc_bio_assets'] + statement['oil_and_gas_assets'] \
-                          + statement['intan_assets'] + statement['r_and_d'] + statement['goodwill'] \
-                          + statement['lt_amor_exp'] + statement['defer_tax_assets'] + statement['oth_nca'] \
-                          + statement['hfs_assets']
-        return statement
-
-    def _add_ol(statement):
-        statement['ol'] = statement['notes_payable'] + statement['acct_payable'] + statement['adv_receipts'] \
-                          + statement['payroll_payable'] + statement['taxes_payable'] + statement['oth_payable'] \
-                          + statement['acc_exp'] + statement['deferred_inc'] + statement['oth_cur_liab'] \
-                          + statement['lt_payable'] + statement['specific_payables'] + statement['estimated_liab'] \
-                          + statement['defer_tax_liab'] + statement['defer_inc_non_cur_liab'] + statement['oth_ncl'] \
-                          + statement['lt_payroll_payable'] + statement['hfs_sales']
-        return statement
-
-    def _add_noa(statement: pd.DataFrame) -> pd.DataFrame:
-        statement['noa'] = statement['oa'] - statement['ol']
-
-    def _transfer_str_to_float(statements: pd.DataFrame) -> pd.DataFrame:
-        statements[['produc_bio_assets', 'oil_and_gas_assets', 'acc_exp', 'deferred_inc', 'hfs_sales']] = \
-            statements[['produc_bio_assets', 'oil_and_gas_assets', 'acc_exp', 'deferred_inc', 'hfs_sales']] \
-                .astype(float)
-        return statements
-
-    def _add_ato(statement: pd.DataFrame) -> pd.DataFrame:
-        pass
-
-    test = pipe(rdb.get_ts_statement('balancesheet'),
-                lambda x: x[x['comp_type'] == '1'],
-                lambda x: x.fillna(0),
-                _transfer_str_to_float,
-                _add_oa,
-                _add_ol,
-                _add_noa)
-    # _iterate_by_code,
-    # lambda x: (_calc_amount(security, oa_subjects) for security in x))
-    t = [d for d in test]
-    a = 2
+    columns = ('ts_code', 'end_date', 'comp_type', *OA_SUBJECTS, *OL_SUBJECTS)
+    noa = _calc_noa(rdb.load_ts_statement('balancesheet', columns))
+    index = pipe(rdb.load_ts_statement('income', ('ts_code', 'end_date', 'revenue')),
+                 lambda x: _calc_delta_ato(noa, x),
+                 lambda x: _rank_in_industry(x, rdb.get_sw_industry(), load_security_master()))
+    rdb.save_operating_efficiency_to_db(index)
+    return len(index)
 
 
 if __name__ == "__main__":
-    _calc_and_save_delta_ato()
+    import time
+
+    start = time.perf_counter()
+    n = _calc_and_save_delta_ato()
+    print(f"计算并保存了{n}个公司的经营资产周转率: {time.perf_counter() - start:.3f}s")
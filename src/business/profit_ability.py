@@ -1,34 +1,31 @@
 """ 盈利能力指标
 """
 from typing import Callable, Tuple, List, Iterator, Optional, Dict
-from functools import partial, reduce
-from statistics import geometric_mean, mean, stdev, quantiles
-from itertools import tee
+from functools import partial
 
 from toolz import pipe, juxt, compose
+from sqlalchemy import exc
 import pandas as pd
+import numpy as np
 
 from src.stock_data import rim_db as rdb
+from src.stock_data.security_master import to_ts_code, to_ts_codes
 # from src.stock_data import crawl_tushare as cts
 
 
-def _convert_to_ts_code(code: str) -> str:
-    return code + '.SH' if code[0] == '6' else code + '.SZ'
-
-
 def calculate_yrs_roe(code: str,
-                      getter: Callable[[str], pd.DataFrame] = rdb.get_financial_indicator) -> Tuple[List[str], float]:
+                      getter: Callable[[str], pd.DataFrame] = rdb.load_roe) -> Tuple[List[str], float]:
     """ 返回上市公司ROE的最近若干年的几何平均数
     输入假设：
     code 是符合tushare规定的上市公司代码
-    getter 是返回tushare财务指标（Dataframe格式）的函数，其中有ts_code, roe, end_date column
+    getter 是以ts_code为参数、返回该公司tushare财务指标（Dataframe格式）的函数，index为end_date，其中有roe column
 
     输出规定：
     最近4~8年ROE的几何平均数，例如，(['2018', '2017', '2016', '2015', '2014', '2013'], 0.098)
     其中元组的第一项保存参与（几何平均）运算的年份-ROE序列，第二项是平均roe
     从最近的公布的年财务指标开始连续拿数据，最多8年数据，最少4年数据。若数据不足，直接返回None。
     """
-    roe_it = getter(code).loc[_convert_to_ts_code(code)]['roe'].sort_index().iteritems()
+    roe_it = getter(to_ts_code(code))['roe'].sort_index().items()
     roe_lst = [roe for roe in roe_it]
     # last_roe_it = takewhile(lambda x: not np.isnan(x[1]), reversed(roe_lst))
     # last_year_roe = [y_r for y_r in last_roe_it]
@@ -39,19 +36,19 @@ def calculate_yrs_roe(code: str,
 
 
 def calculate_yrs_profitability(code: str,
-                                getter: Callable[[str], pd.DataFrame] = rdb.get_financial_indicator) \
+                                getter: Callable[[str], pd.DataFrame] = rdb.load_roe) \
         -> Tuple[List[str], float]:
     """ 返回上市公司ROE的最近若干年的几何平均数
     输入假设：
     code 是符合tushare规定的上市公司代码
-    getter 是返回tushare财务指标（Dataframe格式）的函数，其中有ts_code, roe, end_date column
+    getter 是以ts_code为参数、返回该公司tushare财务指标（Dataframe格式）的函数，index为end_date，其中有roe column
 
     输出规定：
     最近4~8年ROE的几何平均数，例如，(['2018', '2017', '2016', '2015', '2014', '2013'], 0.098)
     其中元组的第一项保存参与（几何平均）运算的年份-ROE序列，第二项是平均roe
     从最近的公布的年财务指标开始连续拿数据，最多8年数据，最少4年数据。若数据不足，直接返回None。
     """
-    roe_it = getter(code).loc[_convert_to_ts_code(code)]['roe'].sort_index().iteritems()
+    roe_it = getter(to_ts_code(code))['roe'].sort_index().items()
     roe_lst = [roe for roe in roe_it]
     # last_roe_it = takewhile(lambda x: not np.isnan(x[1]), reversed(roe_lst))
     # last_year_roe = [y_r for y_r in last_roe_it]
@@ -176,7 +173,7 @@ def get_8yrs_mg_and_ms(code: str,
      'ms': 2.87, 'years_mg': [('2011', 0.421819), ('2012', 0.466875), ..., ('2018', 0.206218)]}
     """
     print(code)
-    result = pipe(getter(_convert_to_ts_code(code)),
+    result = pipe(getter(to_ts_code(code)),
                   _get_yrs_gm,
                   _get_last_9_years_fi,
                   _sort_years_fi,
@@ -200,120 +197,208 @@ def get_mm(code: str) -> Tuple[float, float]:
     mg_ms = [(code, get_8yrs_mg_and_ms(code)) for code in securities]
 
 
-def _filter_valid_mg_data(gm: pd.DataFrame) -> Iterator[pd.DataFrame]:
+def _filter_valid_mg_data(gm: pd.DataFrame) -> pd.DataFrame:
     """
     寻找‘合格的’毛利率数据
     所谓合格：1. 排除科创版公司；
              2. 从最近公布的财报开始，必须至少有连续6年的数据
 
     :param gm: pd.DataFrame
-        这个DF包括了多重索引ts_code/end_date和数据栏位grossprofit_margin
+        这个DF包括了多重索引ts_code/end_date和数据栏位grossprofit_margin，按ts_code、end_date排序
         已经排除了异常毛利率的数据，例如，数据为空，<=0%或>100%
 
-    :return: Iterator[pd.DataFrame]
-        迭代器中的元素的格式同gm，但仅包含一个公司的数据
+    :return: pd.DataFrame
+        格式同gm，但仅包含各个公司合格的数据
     """
+    df = gm[~gm.index.get_level_values('ts_code').str.startswith('688')].reset_index()   # 排除科创板上市公司
+    codes = df['ts_code']
+    years = df['end_date'].str[:4].astype(int)
+    same_code = codes.eq(codes.shift())
+
+    # 与上一行之间年份不连续，则开始一个新的片段；每个公司仅保留最后一个片段，即从最近年份开始连续的数据
+    segment = (~same_code | (years - years.shift() >= 2)).cumsum()
+    df = df[segment == segment.groupby(codes).transform('last')]
+    codes, years = df['ts_code'], years[df.index]
 
-    def remain_last_several_years(group):
-        """ 仅保留有连续正常毛利率的（年份）数据（从最近年份开始）"""
-        last_years = reduce(lambda x, y: y if int(x[:4]) - int(y[:4]) == 1 else x,
-                            reversed(group.index.get_level_values('end_date').values))
-        filter_mask = [False if end_date < last_years else True
-                       for end_date in reversed(group.index.get_level_values('end_date').values)]
-        return group[filter_mask]
+    # 保留的数据从连续片段中最早年份的最后一期财报开始
+    first_year = years.groupby(codes).transform('first')
+    first_end_date = df['end_date'].where(years == first_year).groupby(codes).transform('last')
+    df = df[df['end_date'] >= first_end_date]
 
-    return pipe(gm,
-                lambda x: x[[True if ts_code[:3] != '688' else False  # 排除科创板上市公司
-                             for ts_code in x.index.get_level_values('ts_code').values]],
-                lambda x: (group for name, group in x.groupby(level='ts_code')),  # 迭代每一个上市公司
-                lambda x: (remain_last_several_years(group) for group in x),  # 保留连续正常的数据
-                lambda x: (group for group in x if len(group) >= 6))  # 至少需要六年正常
+    return df[df.groupby('ts_code')['end_date'].transform('size') >= 6]\
+        .set_index(['ts_code', 'end_date'])      # 至少需要六年正常
 
 
-def _calc_mg_ms(gm_it: Iterator[pd.DataFrame]) -> Iterator[Tuple[str, float, float]]:
+def _calc_mg_ms(gm: pd.DataFrame) -> pd.DataFrame:
     """
     根据毛利率计算盈利能力成长性指标和盈利能力稳定性指标
     MG = (II(1 + ΔGM / GM)) ^ 1/T - 1，盈利能力成长性指标
     MS = Avg(GM) / SD(GM), 盈利能力稳定性指标
 
-    :param gm_it: 迭代器，其中元素是DataFrame，包含ts_code/end_date多重索引和grossprofit_margin栏位
+    :param gm: DataFrame，包含ts_code/end_date多重索引和grossprofit_margin栏位，按ts_code、end_date排序
+
+    :return: DataFrame，index为公司代码，栏位为mg和ms
+             毛利率为零或者毛利率没有波动的公司无法计算，不包含在结果中
+    """
+    if gm.empty:
+        return pd.DataFrame({'mg': [], 'ms': []}, index=pd.Index([], name='ts_code'))
+
+    codes = gm.index.get_level_values('ts_code').values
+    margin = gm['grossprofit_margin'].values.astype(float)
+    first = np.r_[True, codes[1:] != codes[:-1]]            # 每个公司的第一行
+    starts = np.flatnonzero(first)
+    counts = np.diff(np.r_[starts, len(margin)])
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        growth_rate = np.ones_like(margin)
+        growth_rate[1:] = 1 + (margin[1:] - margin[:-1]) / margin[:-1]
+        growth_rate[first] = 1
+        positive = (growth_rate > 0) & np.isfinite(growth_rate)
+        invalid = np.logical_or.reduceat(~positive, starts)
+        mg = np.exp(np.add.reduceat(np.log(np.where(positive, growth_rate, 1)), starts) / (counts - 1)) - 1
+
+        avg = np.add.reduceat(margin, starts) / counts
+        deviation = margin - np.repeat(avg, counts)
+        ms = avg / np.sqrt(np.add.reduceat(deviation * deviation, starts) / (counts - 1))
+
+    valid = ~invalid & (counts >= 2) & np.isfinite(ms)
+    return pd.DataFrame({'mg': mg[valid], 'ms': ms[valid]}, index=pd.Index(codes[starts][valid], name='ts_code'))
+
 
-    :return: 迭代器，每个元素中第一项是公司代码，第二项为MG，第三项为MS
+def _calc_quantiles(values: np.ndarray, n: int = 100) -> np.ndarray:
     """
+    计算分位表，算法同statistics.quantiles(values, n=n, method='exclusive')
 
-    def calc_ms_mg(group: pd.DataFrame) -> Tuple[float, float]:
-        """ 计算单个股票的盈利稳定性和几何平均毛利增长率"""
-        gm_lst = group['grossprofit_margin'].tolist()
-        growth_rate = [(1 + (gm_lst[i + 1] - gm_lst[i]) / gm_lst[i])
-                       for i in range(len(gm_lst) - 1)]
-        return geometric_mean(growth_rate) - 1, mean(gm_lst) / stdev(gm_lst)
+    :param values: 一维数组，至少两个元素
+    :param n: 分成多少份
 
-    return ((group.index.get_level_values('ts_code').values[0], *calc_ms_mg(group)) for group in gm_it)
+    :return: 长度n-1的数组，升序
+    """
+    data = np.sort(np.asarray(values, dtype=float))
+    ld = len(data)
+    assert ld >= 2
+    i = np.arange(1, n)
+    j = np.clip(i * (ld + 1) // n, 1, ld - 1)
+    delta = i * (ld + 1) - j * n
+    return (data[j - 1] * (n - delta) + data[j] * delta) / n
+
+
+def rank_percentile(values, quantile_table: np.ndarray):
+    """
+    计算数值在分位表中的百分排位，即分位表中小于此数值的最大分位点的序号，不大于第一个分位点则为0
+    分位表已经排序，所以每个数值的复杂度为O(log n)
+
+    :param values: 数值或者数组
+    :param quantile_table: _calc_quantiles返回的分位表
+    :return: 百分排位，类型同values
+
+    Examples:
+    --------
+    >>> rank_percentile(np.array([0.5, 1.5, 2.5, 3.5]), np.array([1.0, 2.0, 3.0]))
+    array([0, 0, 1, 2])
+    """
+    return np.maximum(np.searchsorted(quantile_table, values, side='left') - 1, 0)
 
 
-def _calc_ms_mg_quantiles(mg_ms_it: Iterator[Tuple[str, float, float]], n=100) -> [Tuple[List[float], List[float]]]:
+def _calc_ms_mg_quantiles(mg_ms: pd.DataFrame, n=100) -> pd.DataFrame:
     """
     根据输入的全市场盈利能力成长性指标和盈利能力稳定性指标，计算并返回分位表
 
-    :param mg_ms_it: 迭代器，每个元素中第一项是公司代码，第二项为MG，第三项为MS
+    :param mg_ms: DataFrame，index为公司代码，栏位为mg和ms
 
-    :return: 元组，第一项为盈利能力成长性指标的分位表，长度n+1;
-                    第二项为盈利能力稳定性指标的分位表，长度n+1;
-                    第三项是输入参数的拷贝
+    :return: DataFrame，index为分位点的序号（0 ~ n-2），栏位mg为盈利能力成长性指标的分位表，ms为盈利能力稳定性指标的分位表
     """
-    it1, it2, it3 = tee(mg_ms_it, 3)
-    return quantiles([value[1] for value in it1], n=n), \
-           quantiles([value[2] for value in it2], n=n), \
-           it3
+    return pd.DataFrame({'mg': _calc_quantiles(mg_ms['mg'].values, n),
+                         'ms': _calc_quantiles(mg_ms['ms'].values, n)},
+                        index=pd.Index(range(n - 1), name='percentile'))
 
 
-def _calc_ms_mg_ranks(data: Tuple[Tuple[List[float], List[float], Iterator[Tuple[str, float, float]]]]) \
-        -> List[Tuple[str, float, int, float, int]]:
+def _calc_ms_mg_ranks(mg_ms: pd.DataFrame, quantile_table: pd.DataFrame) -> pd.DataFrame:
     """
     计算各个公司的MG和MS百分排位
 
-    :param data: 元组
-        每个元素的第一项保存MG的百分分位表；
-        每个元素的第二项保存MS的百分分位表
-        每个元素的第二项是迭代器，保存各个公司的（代码, mg, ms)
-    :return: 列表，每个元素都是列表，其中第一项是公司代码、MG、MG rank、MS、and MS rank
+    :param mg_ms: DataFrame，index为公司代码，栏位为mg和ms
+    :param quantile_table: _calc_ms_mg_quantiles返回的分位表
+
+    :return: DataFrame，index为公司代码，栏位依次为MG、MG rank、MS、and MS rank
+    """
+    assert len(quantile_table) == 99
+    return pd.DataFrame({'mg': mg_ms['mg'],
+                         'mg_rank': rank_percentile(mg_ms['mg'].values, quantile_table['mg'].values),
+                         'ms': mg_ms['ms'],
+                         'ms_rank': rank_percentile(mg_ms['ms'].values, quantile_table['ms'].values)},
+                        index=mg_ms.index)
+
+
+def calc_and_save_maximum_margin() -> int:
+    """
+    计算并保存毛利成长性和稳定性，以及全市场的分位表
+
+    :return: 保存了多少个公司的指标
+
+    Notes:
+    This is a impure function.
+    --------
     """
-    mg_percentiles = data[0]
-    ms_percentiles = data[1]
-    assert len(ms_percentiles) == 99 and len(mg_percentiles) == 99
-
-    rtn: List[Tuple] = []
-    for code, mg, ms in data[2]:
-        mg_rank = 0
-        ms_rank = 0
-        for i in reversed(range(99)):
-            if mg > mg_percentiles[i] and mg_rank == 0:
-                mg_rank = i
-            if ms > ms_percentiles[i] and ms_rank == 0:
-                ms_rank = i
-            if ms_rank != 0 and mg_rank != 0:
-                break
-        rtn.append((code, mg, mg_rank, ms, ms_rank))
-
-    return rtn
-
-
-def calc_and_save_maximum_margin() -> None:
+    watermark = rdb.get_financial_indicator_watermark()
+    mg_ms = pipe(rdb.load_financial_indicator(),
+                 _filter_valid_mg_data,
+                 _calc_mg_ms)
+    quantile_table = _calc_ms_mg_quantiles(mg_ms)
+    rdb.save_profitability_index_to_db(_calc_ms_mg_ranks(mg_ms, quantile_table), quantile_table, watermark)
+    return len(mg_ms)
+
+
+def update_maximum_margin() -> int:
     """
-    计算并保存毛利成长性和稳定性
+    增量计算并保存毛利成长性和稳定性
+    仅重新计算上次计算之后有新财务指标的公司，然后根据全市场的MG、MS重新计算分位表和各个公司的百分排位
+    若从未计算过，或者财务指标表被重建、迁移或删除过记录（见rim_db.is_appended_since），则全量计算
 
-    :return: None
+    :return: 重新计算了多少个公司，全量计算时为全市场的公司数
 
     Notes:
     This is a impure function.
     --------
     """
-    return pipe(rdb.get_financial_indicator(),
-                _filter_valid_mg_data,
-                _calc_mg_ms,
-                _calc_ms_mg_quantiles,
-                _calc_ms_mg_ranks,
-                rdb.save_profitability_index_to_db)
+    previous = rdb.read_profitability_watermark()
+    watermark = rdb.get_financial_indicator_watermark()
+    if previous is None or not rdb.is_appended_since(previous, watermark):
+        return calc_and_save_maximum_margin()
+    changed_codes = rdb.get_financial_indicator_changed_codes(previous.rowid)
+    if len(changed_codes) == 0:
+        return 0
+
+    changed_mg_ms = pipe(rdb.get_financial_indicator_of(changed_codes),
+                         _filter_valid_mg_data,
+                         _calc_mg_ms)
+    saved = rdb.load_profitability_index()[['mg', 'ms']]
+    mg_ms = pd.concat([saved[~saved.index.isin(changed_codes)], changed_mg_ms]).sort_index()
+    quantile_table = _calc_ms_mg_quantiles(mg_ms)
+    rdb.save_profitability_index_to_db(_calc_ms_mg_ranks(mg_ms, quantile_table), quantile_table, watermark)
+    return len(changed_codes)
+
+
+def _calc_mg_ms_by_code(ts_code: str) -> Optional[Tuple[float, int, float, int]]:
+    """
+    根据最新的财务指标计算某个公司的MG和MS，并在已保存的全市场分位表中排位，用于最近一次全市场计算之后才有数据的公司
+
+    :param ts_code: 符合tushare要求的上市公司代码
+    :return: 元组，分别为mg, mg rank, ms, ms rank；若数据不足，返回None
+    """
+    gm = rdb.get_financial_indicator().select([ts_code])
+    if gm.empty:
+        return None
+    mg_ms = pipe(gm, _filter_valid_mg_data, _calc_mg_ms)
+    if mg_ms.empty:
+        return None
+    try:
+        quantile_table = rdb.read_profitability_quantiles()
+    except (exc.OperationalError, pd.io.sql.DatabaseError):
+        return None         # 还没有计算过全市场的分位表，无法给出百分位
+    mg, ms = mg_ms['mg'].iloc[0], mg_ms['ms'].iloc[0]
+    return mg, int(rank_percentile(mg, quantile_table['mg'].values)), \
+        ms, int(rank_percentile(ms, quantile_table['ms'].values))
 
 
 def get_mg_ms(code: str) -> Optional[Dict]:
@@ -323,21 +408,45 @@ def get_mg_ms(code: str) -> Optional[Dict]:
     MM = MAX(ms_rank, mg_rank)
     :param code: 符合6位数公司代码
     :return: 元组，分别为mm, mg, mg rank, ms, ms rank
-    Note: 如果输入值code没能找到对应的盈利能力指标，返回None，代表数据库中数据不足。
+    Note: 如果数据库中没有此公司的盈利能力指标，则根据其最新的财务指标计算，并在全市场分位表中排位；
+          若仍然无法计算（包括还没有计算过全市场的指标和分位表），返回None，代表数据库中数据不足。
     """
     try:
-        indicator = rdb.read_profitability_index().loc[_convert_to_ts_code(code)]
-        mg_rank = int(indicator.loc['mg_rank'])
-        ms_rank = int(indicator.loc['ms_rank'])
-        maximum_margin = max(mg_rank, ms_rank)
-        return {'code': code,
-                'mm': maximum_margin,
-                'mg': indicator.loc['mg'],
-                'mg_rank': mg_rank,
-                'ms': indicator.loc['ms'],
-                'ms_rank': ms_rank}
-    except KeyError:
-        return None
+        indicator = rdb.read_profitability_index().loc[to_ts_code(code)]
+        mg, mg_rank, ms, ms_rank = indicator.loc['mg'], int(indicator.loc['mg_rank']), \
+            indicator.loc['ms'], int(indicator.loc['ms_rank'])
+    except (KeyError, exc.OperationalError, pd.io.sql.DatabaseError):
+        calculated = _calc_mg_ms_by_code(to_ts_code(code))
+        if calculated is None:
+            return None
+        mg, mg_rank, ms, ms_rank = calculated
+    return {'code': code,
+            'mm': max(mg_rank, ms_rank),
+            'mg': mg,
+            'mg_rank': mg_rank,
+            'ms': ms,
+            'ms_rank': ms_rank}
+
+
+def get_mg_ms_by_codes(codes: List[str]) -> List[Optional[Dict]]:
+    """
+    批量版本的get_mg_ms：一次向量化的reindex取出全部公司的指标，数据库中没有指标的公司再逐个计算
+
+    :param codes: 6位数公司代码列表，可以重复
+    :return: 与codes一一对应的列表，元素同get_mg_ms的返回值
+    """
+    indicator = rdb.read_profitability_index()[['mg', 'mg_rank', 'ms', 'ms_rank']].reindex(to_ts_codes(codes))
+    calculated: Dict[str, Optional[Dict]] = {}
+    results = []
+    for code, (mg, mg_rank, ms, ms_rank) in zip(codes, indicator.itertuples(index=False, name=None)):
+        if np.isnan(mg_rank):           # 数据库中没有此公司的指标，同一个公司只计算一次
+            if code not in calculated:
+                calculated[code] = get_mg_ms(code)
+            results.append(calculated[code])
+        else:
+            results.append({'code': code, 'mm': max(int(mg_rank), int(ms_rank)),
+                            'mg': mg, 'mg_rank': int(mg_rank), 'ms': ms, 'ms_rank': int(ms_rank)})
+    return results
 
 
 if __name__ == "__main__":
@@ -1,86 +1,165 @@
 from typing import Callable, List, Tuple, Iterator, Dict, Optional
-import datetime
 from itertools import product
 
 import pandas as pd
+import numpy as np
 
 from src.stock_data import rim_db as rdb
+from src.stock_data.security_master import load_security_master, take, to_ts_code
 
 
 def get_profit_forecast(code: str,
-                        getter: Callable[[str], pd.DataFrame] = rdb.get_profit_forecast):
+                        getter: Callable[[], pd.DataFrame] = rdb.get_profit_forecast):
     """ 获取分析师的盈利预期
     """
-    today = datetime.datetime.now().strftime('%Y-%m-%d')
-    return getter(today).loc[code].to_dict()
+    return getter().loc[code].to_dict()
 
 
-def _convert_to_ts_code(code: str) -> str:
-    return code + '.SH' if code[0] == '6' else code + '.SZ'
+def get_indicator2018(code: str,
+                      getter: Callable[[], pd.DataFrame] = rdb.get_indicator2018) -> dict:
+    return getter().loc[to_ts_code(code)].to_dict()
 
 
-def get_indicator2018(code: str,
-                      getter: Callable[[str], pd.DataFrame] = rdb.get_indicator2018) -> dict:
-    today = datetime.datetime.now().strftime('%Y-%m-%d')
-    ts_code = _convert_to_ts_code(code)
-    return getter(today).loc[ts_code].to_dict()
+RR_LST: List[float] = [0.08, 0.09, 0.10, 0.11, 0.12]      # 必要投资报酬率 / 折现率
+GR_LST: List[float] = [0.0, 0.02, 0.04]                    # 持续期的剩余收益增长率
+FORECAST_YEARS: List[str] = ['2019', '2020', '2021']
+DISCOUNT_EXPONENTS: List[float] = [0, 0.85, 1.85, 1.85]    # 2019、2020、2021年剩余收益和持续期剩余收益的折现期数
+RIM_FIELDS: List[str] = ['value', 'discounted_re2019', 'discounted_re2020', 'discounted_re2021', 'discounted_cv']
 
 
-def calculate_rim_value(code: str) -> dict:
-    def cal_re(bps_0: float, forecast_eps: List[float], rr: float) -> List[float]:
-        # 计算各期的剩余收益
-        re_lst: List[float] = []
-        bps: float = bps_0
-        for eps in forecast_eps:
-            re_lst.append(eps - rr * bps)
-            bps = bps + eps
-        return re_lst
-
-    def discounted(amount_lst: List[float], discount_exponents: List[float], rr) -> List[float]:
-        """ 计算各期金额的折现值
-        """
-        assert len(amount_lst) == len(discount_exponents)
-        return [amount_lst[i] / (1+rr) ** discount_exponents[i] for i in range(len(amount_lst))]
-
-    def cal_cv(re: float, rr: float, gr: float) -> float:
-        """ 计算第t期后持续期的剩余收益"""
-        assert rr > gr
-        return re * (1 + gr) / (rr - gr)
-
-    def cal_rim_value(rr: float, gr: float):
-        re = cal_re(indicator2018['bps'], [profit_forecast['eps_2019'],
-                                           profit_forecast['eps_2020'],
-                                           profit_forecast['eps_2021']], rr)
-        cv = cal_cv(re[2], rr, gr)
-        re.append(cv)
-        discounted_re = discounted(re, [0, 0.85, 1.85, 1.85], rr)
-        value = indicator2018['bps'] + sum(discounted_re)
-        return {
-            'rr': rr,
-            'gr': gr,
-            'value': value,
-            'discounted_re2019': discounted_re[0],
-            'discounted_re2020': discounted_re[1],
-            'discounted_re2021': discounted_re[2],
-            'discounted_cv': discounted_re[3],
-        }
+def calculate_rim_values(bps: np.ndarray,
+                         forecast_eps: np.ndarray,
+                         rr_lst: List[float] = RR_LST,
+                         gr_lst: List[float] = GR_LST) -> Dict[str, np.ndarray]:
+    """
+    一次性计算多个公司在所有(rr, gr)假设下的剩余收益估值
+
+    :param bps: 一维数组，长度n，各公司的基期（2018年）每股净资产
+    :param forecast_eps: 二维数组，形状(n, 3)，各公司2019、2020、2021年的预测每股收益
+    :param rr_lst: 必要投资报酬率列表，长度R
+    :param gr_lst: 持续期的剩余收益增长率列表，长度G，每个gr都必须小于所有的rr
+
+    :return: dict，键为RIM_FIELDS，值为形状(n, R, G)的数组
+    Note: 运算顺序同逐个公司的计算保持一致，因此与单个公司的计算结果完全相同
+    """
+    bps = np.asarray(bps, dtype=np.float64)
+    forecast_eps = np.asarray(forecast_eps, dtype=np.float64)
+    assert forecast_eps.ndim == 2 and forecast_eps.shape == (len(bps), len(FORECAST_YEARS))
+    assert min(rr_lst) > max(gr_lst)
+
+    rr = np.asarray(rr_lst, dtype=np.float64)
+    gr = np.asarray(gr_lst, dtype=np.float64)
+    # 折现系数表很小，用Python的浮点幂运算，保证与逐个计算的结果一致
+    discount = np.array([[(1 + r) ** e for e in DISCOUNT_EXPONENTS] for r in rr_lst])     # (R, 4)
+
+    # 各期期初的每股净资产，形状(n, 3)
+    book = np.empty_like(forecast_eps)
+    book[:, 0] = bps
+    for t in range(1, forecast_eps.shape[1]):
+        book[:, t] = book[:, t - 1] + forecast_eps[:, t - 1]
+
+    re = forecast_eps[:, np.newaxis, :] - rr[np.newaxis, :, np.newaxis] * book[:, np.newaxis, :]   # (n, R, 3)
+    cv = re[:, :, 2, np.newaxis] * (1 + gr) / (rr[:, np.newaxis] - gr)                            # (n, R, G)
+
+    discounted_re = re / discount[np.newaxis, :, :3]                                               # (n, R, 3)
+    discounted_cv = cv / discount[np.newaxis, :, 3, np.newaxis]                                    # (n, R, G)
+    shape = discounted_cv.shape
+
+    discounted_re2019 = np.broadcast_to(discounted_re[:, :, 0, np.newaxis], shape)
+    discounted_re2020 = np.broadcast_to(discounted_re[:, :, 1, np.newaxis], shape)
+    discounted_re2021 = np.broadcast_to(discounted_re[:, :, 2, np.newaxis], shape)
+    value = bps[:, np.newaxis, np.newaxis] \
+        + (discounted_re2019 + discounted_re2020 + discounted_re2021 + discounted_cv)
+
+    return {'value': value,
+            'discounted_re2019': discounted_re2019,
+            'discounted_re2020': discounted_re2020,
+            'discounted_re2021': discounted_re2021,
+            'discounted_cv': discounted_cv}
+
+
+# 估值特征表的栏位，前6个栏位同rim.RimProposal
+FEATURE_COLUMNS: List[str] = ['bps_2018', 'eps_2018', *[f"eps_{y}" for y in FORECAST_YEARS],
+                              'sw_l2', 'industry_name', 'industry_roe', 'market_cap']
+
+
+def build_valuation_features() -> pd.DataFrame:
+    """
+    构建全市场的估值特征表：每个公司一行，关联2018年每股净资产和每股收益、2019~2021年的预测每股收益、
+    申万二级行业代码、名称和行业净资产收益率以及市值；各数据集按security_id关联
+
+    :return: index为6位数公司代码的DataFrame，栏位为FEATURE_COLUMNS，按security_id排序；
+             只包含既有2018年财务指标又有盈利预测的公司，其余栏位缺失时为空值
+    """
+    master = load_security_master()
+    indicator = master.index_by_id(rdb.get_indicator2018()[['bps', 'eps']]
+                                   .rename(columns={'bps': 'bps_2018', 'eps': 'eps_2018'}))
+    forecast = master.index_by_id(rdb.get_profit_forecast()[[f"eps_{y}" for y in FORECAST_YEARS]])
+    df = indicator.join(forecast, how='inner')
+    ids = df.index.values
+
+    sw_l2 = take(master.index_by_id(rdb.get_sw_industry()), ids)['sw_l2'].values
+    industry_roe = rdb.get_sw_industry_roe().reindex(sw_l2)
+    df = df.assign(sw_l2=sw_l2,
+                   industry_name=industry_roe['industry_name'].values,
+                   industry_roe=industry_roe['industry_roe'].values,
+                   market_cap=take(master.index_by_id(rdb.get_market_value()), ids)['market_cap'].values)
+    return df[FEATURE_COLUMNS].set_axis(pd.Index(master.codes[ids].astype(object), name='code'), axis=0)
+
+
+def calculate_market_rim_values(inputs: pd.DataFrame,
+                                rr_lst: List[float] = RR_LST,
+                                gr_lst: List[float] = GR_LST) -> pd.DataFrame:
+    """
+    计算全市场所有公司在所有(rr, gr)假设下的剩余收益估值
+
+    :param inputs: build_valuation_features返回的DataFrame
+    :param rr_lst: 必要投资报酬率列表
+    :param gr_lst: 持续期的剩余收益增长率列表
 
+    :return: 多重索引为code/rr/gr的DataFrame，栏位为RIM_FIELDS
+    """
+    values = calculate_rim_values(inputs['bps_2018'].values,
+                                  inputs[[f"eps_{y}" for y in FORECAST_YEARS]].values,
+                                  rr_lst, gr_lst)
+    index = pd.MultiIndex.from_product([inputs.index, rr_lst, gr_lst], names=['code', 'rr', 'gr'])
+    return pd.DataFrame({field: values[field].reshape(-1) for field in RIM_FIELDS}, index=index)
+
+
+def calculate_rim_value(code: str) -> dict:
     profit_forecast = get_profit_forecast(code)
     indicator2018 = get_indicator2018(code)
 
-    rr_lst: List[float] = [0.08, 0.09, 0.10, 0.11, 0.12]
-    gr_lst: List[float] = [0.0, 0.02, 0.04]
-    rr_gr_lst = product(rr_lst, gr_lst)
-    rim_values = [cal_rim_value(rr, gr)for rr, gr in rr_gr_lst]
+    values = calculate_rim_values(np.array([indicator2018['bps']]),
+                                  np.array([[profit_forecast[f"eps_{y}"] for y in FORECAST_YEARS]]))
+    rim_values = [dict(rr=rr, gr=gr, **{field: float(values[field][0, i, j]) for field in RIM_FIELDS})
+                  for (i, rr), (j, gr) in product(enumerate(RR_LST), enumerate(GR_LST))]
 
     return {
         'bps2018': indicator2018['bps'],
         're': rim_values,
-        'rr': rr_lst,
-        'gr': gr_lst
+        'rr': RR_LST,
+        'gr': GR_LST
     }
 
 
+def calc_and_save_rim_values() -> str:
+    """
+    每次数据更新之后，构建并保存全市场的估值特征表，计算并保存剩余收益估值
+
+    :return: 本次计算所依据的数据版本
+
+    Notes:
+    This is a impure function.
+    --------
+    """
+    data_version = rdb.get_data_version()
+    features = build_valuation_features()
+    values = calculate_market_rim_values(features).join(features['bps_2018'].rename('bps2018'), on='code')
+    rdb.save_rim_value_to_db(values, features, data_version)
+    return data_version
+
+
 def _is_valid_code(code: str) -> bool:
     assert len(code) == 6
     assert code.isdigit()
@@ -89,4 +168,14 @@ def _is_valid_code(code: str) -> bool:
 
 
 if __name__ == "__main__":
-    pass
+    import time
+
+    codes = build_valuation_features().index
+    start = time.perf_counter()
+    for c in codes:
+        calculate_rim_value(c)
+    print(f"逐个公司计算{len(codes)}个公司: {time.perf_counter() - start:.3f}s")
+
+    start = time.perf_counter()
+    version = calc_and_save_rim_values()
+    print(f"全市场批量计算并保存(数据版本{version}): {time.perf_counter() - start:.3f}s")
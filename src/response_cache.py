@@ -0,0 +1,136 @@
+""" 以数据版本为ETag的响应缓存
+
+API的数据只有在爬虫或计算任务写入数据库之后才会变化，但每个请求都要重新计算、经过pydantic模型校验并序列化。
+ResponseCacheMiddleware是一个ASGI中间件，对GET请求：
+1. 以当前的数据版本（各数据库版本的摘要，见engines.get_db_version）作为响应的ETag，
+   请求的If-None-Match与之相同时直接返回304，不再计算；
+2. 以(路径, 查询字符串, 数据版本)为键，把序列化之后的响应保存在有界的LRU中，重复的请求直接返回保存的响应。
+数据版本变化后，旧版本的ETag和缓存项自然失效，旧的缓存项随后被LRU淘汰。
+自行处理ETag或内容协商的接口（响应已带有ETag或Vary，例如 /securities）不经过缓存，保留其自己的响应头。
+
+只有当内存中的数据集都已是当前版本时（见versioned_cache.refresh_all）才使用ETag和缓存，
+以免把重新加载期间用旧数据计算的响应标记为新版本；数据版本至多每check_interval秒检查一次。
+"""
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from src.stock_data import engines
+from src.stock_data.versioned_cache import refresh_all
+
+# 数据版本所包含的数据库：crawl.db是爬虫的任务队列，频繁写入，但API不读取
+VERSIONED_DATABASES = tuple(db for db in engines.DATABASES if db != 'crawl')
+
+# 不缓存的路径：/health 报告的是预热进度，不是数据
+EXCLUDED_PATHS = ('/health', '/docs', '/redoc', '/openapi.json')
+
+
+def get_data_version() -> Dict[str, str]:
+    """ 各数据库的版本，数据库文件不存在时为''
+    """
+    versions = {}
+    for db in VERSIONED_DATABASES:
+        try:
+            versions[db] = engines.get_db_version(db)
+        except ValueError:
+            versions[db] = ''
+    return versions
+
+
+def _matches(if_none_match: str, etag: str) -> bool:
+    """ If-None-Match是否包含etag，按弱比较：忽略W/前缀
+    """
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return any((tag[2:] if tag.startswith('W/') else tag) == etag for tag in tags)
+
+
+class ResponseCacheMiddleware:
+    """
+    :param app: ASGI应用
+    :param maxsize: 至多缓存多少个响应
+    :param max_bytes: 缓存的响应体至多共占多少字节，超过max_bytes / 4的单个响应不缓存
+    :param check_interval: 至多每隔多少秒检查一次数据版本
+    :param excluded_paths: 不缓存、也不加ETag的路径
+    """
+
+    def __init__(self, app, maxsize: int = 1024, max_bytes: int = 64 * 2 ** 20, check_interval: float = 1.0,
+                 excluded_paths: Iterable[str] = EXCLUDED_PATHS):
+        self.app = app
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.check_interval = check_interval
+        self.excluded_paths = frozenset(excluded_paths)
+        self.entries: OrderedDict = OrderedDict()     # (路径, 查询字符串, 数据版本) -> (headers, body)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._etag: Optional[str] = None
+        self._next_check = 0.0
+
+    def etag(self) -> Optional[str]:
+        """ 当前数据版本的ETag；内存中还有过期或正在重新加载的数据集时为None
+        """
+        now = time.monotonic()
+        if now >= self._next_check:
+            versions = get_data_version()
+            digest = hashlib.sha1(repr(sorted(versions.items())).encode()).hexdigest()[:20]
+            self._etag = f'"{digest}"' if refresh_all(versions) else None
+            self._next_check = now + self.check_interval
+        return self._etag
+
+    def _store(self, key: Tuple, headers: List, body: bytes) -> None:
+        if len(body) > self.max_bytes // 4:
+            return
+        if key in self.entries:
+            self.size -= len(self.entries.pop(key)[1])
+        self.entries[key] = (headers, body)
+        self.size += len(body)
+        while len(self.entries) > self.maxsize or self.size > self.max_bytes:
+            self.size -= len(self.entries.popitem(last=False)[1][1])
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['method'] != 'GET' or scope['path'] in self.excluded_paths:
+            await self.app(scope, receive, send)
+            return
+        etag = self.etag()
+        if etag is None:
+            await self.app(scope, receive, send)
+            return
+
+        validators = [(b'etag', etag.encode()), (b'cache-control', b'no-cache')]
+        request_headers = dict(scope['headers'])
+        if _matches(request_headers.get(b'if-none-match', b'').decode('latin-1'), etag):
+            await send({'type': 'http.response.start', 'status': 304, 'headers': validators})
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+
+        key = (scope['path'], scope['query_string'], etag)
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            await send({'type': 'http.response.start', 'status': 200, 'headers': entry[0]})
+            await send({'type': 'http.response.body', 'body': entry[1]})
+            return
+
+        self.misses += 1
+        start, chunks = {}, []
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                start.update(message)
+                names = {name.lower() for name, _ in message.get('headers', [])}
+                if b'etag' in names or b'vary' in names:
+                    start['status'] = None          # 缓存的键中不含请求头，不能缓存
+                elif message['status'] == 200:
+                    message = dict(message, headers=list(message.get('headers', [])) + validators)
+                    start['headers'] = message['headers']
+            elif message['type'] == 'http.response.body' and start.get('status') == 200:
+                chunks.append(message.get('body', b''))
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+        # 计算期间数据版本发生了变化时，不能确定响应是哪个版本的数据
+        if start.get('status') == 200 and self.etag() == etag:
+            self._store(key, start['headers'], b''.join(chunks))
@@ -0,0 +1,205 @@
+""" 全市场选股
+
+在aqi_db.get_screener_table（每个公司一行，关联了估值特征、剩余收益估值、盈利能力指标、市值和公司信息）上，
+把筛选条件和排序键作为向量化的掩码和lexsort计算，只有当前页的行才转换为JSON。
+
+筛选条件是受限的Python表达式，只允许栏位名、数字、字符串、四则运算、比较、and/or/not以及 in [...]，例如：
+    value_to_price > 1.3 and mm >= 80 and not is_financial
+    rim_value / bps_2018 > 1.5 and industry_1 in ['医药', '消费']
+四则运算只能用于数值栏位和数字，文本栏位只能参与比较和 in [...]。
+栏位的空值参与比较的结果为False。排序键为栏位名，前缀'-'代表降序，空值总是排在最后。
+
+用法：
+    python -m src.screener          # 基准测试：在模拟的全市场数据上筛选、排序和分页
+"""
+import ast
+from functools import lru_cache
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+
+
+class ExpressionError(ValueError):
+    """ 筛选条件或排序键不合法
+    """
+
+
+_BINARY_OPS = {ast.Add: np.add, ast.Sub: np.subtract, ast.Mult: np.multiply, ast.Div: np.true_divide}
+_COMPARE_OPS = {ast.Gt: np.greater, ast.GtE: np.greater_equal, ast.Lt: np.less, ast.LtE: np.less_equal,
+                ast.Eq: np.equal, ast.NotEq: np.not_equal}
+_ALLOWED_NODES = (ast.Expression, ast.BoolOp, ast.BinOp, ast.UnaryOp, ast.Compare, ast.Name, ast.Load,
+                  ast.Constant, ast.List, ast.Tuple, ast.And, ast.Or, ast.Not, ast.USub, ast.In, ast.NotIn,
+                  *_BINARY_OPS, *_COMPARE_OPS)
+
+
+@lru_cache(maxsize=256)
+def compile_expression(expression: str) -> ast.Expression:
+    """
+    解析并检查筛选条件
+
+    :param expression: 筛选条件
+    :return: 语法树；含有不允许的语法时抛出ExpressionError
+    """
+    try:
+        tree = ast.parse(expression, mode='eval')
+    except SyntaxError as e:
+        raise ExpressionError(f"invalid expression {expression!r}: {e.msg}")
+    for node in ast.walk(tree):
+        if not isinstance(node, _ALLOWED_NODES):
+            raise ExpressionError(f"{type(node).__name__} is not allowed in {expression!r}")
+    return tree
+
+
+def _evaluate(node: ast.AST, table: pd.DataFrame):
+    if isinstance(node, ast.Expression):
+        return _evaluate(node.body, table)
+    if isinstance(node, ast.Name):
+        if node.id not in table.columns:
+            raise ExpressionError(f"unknown column {node.id!r}")
+        return table[node.id].to_numpy()
+    if isinstance(node, ast.Constant):
+        return node.value
+    if isinstance(node, (ast.List, ast.Tuple)):
+        return [_evaluate(element, table) for element in node.elts]
+    if isinstance(node, ast.BinOp):
+        return _arithmetic(_BINARY_OPS[type(node.op)], _evaluate(node.left, table), _evaluate(node.right, table))
+    if isinstance(node, ast.UnaryOp):
+        operand = _evaluate(node.operand, table)
+        return _arithmetic(np.negative, operand) if isinstance(node.op, ast.USub) \
+            else np.logical_not(_as_mask(operand))
+    if isinstance(node, ast.BoolOp):
+        masks = [_as_mask(_evaluate(value, table)) for value in node.values]
+        return np.logical_and.reduce(masks) if isinstance(node.op, ast.And) else np.logical_or.reduce(masks)
+    if isinstance(node, ast.Compare):
+        left, masks = _evaluate(node.left, table), []
+        for op, comparator in zip(node.ops, node.comparators):
+            right = _evaluate(comparator, table)
+            if isinstance(op, (ast.In, ast.NotIn)):
+                if not isinstance(right, list):
+                    raise ExpressionError("'in' must be followed by a list")
+                mask = pd.Series(left).isin(right).values
+                masks.append(mask if isinstance(op, ast.In) else ~mask)
+            else:
+                masks.append(_compare(_COMPARE_OPS[type(op)], left, right))
+            left = right
+        return np.logical_and.reduce(masks)
+    raise ExpressionError(f"{type(node).__name__} is not allowed")
+
+
+def _is_numeric(value) -> bool:
+    if isinstance(value, np.ndarray):
+        return value.dtype.kind in 'biuf'
+    return isinstance(value, (int, float))
+
+
+def _arithmetic(op, *operands):
+    """ 四则运算和取负，操作数必须是数值栏位或数字
+    """
+    if not all(_is_numeric(operand) for operand in operands):
+        raise ExpressionError("arithmetic is only allowed on numeric columns and numbers")
+    try:
+        return op(*operands)
+    except TypeError as e:
+        raise ExpressionError(str(e))
+
+
+def _compare(op, left, right) -> np.ndarray:
+    """ 逐行比较，任意一边为空值时结果为False
+    """
+    arrays = [x for x in (left, right) if isinstance(x, np.ndarray)]
+    valid = np.logical_and.reduce([pd.notna(x) for x in arrays])
+    if any(x.dtype.kind == 'O' for x in arrays):
+        # 文本栏位：空值先替换为''，以免None参与比较
+        left, right = (np.where(pd.notna(x), x, '') if isinstance(x, np.ndarray) else x for x in (left, right))
+    try:
+        return valid & np.asarray(op(left, right), dtype=bool)
+    except TypeError as e:
+        raise ExpressionError(str(e))
+
+
+def _as_mask(value) -> np.ndarray:
+    value = np.asarray(value)
+    if value.dtype.kind != 'b':
+        raise ExpressionError("filter must evaluate to a boolean")
+    return value
+
+
+def filter_mask(table: pd.DataFrame, filters: List[str]) -> np.ndarray:
+    """
+    :param table: 选股表
+    :param filters: 筛选条件，同时满足
+    :return: 布尔数组，与table的行一一对应
+    """
+    mask = np.ones(len(table), dtype=bool)
+    with np.errstate(all='ignore'):
+        for expression in filters:
+            result = _as_mask(_evaluate(compile_expression(expression), table))
+            if result.shape != mask.shape:
+                raise ExpressionError(f"{expression!r} does not depend on any column")
+            mask &= result
+    return mask
+
+
+def _sort_key(values: np.ndarray, descending: bool) -> np.ndarray:
+    """ lexsort的排序键，空值总是排在最后
+    """
+    if values.dtype.kind in 'biuf':
+        key = values.astype(np.float64)
+        return -key if descending else key           # NaN在np.lexsort中排在最后，取负之后仍为NaN
+    codes, _ = pd.factorize(values, sort=True)
+    codes = codes.astype(np.float64)
+    codes[codes < 0] = np.nan
+    return -codes if descending else codes
+
+
+def screen(table: pd.DataFrame, filters: List[str], sort: List[str], page: int = 1, page_size: int = 50,
+           columns: Optional[List[str]] = None) -> dict:
+    """
+    筛选、排序和分页
+
+    :param table: 选股表，见aqi_db.get_screener_table
+    :param filters: 筛选条件，同时满足
+    :param sort: 排序键，栏位名，前缀'-'代表降序；为空时按security_id排序
+    :param page: 页码，从1开始；超过最后一页时items为空
+    :param page_size: 每页的行数
+    :param columns: 返回的栏位，默认为全部栏位
+    :return: {'total': 符合条件的公司数, 'page': 页码, 'page_size': 每页的行数, 'items': 当前页的记录}
+    """
+    columns = list(table.columns) if not columns else columns
+    unknown = [c for c in columns + [key.lstrip('-') for key in sort] if c not in table.columns]
+    if unknown:
+        raise ExpressionError(f"unknown columns {unknown}")
+
+    rows = np.flatnonzero(filter_mask(table, filters))
+    if sort:
+        keys = [_sort_key(table[key.lstrip('-')].to_numpy()[rows], key.startswith('-')) for key in reversed(sort)]
+        rows = rows[np.lexsort(keys)]
+    start = (page - 1) * page_size
+    selected = table.iloc[rows[start:start + page_size]][columns]
+    items = selected.astype(object).where(selected.notna(), None).to_dict('records')
+    return {'total': len(rows), 'page': page, 'page_size': page_size, 'items': items}
+
+
+if __name__ == "__main__":
+    import time
+
+    rng = np.random.default_rng(0)
+    n = 4000
+    industries = np.array(['银行Ⅱ(申万)', '医药商业Ⅱ(申万)', '食品加工Ⅱ(申万)', '电子制造Ⅱ(申万)', None], dtype=object)
+    market = pd.DataFrame({'code': [f'{i:06d}' for i in range(n)],
+                           'rim_value': rng.normal(10, 4, n), 'pb_ratio': rng.normal(1.5, 0.4, n),
+                           'bps_2018': rng.normal(6, 2, n),
+                           'mm': rng.integers(0, 101, n).astype(float), 'mg_rank': rng.integers(0, 101, n),
+                           'industry_name': industries[rng.integers(0, len(industries), n)]})
+    market['is_financial'] = market['industry_name'].str.startswith('银行').fillna(False).astype(bool).values
+    market.loc[rng.choice(n, 300, replace=False), 'rim_value'] = np.nan
+
+    market['value_to_price'] = market['rim_value'] / (market['pb_ratio'] * market['bps_2018'])
+
+    filters = ['value_to_price > 1.3 and mm >= 80 and not is_financial']
+    screen(market, filters, ['-mm', 'code'])
+    start = time.perf_counter()
+    for _ in range(100):
+        result = screen(market, filters, ['-mm', 'code'], page=2, page_size=20)
+    print(f"{n}个公司, 符合条件{result['total']}个: {(time.perf_counter() - start) * 10:.2f}ms/次")
@@ -1,19 +1,142 @@
+from bisect import bisect_left
+from collections import namedtuple
 from typing import List, Tuple, Callable
+import gzip
+import hashlib
+import json
 
 import pandas as pd
 
-import aqi_db as rdb
+from src import aqi_db as rdb
+from src.stock_data.security_master import normalize
+from src.stock_data.versioned_cache import versioned_cache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None       # 没有安装brotli时只提供gzip
+
+SecuritiesPayload = namedtuple('SecuritiesPayload', ['bodies', 'etag'])
+SecuritiesPayload.__doc__ = """ 预先序列化的股票列表
+bodies: 内容编码（'identity'、'gzip'，安装了brotli时还有'br'） -> 响应体
+etag: 未压缩的响应体的摘要，各个编码的ETag为其后加上编码名称
+"""
 
 
 def get_securities(getter: Callable[[], pd.DataFrame]) -> List[Tuple[str, str, str]]:
     """ 获取股票列表，每个项目的内容包括股票名称、代码和拼音简称
     """
-    return [(t.index[:6], t.display_name, t.name) for t in getter().itertuples(index=False)]
+    df = getter()
+    return list(zip(normalize(df['code'].values).tolist(), df['display_name'].tolist(), df['name'].tolist()))
 
 
-if __name__ == "__main__":
-    print(get_securities(rdb.get_securities))
+@versioned_cache('jq')
+def get_securities_payload() -> SecuritiesPayload:
+    """
+    把 /securities 的响应序列化并压缩，jq.db被写入之后才会重新生成；每次请求只是选择一个响应体
+
+    :return: SecuritiesPayload，响应体的内容与原先由FastAPI序列化的 {"hello world": get_securities(...)} 相同
+    """
+    body = json.dumps({"hello world": get_securities(rdb.get_securities)},
+                      ensure_ascii=False, allow_nan=False, separators=(',', ':')).encode('utf-8')
+    bodies = {'identity': body, 'gzip': gzip.compress(body, compresslevel=9)}
+    if brotli is not None:
+        bodies['br'] = brotli.compress(body, quality=11)
+    return SecuritiesPayload(bodies, hashlib.sha1(body).hexdigest()[:20])
+
+
+def choose_encoding(accept_encoding: str, payload: SecuritiesPayload) -> str:
+    """
+    内容协商：在客户端接受（q不为0）的编码中选择响应体最小的
+    明确列出的编码以其自身的q为准，'*'只适用于没有列出的编码，例如'gzip;q=0, *'不接受gzip
+
+    :param accept_encoding: 请求的Accept-Encoding，例如'gzip, deflate, br'
+    :param payload: get_securities_payload的返回值
+    :return: payload.bodies中的编码名称，都不接受时为'identity'
+    """
+    qualities = {}
+    for item in accept_encoding.lower().split(','):
+        name, _, params = item.strip().partition(';')
+        q = params.strip()[2:] if params.strip().startswith('q=') else '1'
+        try:
+            qualities[name.strip()] = float(q)
+        except ValueError:
+            continue
+    candidates = [e for e in payload.bodies if e != 'identity' and qualities.get(e, qualities.get('*', 0)) > 0]
+    return min(candidates, key=lambda e: len(payload.bodies[e]), default='identity')
+
+
+def _search_key(text: str) -> str:
+    """ 检索时不区分大小写、忽略空格，例如'*ST 海马' -> '*st海马'
+    """
+    return ''.join(text.split()).lower()
 
 
+class SecurityIndex:
+    """ 股票列表的前缀索引：代码、名称和拼音简称各有一个排序的数组，前缀检索是一次二分查找加上顺序扫描
+
+    :param securities: get_securities的返回值，(代码, 名称, 拼音简称)
+    """
+    # 检索的栏位，按优先级排列
+    FIELDS = ('code', 'display_name', 'name')
+
+    __slots__ = ('securities', '_keys', '_ids')
+
+    def __init__(self, securities: List[Tuple[str, str, str]]):
+        self.securities = securities
+        self._keys: List[List[str]] = []
+        self._ids: List[List[int]] = []
+        for field in range(len(self.FIELDS)):
+            pairs = sorted((_search_key(str(s[field])), i) for i, s in enumerate(securities) if s[field])
+            self._keys.append([key for key, _ in pairs])
+            self._ids.append([i for _, i in pairs])
+
+    def __len__(self) -> int:
+        return len(self.securities)
+
+    def search(self, query: str, limit: int = 10) -> List[Tuple[str, str, str]]:
+        """
+        前缀检索：先按代码，再按名称，最后按拼音简称；同一个栏位内按字典序，因此完全匹配的排在最前面
+
+        :param query: 代码、名称或拼音简称的前缀，不区分大小写
+        :param limit: 至多返回多少个证券
+        :return: (代码, 名称, 拼音简称)，query为空时返回空列表
+        """
+        prefix = _search_key(query)
+        if not prefix:
+            return []
+        found, results = set(), []
+        for keys, ids in zip(self._keys, self._ids):
+            position = bisect_left(keys, prefix)
+            while position < len(keys) and len(results) < limit and keys[position].startswith(prefix):
+                i = ids[position]
+                if i not in found:
+                    found.add(i)
+                    results.append(self.securities[i])
+                position += 1
+        return results
+
+
+@versioned_cache('jq')
+def get_security_index() -> SecurityIndex:
+    """ 股票列表的前缀索引，jq.db被写入（securities表可能发生变化）之后才会重新建立
+    """
+    return SecurityIndex(get_securities(rdb.get_securities))
+
+
+if __name__ == "__main__":
+    import time
 
+    print(get_securities(rdb.get_securities)[:5])
+    start = time.perf_counter()
+    payload = get_securities_payload()
+    print(f"序列化和压缩: {(time.perf_counter() - start) * 1000:.1f}ms, "
+          + ', '.join(f'{e} {len(b) / 1024:.1f}KB' for e, b in payload.bodies.items()))
 
+    index = SecurityIndex([(f'{n:06d}', f'证券{n}', f'ZQ{n}') for n in range(4000)])
+    queries = ['0001', '证券12', 'zq3', '6000', 'x']
+    start = time.perf_counter()
+    for _ in range(2000):
+        for q in queries:
+            index.search(q, 10)
+    print(f"前缀检索: {(time.perf_counter() - start) / 2000 / len(queries) * 1e6:.1f}µs/次")
@@ -0,0 +1,175 @@
+""" 缓冲的、幂等的批量写入
+
+爬虫每抓取到一条记录就写一次数据库，每次写入都是一个事务；而且直接追加，重新运行爬虫会产生重复的记录。
+BulkWriter把记录缓存在内存中，记录数达到max_rows或者最早的记录已缓存max_seconds秒时，
+在一个事务中用executemany批量写入；写入方式为按唯一键（声明了结构的数据表为其主键，见schema）的upsert，
+所以重复抓取同一个报告期只会覆盖原来的记录。
+
+upsert使用INSERT OR REPLACE：被覆盖的记录会得到新的rowid，依赖rowid识别新数据的增量计算（见rim_db.
+get_financial_indicator_watermark）因此仍然能够发现被更新的记录。
+"""
+import atexit
+import math
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import sqlalchemy
+
+from src.stock_data import engines, schema
+
+
+def _quote(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _sql_type(value) -> str:
+    """ 根据Python值推断SQLite的列类型；无法推断（例如全部为空）时不声明类型，保留原始值
+    """
+    if isinstance(value, bool) or isinstance(value, int):
+        return 'INTEGER'
+    if isinstance(value, float):
+        return 'REAL'
+    if isinstance(value, str):
+        return 'TEXT'
+    return ''
+
+
+def _to_sql_value(value):
+    """ 把numpy标量转换为Python类型，NaN转换为NULL
+    """
+    if hasattr(value, 'item'):
+        value = value.item()
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+
+class BulkWriter:
+    """ 按唯一键upsert的缓冲写入器，线程安全
+
+    :param db: 数据库名称，见engines.DATABASES，例如'ts'
+    :param table: 表名；表不存在时根据第一批记录创建
+    :param key: 唯一键的栏位，默认为数据表结构中的主键，没有声明结构时为ts_code, end_date
+    :param max_rows: 缓存的记录数达到此值时写入
+    :param max_seconds: 最早的记录缓存了此秒数时写入（由后台线程检查）
+
+    Examples:
+    --------
+    with BulkWriter('ts', 'income') as writer:
+        for row in rows:
+            writer.write(row)
+    """
+
+    def __init__(self, db: str, table: str, key: Optional[Sequence[str]] = None,
+                 max_rows: int = 500, max_seconds: float = 5.0):
+        self.db = db
+        self.table = table
+        self._schema = schema.get_schema(db, table)
+        self.key = tuple(key or (self._schema.key if self._schema is not None else ('ts_code', 'end_date')))
+        self.max_rows = max_rows
+        self.max_seconds = max_seconds
+        self.stats = {'rows': 0, 'flushes': 0}
+        self._buffer: Dict[Tuple, dict] = {}         # 唯一键 -> 记录，缓存中同一个键只保留最新的记录
+        self._first_buffered: Optional[float] = None
+        self._columns: Optional[List[str]] = None   # 数据表现有的栏位
+        self._lock = threading.RLock()
+        self._closed = threading.Event()
+        self._timer = threading.Thread(target=self._flush_periodically, daemon=True)
+        self._timer.start()
+        atexit.register(self.close)
+
+    def write(self, row: dict) -> None:
+        """ 缓存一条记录，必要时写入数据库
+        """
+        with self._lock:
+            self._buffer[tuple(row[k] for k in self.key)] = row
+            if self._first_buffered is None:
+                self._first_buffered = time.monotonic()
+            if len(self._buffer) >= self.max_rows:
+                self.flush()
+
+    def write_many(self, rows: Iterable[dict]) -> None:
+        for row in rows:
+            self.write(row)
+
+    def _flush_periodically(self) -> None:
+        while not self._closed.wait(min(self.max_seconds, 1.0)):
+            with self._lock:
+                if self._first_buffered is not None \
+                        and time.monotonic() - self._first_buffered >= self.max_seconds:
+                    self.flush()
+
+    def _prepare_table(self, con, rows: List[dict]) -> None:
+        """ 建表、补充新的栏位，并保证唯一键上有唯一索引；已有的重复记录只保留最后写入的一条
+        声明了结构的数据表（见schema.SCHEMAS）按照结构建表，主键即为唯一键
+        """
+        samples: Dict[str, object] = {}
+        for row in rows:
+            for column, value in row.items():
+                if samples.get(column) is None:
+                    samples[column] = _to_sql_value(value)
+
+        if self._columns is None:
+            self._columns = [r[1] for r in con.execute(sqlalchemy.text(f'PRAGMA table_info({_quote(self.table)})'))]
+            if not self._columns:
+                if self._schema is not None:
+                    schema.create_table(con, self.table, self._schema, list(samples))
+                else:
+                    columns = ', '.join(f'{_quote(c)} {_sql_type(v)}'.rstrip() for c, v in samples.items())
+                    con.execute(sqlalchemy.text(f'CREATE TABLE {_quote(self.table)} ({columns})'))
+                self._columns = [r[1] for r in
+                                 con.execute(sqlalchemy.text(f'PRAGMA table_info({_quote(self.table)})'))]
+            elif self._schema is None:
+                keys = ', '.join(_quote(k) for k in self.key)
+                con.execute(sqlalchemy.text(f'DELETE FROM {_quote(self.table)} WHERE rowid NOT IN '
+                                            f'(SELECT MAX(rowid) FROM {_quote(self.table)} GROUP BY {keys})'))
+            if self._schema is None:
+                index = _quote(f"ux_{self.table}_{'_'.join(self.key)}")
+                con.execute(sqlalchemy.text(f'CREATE UNIQUE INDEX IF NOT EXISTS {index} ON {_quote(self.table)} '
+                                            f"({', '.join(_quote(k) for k in self.key)})"))
+
+        for column, value in samples.items():
+            if column not in self._columns:
+                sql_type = _sql_type(value) if self._schema is None else schema.column_type(self._schema, column)
+                con.execute(sqlalchemy.text(f'ALTER TABLE {_quote(self.table)} '
+                                            f'ADD COLUMN {_quote(column)} {sql_type}'.rstrip()))
+                self._columns.append(column)
+
+    def flush(self) -> int:
+        """ 在一个事务中写入缓存的全部记录
+
+        :return: 写入的记录数
+        """
+        with self._lock:
+            rows = list(self._buffer.values())
+            if not rows:
+                return 0
+            if self._columns is None and self._schema is not None:
+                schema.migrate_table(self.db, self.table)
+            with engines.get_engine(self.db).begin() as con:
+                self._prepare_table(con, rows)
+                columns = [c for c in self._columns if any(c in row for row in rows)]
+                sql = f"INSERT OR REPLACE INTO {_quote(self.table)} ({', '.join(_quote(c) for c in columns)}) " \
+                      f"VALUES ({', '.join(f':p{i}' for i in range(len(columns)))})"
+                con.execute(sqlalchemy.text(sql),
+                            [{f'p{i}': _to_sql_value(row.get(c)) for i, c in enumerate(columns)} for row in rows])
+            self._buffer.clear()
+            self._first_buffered = None
+            self.stats['rows'] += len(rows)
+            self.stats['flushes'] += 1
+            return len(rows)
+
+    def close(self) -> None:
+        """ 停止后台线程并写入剩余的记录，可以重复调用
+        """
+        if not self._closed.is_set():
+            self._closed.set()
+            atexit.unregister(self.close)
+        self.flush()
+
+    def __enter__(self) -> 'BulkWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
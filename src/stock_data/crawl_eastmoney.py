@@ -1,17 +1,186 @@
-import pandas as pd
+""" 东方财富的盈利预测爬虫
+
+盈利预测页面 http://data.eastmoney.com/report/profitforecast.jshtml 的表格由东方财富数据中心的分页JSON接口
+（报表RPT_WEB_RESPREDICT）填充。直接通过HTTP并发地请求各页，每一页解析之后立即upsert到em1.db（engines.DATABASES['em']，
+即API读取的数据库）的profit_forecast表，不需要浏览器，可以在服务器上运行。
+
+接口地址和字段对应关系见FORECAST_URL、FORECAST_FIELDS和EPS_FIELDS。record把真实接口的原始响应保存为FIXTURE_DIR下的录制文件，
+tests/test_crawl_eastmoney.py用parse_page解析这些文件，检查字段对应关系；eastmoney_standin回放这些文件，用于离线测试。
+接口或字段发生变化时，重新录制即可发现。
+
+用法（在项目根目录下）：
+    python -m src.stock_data.crawl_eastmoney                # 抓取并保存
+    python -m src.stock_data.crawl_eastmoney record [页数]   # 录制真实接口的前几页响应，默认2页
+    python -m src.stock_data.crawl_eastmoney bench          # 基准测试：对回放录制文件的模拟服务器抓取
+    python -m src.stock_data.crawl_eastmoney selenium       # 旧的做法，用Chrome逐页点击（需要selenium和Chrome）
+"""
+import datetime
+import json
+import os
+import re
+import sys
+import time
+import urllib.parse
+import urllib.request
+from typing import Dict, List, Tuple
+
 import sqlalchemy
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support import expected_conditions as ec
-from selenium.webdriver.support.wait import WebDriverWait
 
-if __name__ == '__main__':
+from src.stock_data import engines, schema, security_master, snapshot
+from src.stock_data.bulk_writer import BulkWriter
+from src.stock_data.fetch_executor import RateLimitedExecutor
+
+# 盈利预测的分页接口，可以用环境变量EASTMONEY_FORECAST_URL指向模拟服务器
+FORECAST_URL = os.environ.get('EASTMONEY_FORECAST_URL', 'https://datacenter-web.eastmoney.com/api/data/v1/get')
+FORECAST_PARAMS: Dict[str, str] = {'reportName': 'RPT_WEB_RESPREDICT', 'columns': 'WEB_RESPREDICT',
+                                   'sortColumns': 'SECURITY_CODE', 'sortTypes': '1'}
+PAGE_SIZE = 100
+REQUESTS_PER_MINUTE = 120
+
+# 接口的字段 -> profit_forecast的栏位，栏位与原先页面表格的各列相同
+FORECAST_FIELDS: Dict[str, str] = {
+    'SECURITY_CODE': 'code',
+    'RATING_ORG_NUM': 'number_of_reports',
+    'RATING_BUY_NUM': 'rank_buy',
+    'RATING_ADD_NUM': 'rank_increase',
+    'RATING_NEUTRAL_NUM': 'rank_neutral',
+    'RATING_REDUCE_NUM': 'rank_reduction',
+    'RATING_SALE_NUM': 'rank_sell_out',
+}
+
+# 每股收益的(年度字段, 每股收益字段)：EPS1为YEAR1（最近一个已披露年度）的每股收益，EPS2~EPS4为之后三个年度的预测。
+# YEAR1随时间推移，而且各公司不同（取决于是否已披露年报），因此按年度保存到eps_<年度>栏位，而不是按位置
+EPS_FIELDS: Tuple[Tuple[str, str], ...] = (('YEAR1', 'EPS1'), ('YEAR2', 'EPS2'), ('YEAR3', 'EPS3'), ('YEAR4', 'EPS4'))
+
+# profit_forecast中有栏位的年度，RIM模型以2018年为基年（见business.rim.FORECAST_YEARS）
+EPS_YEARS: Tuple[int, ...] = (2018, 2019, 2020, 2021)
+
+# 录制的真实响应，page_<页码>.json
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'tests', 'fixtures', 'eastmoney')
+
+_JSONP = re.compile(r'^[\w$.]+\((.*)\);?\s*$', re.S)
+
+
+def _page_url(url: str, page: int) -> str:
+    return f"{url}?{urllib.parse.urlencode(dict(FORECAST_PARAMS, pageNumber=page, pageSize=PAGE_SIZE))}"
+
+
+def _request(url: str, page: int) -> bytes:
+    request = urllib.request.Request(_page_url(url, page), headers={'User-Agent': 'Mozilla/5.0'})
+    with urllib.request.urlopen(request, timeout=15) as response:
+        return response.read()
+
+
+def _eps_by_year(item: dict) -> Dict[int, object]:
+    """ 一条记录的每股收益，年度 -> 每股收益，只保留EPS_YEARS中的年度
+    """
+    eps = {}
+    for year_field, eps_field in EPS_FIELDS:
+        try:
+            year = int(float(item.get(year_field)))
+        except (TypeError, ValueError):
+            continue
+        if year in EPS_YEARS:
+            eps[year] = item.get(eps_field)
+    return eps
+
+
+def parse_page(text: str) -> Tuple[int, List[dict]]:
+    """
+    解析一页盈利预测，JSON或JSONP：{"result": {"pages": 总页数, "count": 记录数, "data": [...]}, "success": ...}
+    页码超出范围时result为null。每股收益按YEAR1~YEAR4保存到对应年度的eps_<年度>栏位，没有的年度为None；
+    年度与EPS_YEARS全不相交的记录不保存，以免把其他年度的预测当作eps_2018~eps_2021
+
+    :param text: 接口的响应
+    :return: (总页数, profit_forecast的记录列表)
+    :raise ValueError: 本页有记录，但没有一条记录的年度在EPS_YEARS之中
+    """
+    match = _JSONP.match(text)
+    result = json.loads(match.group(1) if match else text).get('result') or {}
+    items = result.get('data') or []
+    rows = []
+    for item in items:
+        eps = _eps_by_year(item)
+        if eps:
+            rows.append(dict({column: item.get(field) for field, column in FORECAST_FIELDS.items()},
+                             **{f'eps_{year}': eps.get(year) for year in EPS_YEARS}))
+    if items and not rows:
+        years = sorted({str(item[field]) for item in items for field, _ in EPS_FIELDS if item.get(field) is not None})
+        raise ValueError(f"盈利预测的年度{years}与profit_forecast的栏位eps_{EPS_YEARS[0]}~eps_{EPS_YEARS[-1]}不相交")
+    return int(result.get('pages') or 0), rows
+
+
+def fetch_page(url: str, page: int) -> Tuple[int, List[dict]]:
+    """
+    请求并解析一页盈利预测
+
+    :param url: 接口地址
+    :param page: 页码，从1开始
+    :return: (总页数, profit_forecast的记录列表)
+    """
+    return parse_page(_request(url, page).decode('utf-8'))
+
+
+def record_fixtures(pages: int = 2, url: str = FORECAST_URL, directory: str = FIXTURE_DIR) -> List[str]:
+    """
+    把真实接口前几页的原始响应保存为录制文件，供测试和eastmoney_standin使用
+
+    :param pages: 录制的页数
+    :return: 保存的文件路径
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for page in range(1, pages + 1):
+        path = os.path.join(directory, f'page_{page}.json')
+        with open(path, 'wb') as f:
+            f.write(_request(url, page))
+        paths.append(path)
+    return paths
+
+
+def crawl_profit_forecast(url: str = FORECAST_URL, workers: int = 4) -> int:
+    """ 抓取全部盈利预测，保存到em1.db的profit_forecast表，以code为唯一键
+    每一页解析之后即交给BulkWriter写入；全部页面抓取成功之后，删除本次没有出现的公司（例如已经没有预测的公司）
+    年度不符的页面（见parse_page）视为失败，此时不删除旧的记录
+
+    :param url: 接口地址
+    :param workers: 并发的线程数
+    :return: 保存的记录数
+    """
+    crawled_at = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+    failed = 0
+    with RateLimitedExecutor({'eastmoney': REQUESTS_PER_MINUTE}, workers=workers) as executor, \
+            BulkWriter('em', 'profit_forecast') as writer:
+        total_pages, rows = executor.submit('eastmoney', fetch_page, url, 1).result()
+        writer.write_many(dict(row, crawled_at=crawled_at) for row in rows)
+        for page, result in executor.map('eastmoney', lambda p: fetch_page(url, p), range(2, total_pages + 1)):
+            if isinstance(result, Exception):
+                failed += 1
+                print(f"第{page}页抓取失败: {result!r}")
+            else:
+                writer.write_many(dict(row, crawled_at=crawled_at) for row in result[1])
+    if failed == 0:
+        with engines.get_engine('em').begin() as con:
+            con.execute(sqlalchemy.text('DELETE FROM profit_forecast WHERE crawled_at IS NULL OR crawled_at != :t'),
+                        {'t': crawled_at})
+    security_master.register_sources()
+    snapshot.export_database('em')
+    print(f"盈利预测: {total_pages}页, 保存{writer.stats['rows']}条, 失败{failed}页")
+    return writer.stats['rows']
+
+
+def crawl_with_selenium(url: str = 'http://data.eastmoney.com/report/profitforecast.jshtml') -> int:
+    """ 旧的做法：用Chrome打开页面，逐个单元格读取表格，点击"下一页"翻页，最后一次性保存
+    """
+    import pandas as pd
+    from selenium import webdriver
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support import expected_conditions as ec
+    from selenium.webdriver.support.wait import WebDriverWait
+
     browser = webdriver.Chrome()
-    # forecasts = pd.DataFrame(columns=['code', 'number_of_reports', 'rank_buy', 'rank_increase', 'rank_neutral',
-    #                                   'rank_reduction', 'rank_sell_out', 'eps_2018', 'eps_2019', 'eps_2020',
-    #                                   'eps_2021'], index=['0'])
     try:
-        browser.get('http://data.eastmoney.com/report/profitforecast.jshtml')
+        browser.get(url)
         forecasts = []
         is_not_last_page = True
         while is_not_last_page is True:
@@ -40,7 +209,37 @@ if __name__ == '__main__':
                 is_not_last_page = False
 
         df_forecasts = pd.DataFrame(forecasts)
-        df_forecasts.to_sql('profit_forecast', con=sqlalchemy.create_engine('sqlite:///../../data/em2.db'),
-                            if_exists='replace', chunksize=1024)
+        schema.replace_table('em', 'profit_forecast', df_forecasts)
+        security_master.register_sources()
+        snapshot.export_database('em')
+        return len(df_forecasts)
     finally:
         browser.close()
+
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'crawl'
+    if command == 'record':
+        for fixture in record_fixtures(int(sys.argv[2]) if len(sys.argv) > 2 else 2):
+            print(f"已录制 {fixture}: {len(parse_page(open(fixture, encoding='utf-8').read())[1])}条")
+    elif command == 'bench':
+        import threading
+
+        from src.stock_data import eastmoney_standin
+
+        # selenium路径需要Chrome和真实的页面，不能对模拟服务器运行；与之可比的是一次一页的顺序抓取（workers=1），
+        # 它是selenium路径的上限：后者每页还要渲染页面、逐个单元格读取表格。两者都受REQUESTS_PER_MINUTE的限制
+        pages = 38
+        srv = eastmoney_standin.make_server(pages=pages, latency=0.3)
+        threading.Thread(target=srv.serve_forever, daemon=True).start()
+        for workers in (1, 4):
+            start = time.perf_counter()
+            crawl_profit_forecast(srv.url, workers=workers)
+            elapsed = time.perf_counter() - start
+            print(f"HTTP workers={workers}: {pages}页, {elapsed:.2f}s, {pages / elapsed:.2f} 页/秒")
+        srv.shutdown()
+    else:
+        start = time.perf_counter()
+        n = crawl_with_selenium() if command == 'selenium' else crawl_profit_forecast()
+        elapsed = time.perf_counter() - start
+        print(f"{command}: {n}条, {elapsed:.2f}s, {n / elapsed:.0f} 条/秒")
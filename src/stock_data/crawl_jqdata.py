@@ -1,14 +1,24 @@
 import datetime as dt
 
-import sqlalchemy
 from jqdatasdk import *
 
 from src import config
+from src.stock_data import schema, security_master, snapshot
 
 
-if __name__ == "__main__":
+def crawl_securities() -> int:
+    """ 抓取当前全部股票，替换jq.db的securities表
+
+    :return: 股票数
+    """
     auth(config.jq_user, config.jq_pwd)
     df = get_all_securities(['stock'], dt.datetime.now())
     print(df)
-    df.to_sql('securities', con=sqlalchemy.create_engine('sqlite:///../../data/jq.db'), if_exists='replace',
-              chunksize=1024)
+    schema.replace_table('jq', 'securities', df.rename_axis('code').reset_index())
+    security_master.register_sources()
+    snapshot.export_database('jq')
+    return len(df)
+
+
+if __name__ == "__main__":
+    crawl_securities()
@@ -0,0 +1,219 @@
+""" 持久化的抓取任务队列
+
+每个抓取任务为(api, ts_code, period)，状态依次为：
+    pending     待抓取
+    running     已被某次抓取领取，尚未完成；抓取中断后，下次运行时重新置为pending
+    done        已抓取并保存，不再重复抓取
+    empty       已抓取，但tushare还没有数据（例如年报尚未披露）；到了retry_at之后由release_empty重新置为pending，
+                每次重新检查的间隔加倍，从EMPTY_RECHECK_BASE到EMPTY_RECHECK_MAX
+    failed      重试之后仍然失败，可以用retry_failed重新置为pending
+
+任务保存在独立的crawl.db中，而不是ts.db，避免任务状态的写入改变ts.db的数据版本。
+"还剩哪些任务"是crawl_job上按(api, status)索引的查询，不需要读入整个数据表来求差集。
+"""
+import functools
+import time
+import uuid
+from typing import Dict, Iterable, List, Set, Tuple
+
+import sqlalchemy
+
+from src.stock_data import engines
+
+PENDING, RUNNING, DONE, EMPTY, FAILED = 'pending', 'running', 'done', 'empty', 'failed'
+
+# 没有数据的任务重新检查的间隔（秒）：第一次1天，之后每次加倍，至多30天
+EMPTY_RECHECK_BASE = 24 * 3600
+EMPTY_RECHECK_MAX = 30 * 24 * 3600
+
+_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS crawl_job (
+        api TEXT NOT NULL,
+        ts_code TEXT NOT NULL,
+        period TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        claim TEXT,
+        error TEXT,
+        updated_at REAL,
+        retry_at REAL,
+        stored INTEGER,
+        PRIMARY KEY (api, ts_code, period))''',
+    'CREATE INDEX IF NOT EXISTS ix_crawl_job_status ON crawl_job (api, status)',
+]
+
+# 后来增加的栏位，旧的crawl.db在打开时补上。stored：1为数据已保存，0为没有数据，
+# 空值为旧版本置为done的任务，旧版本把没有数据的任务也置为done，见has_unverified_done
+_ADDED_COLUMNS = {'retry_at': 'REAL', 'stored': 'INTEGER'}
+
+
+@functools.lru_cache(maxsize=None)
+def _create_schema(path: str) -> None:
+    with engines.get_engine('crawl').begin() as con:
+        for statement in _SCHEMA:
+            con.execute(sqlalchemy.text(statement))
+        columns = {row[1] for row in con.execute(sqlalchemy.text('PRAGMA table_info(crawl_job)'))}
+        for column, sql_type in _ADDED_COLUMNS.items():
+            if column not in columns:
+                con.execute(sqlalchemy.text(f'ALTER TABLE crawl_job ADD COLUMN {column} {sql_type}'))
+
+
+def _engine():
+    _create_schema(engines.get_db_path('crawl'))
+    return engines.get_engine('crawl')
+
+
+def enqueue(api: str, code_periods: Iterable[Tuple[str, str]]) -> int:
+    """
+    添加抓取任务，已经存在的任务（无论状态）保持不变
+
+    :param api: tushare接口名称，例如'income'
+    :param code_periods: (ts_code, period)
+    :return: 新增的任务数
+    """
+    with _engine().begin() as con:
+        before = con.execute(sqlalchemy.text('SELECT COUNT(*) FROM crawl_job WHERE api = :api'), {'api': api}).scalar()
+        params = [{'api': api, 'ts_code': code, 'period': period, 'now': time.time()} for code, period in code_periods]
+        if params:
+            con.execute(sqlalchemy.text('INSERT OR IGNORE INTO crawl_job (api, ts_code, period, updated_at) '
+                                        'VALUES (:api, :ts_code, :period, :now)'), params)
+        after = con.execute(sqlalchemy.text('SELECT COUNT(*) FROM crawl_job WHERE api = :api'), {'api': api}).scalar()
+    return after - before
+
+
+def is_empty(api: str) -> bool:
+    """ 某个接口是否还没有任何任务
+    """
+    with _engine().connect() as con:
+        return con.execute(sqlalchemy.text('SELECT 1 FROM crawl_job WHERE api = :api LIMIT 1'),
+                           {'api': api}).scalar() is None
+
+
+def claim(api: str, limit: int) -> List[Tuple[str, str]]:
+    """
+    领取至多limit个待抓取的任务，并置为running
+
+    :return: (ts_code, period)列表，没有待抓取的任务时为空
+    """
+    token = uuid.uuid4().hex
+    with _engine().begin() as con:
+        con.execute(sqlalchemy.text('UPDATE crawl_job SET status = :running, claim = :token, updated_at = :now '
+                                    'WHERE rowid IN (SELECT rowid FROM crawl_job WHERE api = :api '
+                                    'AND status = :pending ORDER BY ts_code, period LIMIT :limit)'),
+                    {'running': RUNNING, 'pending': PENDING, 'token': token, 'now': time.time(), 'api': api,
+                     'limit': limit})
+        rows = con.execute(sqlalchemy.text('SELECT ts_code, period FROM crawl_job WHERE claim = :token'),
+                           {'token': token}).fetchall()
+    return [(code, period) for code, period in rows]
+
+
+def _set_status(api: str, code_periods: Iterable[Tuple[str, str]], status: str, error: str = None,
+                stored: int = None, retry_at: str = 'NULL') -> None:
+    """
+    :param retry_at: retry_at栏位的SQL表达式，可以引用attempts（更新之前的值）和:now
+    """
+    params = [{'api': api, 'ts_code': code, 'period': period, 'status': status, 'error': error, 'stored': stored,
+               'now': time.time()}
+              for code, period in code_periods]
+    if params:
+        with _engine().begin() as con:
+            con.execute(sqlalchemy.text(f'UPDATE crawl_job SET status = :status, error = :error, claim = NULL, '
+                                        f'stored = :stored, retry_at = {retry_at}, '
+                                        f'attempts = attempts + 1, updated_at = :now '
+                                        f'WHERE api = :api AND ts_code = :ts_code AND period = :period'), params)
+
+
+def mark_done(api: str, code_periods: Iterable[Tuple[str, str]]) -> None:
+    """ 把任务置为done，应在数据已经写入数据库之后调用
+    """
+    _set_status(api, code_periods, DONE, stored=1)
+
+
+def mark_empty(api: str, code_periods: Iterable[Tuple[str, str]]) -> None:
+    """ 把抓取成功、但没有数据的任务置为empty，到了重新检查的时间之后由release_empty重新置为pending
+    """
+    _set_status(api, code_periods, EMPTY, stored=0,
+                retry_at=f':now + MIN({EMPTY_RECHECK_MAX}, {EMPTY_RECHECK_BASE} * (1 << MIN(attempts, 10)))')
+
+
+def release_empty(api: str) -> int:
+    """ 到了重新检查时间的empty任务重新置为pending
+
+    :return: 重置的任务数
+    """
+    with _engine().begin() as con:
+        return con.execute(sqlalchemy.text('UPDATE crawl_job SET status = :pending, updated_at = :now '
+                                           'WHERE api = :api AND status = :empty AND retry_at <= :now'),
+                           {'pending': PENDING, 'empty': EMPTY, 'now': time.time(), 'api': api}).rowcount
+
+
+def has_unverified_done(api: str) -> bool:
+    """ 是否有旧版本置为done的任务（stored为空），它们之中可能有没有数据的任务，需要用reconcile_done核对
+    """
+    with _engine().connect() as con:
+        return con.execute(sqlalchemy.text('SELECT 1 FROM crawl_job WHERE api = :api AND status = :done '
+                                           'AND stored IS NULL LIMIT 1'), {'api': api, 'done': DONE}).scalar() \
+            is not None
+
+
+def reconcile_done(api: str, stored: Set[Tuple[str, str]]) -> int:
+    """
+    核对旧版本置为done的任务：数据表中有数据的保持done，没有数据的置为empty并立即可以重新抓取
+
+    :param stored: 数据表中已有的(ts_code, period)
+    :return: 重新置为empty的任务数
+    """
+    with _engine().connect() as con:
+        rows = con.execute(sqlalchemy.text('SELECT ts_code, period FROM crawl_job WHERE api = :api '
+                                           'AND status = :done AND stored IS NULL'), {'api': api, 'done': DONE})
+        unverified = [(code, period) for code, period in rows]
+    missing = [job for job in unverified if job not in stored]
+    now = time.time()
+    with _engine().begin() as con:
+        if missing:
+            con.execute(sqlalchemy.text('UPDATE crawl_job SET status = :empty, stored = 0, retry_at = :now, '
+                                        'updated_at = :now '
+                                        'WHERE api = :api AND ts_code = :ts_code AND period = :period'),
+                        [{'api': api, 'empty': EMPTY, 'now': now, 'ts_code': code, 'period': period}
+                         for code, period in missing])
+        con.execute(sqlalchemy.text('UPDATE crawl_job SET stored = 1 WHERE api = :api AND status = :done '
+                                    'AND stored IS NULL'), {'api': api, 'done': DONE})
+    return len(missing)
+
+
+def mark_failed(api: str, code_periods: Iterable[Tuple[str, str]], error: str) -> None:
+    """ 把任务置为failed，并记录错误信息
+    """
+    _set_status(api, code_periods, FAILED, error)
+
+
+def _reset(api: str, status: str) -> int:
+    with _engine().begin() as con:
+        return con.execute(sqlalchemy.text('UPDATE crawl_job SET status = :pending, claim = NULL, updated_at = :now '
+                                           'WHERE api = :api AND status = :status'),
+                           {'pending': PENDING, 'now': time.time(), 'api': api, 'status': status}).rowcount
+
+
+def reset_running(api: str) -> int:
+    """ 上次抓取被中断时仍为running的任务重新置为pending，应在同一接口没有其他抓取进程时调用
+
+    :return: 重置的任务数
+    """
+    return _reset(api, RUNNING)
+
+
+def retry_failed(api: str) -> int:
+    """ 失败的任务重新置为pending
+
+    :return: 重置的任务数
+    """
+    return _reset(api, FAILED)
+
+
+def counts(api: str) -> Dict[str, int]:
+    """ 各个状态的任务数
+    """
+    with _engine().connect() as con:
+        rows = con.execute(sqlalchemy.text('SELECT status, COUNT(*) FROM crawl_job WHERE api = :api GROUP BY status'),
+                           {'api': api}).fetchall()
+    return {PENDING: 0, RUNNING: 0, DONE: 0, EMPTY: 0, FAILED: 0, **{status: n for status, n in rows}}
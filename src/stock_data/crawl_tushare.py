@@ -1,161 +1,141 @@
-from typing import List, NoReturn, Tuple, Iterator
-import sched, time
-from itertools import groupby, product, count
+from typing import Dict, List, NoReturn, Tuple
+from itertools import product
 import datetime
+import os
 
 import pandas as pd
-import sqlalchemy
-import tushare as ts
 from toolz.functoolz import pipe
 
-from src import config
-from src.stock_data import rim_db
+from src.stock_data import rim_db, snapshot, crawl_queue, security_master, tushare_standin
+from src.stock_data.bulk_writer import BulkWriter
+from src.stock_data.fetch_executor import RateLimitedExecutor
 
-ts.set_token(config.ts_token)
+try:
+    import tushare as ts
+except ImportError:
+    ts = None       # 只访问tushare_standin时不需要安装tushare
 
 
 def get_securities():
-    pro = ts.pro_api()
+    pro = get_pro_api()
     # 查询当前所有正常上市交易的股票列表
     return pro.stock_basic(exchange='', list_status='L', fields='ts_code,symbol,name,area,industry,list_date')
 
 
 def tushare_indicator_to_db(index: int, codes: List[str]) -> NoReturn:
-    indicators: List[dict] = []
     print(f"第{index}批次 {datetime.datetime.now()}")
-    for code in codes:
-        print(f"{code}")
-        indicator: pd.DataFrame = ts.pro_api().fina_indicator(ts_code=code, period='20181231', fields='ts_code, eps, bps')
-        if indicator.empty is False:
-            indicators.append(indicator.iloc[0].to_dict())
-    pd.DataFrame(indicators).to_sql('indicator2018', con=sqlalchemy.create_engine('sqlite:///../../data/ts.db'),
-                                    if_exists='replace' if index == 0 else 'append', chunksize=1024)
+    with BulkWriter('ts', 'indicator2018') as writer:
+        for code in codes:
+            print(f"{code}")
+            indicator: pd.DataFrame = get_pro_api().fina_indicator(ts_code=code, period='20181231',
+                                                                   fields='ts_code, eps, bps')
+            if indicator.empty is False:
+                writer.write(indicator.iloc[0].to_dict())
+    security_master.register_sources()
+    snapshot.export_database('ts')
+
+
+# 各接口每分钟的访问次数，略低于tushare对本账户的限额，见 https://tushare.pro/document/1?doc_id=108
+TUSHARE_RATE_LIMITS: Dict[str, float] = {
+    'fina_indicator': 70,
+    'balancesheet': 70,
+    'income': 70,
+}
+
+# 接口名称 -> 数据表名称
+TUSHARE_TABLES: Dict[str, str] = {
+    'fina_indicator': 'financial_indicator',
+    'balancesheet': 'balancesheet',
+    'income': 'income',
+}
+
+
+def get_pro_api():
+    """ tushare pro的客户端；若设置了环境变量TUSHARE_HTTP_URL，则返回访问该地址的tushare_standin.StandinApi，
+    用法相同，这时不需要安装tushare，也不需要src/config.py中的ts_token
+    """
+    http_url = os.environ.get('TUSHARE_HTTP_URL')
+    if http_url:
+        return tushare_standin.StandinApi(http_url)
+    if ts is None:
+        raise ImportError('没有安装tushare；访问模拟服务器请设置TUSHARE_HTTP_URL，见tushare_standin')
+    from src import config
+    return ts.pro_api(config.ts_token)
 
 
-def save_ts_indicator_to_db(code_year_lst: List[Tuple[str, str]]) -> NoReturn:
-    """ 根据指定的股票代码，从tushare获取财务指标数据，并保存到本地数据库
-    假设：
-    1. 数据库路径为项目路径 \data\ts.db
-    2. 数据表为financial_indicator
-    3. 字段名称同tushare规定 https://tushare.pro/document/2?doc_id=79
-    输入假设：
-    codes 代码-年列表，代码和年份都要要符合tushare的格式要求。列表不能为空
-    输出：
-    NoReturn
+def enqueue_code_periods(api_name: str, start: int, end: int) -> int:
     """
-    assert code_year_lst is not None
-    indicators: List[dict] = []
-    for (code, year), index in code_year_lst:
-        print(f"{index}, {code}, {year}")
-        indicator: pd.DataFrame = ts.pro_api().fina_indicator(ts_code=code, period=year)
-        if indicator.empty is False:
-            indicators.append(indicator.iloc[0].to_dict())
-    pd.DataFrame(indicators).to_sql('financial_indicator', con=sqlalchemy.create_engine('sqlite:///../../data/ts.db'),
-                                    if_exists='append', chunksize=1024)
-    print("Save to DB")
-
-
-def task_scheduler() -> NoReturn:
-    pro = ts.pro_api()
-    s = sched.scheduler(time.time, time.sleep)
-    securities: pd.DataFrame = pro.stock_basic(exchange='', list_status='L', fields='ts_code')
-    securities_lst: List[str] = [t.ts_code for t in securities.itertuples()]
-    code_year_set = set(product(securities_lst, [f"{y}1231" for y in range(2010, 2019)]))
-
-    today = datetime.datetime.now()
-    today = today.strftime("%Y-%m-%d")
-    financial_indicators = rim_db.get_financial_indicator(today)
-    code_set = financial_indicators.index
-    done_code_year_set = set(zip(code_set.get_level_values(0), code_set.get_level_values(1)))
-
-    to_do_set = code_year_set - done_code_year_set
-    to_do_with_index = zip(to_do_set, count())
-
-    job_groups = groupby(to_do_with_index, key=lambda x: x[1] // 36)  # 每30秒查询-保存36条记录
-    for i, jobs in job_groups:
-        s.enter(i * 30, 1, save_ts_indicator_to_db, kwargs={'code_year_lst': [j for j in jobs]})
-    s.run()
-
-
-def download_and_save_statement(code_year_lst: List[Tuple[str, str]], statement_name: str = 'balancesheet') -> NoReturn:
-    """ 根据股票代码、年份和报表名称，从tushare获取指定的报表，并保存到本地数据库
-    假设：
-    1. 数据库路径为项目路径 \data\ts.db
-    2. code_year_lst 代码-年列表，内部元素为(index, (code, year)), code和year都要要符合tushare的格式要求。列表不能为空
-    3. statement_name, 字符串, 只能为balancesheet
-    输出：
-    NoReturn
+    把当前上市的公司在start ~ end-1年度的年报加入抓取任务队列，已有的任务保持不变
+    某个接口第一次加入任务时，数据库中已有的报告期直接置为done，之后不再需要读入整个数据表；
+    旧版本的队列把没有数据的任务也置为done，这样的队列也读入一次数据表，把没有数据的任务重新置为empty
+
+    :param api_name: tushare接口名称，见TUSHARE_TABLES
+    :param start: 开始年度
+    :param end: 结束年度（不含）
+    :return: 新增的任务数
     """
-    assert code_year_lst is not None
-    assert statement_name == 'balancesheet' or statement_name == 'income'
-    assert all([isinstance(index, int) and isinstance(code_year, tuple) for index, code_year in code_year_lst])
-
-    statements: List[dict] = []
-    for index, (code, year) in code_year_lst:
-        print(f"{index}, {code}, {year}")
-        statement: pd.DataFrame = ts.pro_api().query(statement_name, ts_code=code, period=year)
-        if statement.empty is False:
-            statements.append(statement.iloc[0].to_dict())
-    pd.DataFrame(statements).to_sql(statement_name, con=sqlalchemy.create_engine('sqlite:///../../data/ts.db'),
-                                    if_exists='append', chunksize=1024)
-    print("Save to DB")
-
-
-def task_scheduler2(name: str, start: int, end: int) -> NoReturn:
-    s = sched.scheduler(time.time, time.sleep)
-    statements = rim_db.get_ts_statement(name)
-    if statements is not None:
-        code_year = statements.index
-        completion_of_code_year = set(zip(code_year.get_level_values(0), code_year.get_level_values(1)))
-    else:
-        completion_of_code_year = set()
-
-    code_year_set = pipe(ts.pro_api().stock_basic(exchange='', list_status='L', fields='ts_code'),
-                         lambda x: [t.ts_code for t in x.itertuples()],  # 枚举当前可用的公司代码
-                         lambda x: set(product(x, [f"{y}1231" for y in range(start, end)])))  # 构造 tuple (code, year)
-
-    undo_code_year_set = code_year_set - completion_of_code_year
-
-    tasks = pipe(undo_code_year_set,
-                 lambda x: zip(count(), x),
-                 lambda x: groupby(x, key=lambda y: y[0] // 35),  # 分组，便于限流
-                 lambda x: [s.enter(i * 30, 1, download_and_save_statement,  # 每分钟安排35个下载任务
-                                    kwargs={'code_year_lst': [j for j in jobs]}) for i, jobs in x])
-    s.run()
-
-
-def task_scheduler3(name: str, start: int, end: int) -> NoReturn:
-    statements = rim_db.get_ts_statement(name)
-    if statements is not None:
-        code_year = statements.index
-        completion_of_code_year = set(zip(code_year.get_level_values(0), code_year.get_level_values(1)))
-    else:
-        completion_of_code_year = set()
-
-    code_year_set = pipe(ts.pro_api().stock_basic(exchange='', list_status='L', fields='ts_code'),
-                         lambda x: [t.ts_code for t in x.itertuples()],  # 枚举当前可用的公司代码
-                         lambda x: set(product(x, [f"{y}1231" for y in range(start, end)])))  # 构造 tuple (code, year)
-
-    undo_code_year_set = code_year_set - completion_of_code_year
-
-    counter = 1
-    start_time = time.time()
-    for code, end_date in undo_code_year_set:
-        print(f"code is {code}, end date is {end_date}")
-        if counter >= 75:
-            counter = 1
-            delta = time.time() - start_time
-            start_time = time.time()
-            if delta < 61:
-                time.sleep(71 - delta)
+    is_new = crawl_queue.is_empty(api_name)
+    added = pipe(get_pro_api().stock_basic(exchange='', list_status='L', fields='ts_code'),
+                 lambda x: [t.ts_code for t in x.itertuples()],  # 枚举当前可用的公司代码
+                 lambda x: product(x, [f"{y}1231" for y in range(start, end)]),  # 构造 tuple (code, year)
+                 lambda x: crawl_queue.enqueue(api_name, x))
+    if is_new or crawl_queue.has_unverified_done(api_name):
+        statements = rim_db.load_ts_statement(TUSHARE_TABLES[api_name], ('ts_code', 'end_date'))
+        stored = set() if statements is None else set(statements.index)
+        if is_new:
+            crawl_queue.mark_done(api_name, stored)
         else:
-            counter = counter + 1
+            crawl_queue.reconcile_done(api_name, stored)
+    return added
 
-        statement: pd.DataFrame = ts.pro_api().query(name, ts_code=code, period=end_date).set_index(['ts_code',
-                                                                                                     'end_date'])
-        if not statement.empty:
-            statement.to_sql(name, con=sqlalchemy.create_engine('sqlite:///../../data/ts.db'), if_exists='append')
+
+def crawl_statements(api_name: str, start: int, end: int, workers: int = 4, batch: int = 500) -> int:
+    """ 从tushare并发地抓取当前上市公司start ~ end-1年度的年报数据，保存到ts.db
+    假设：
+    1. 数据表名称见TUSHARE_TABLES，字段名称同tushare规定，(ts_code, end_date)唯一，重复抓取会覆盖原来的记录
+    2. 访问频率由TUSHARE_RATE_LIMITS限制，超出限额和网络错误会自动重试；重试之后仍然失败的任务在队列中置为failed
+    3. 每次从任务队列领取batch个任务，数据写入数据库之后才置为done；中断之后重新运行，从未完成的任务继续
+    4. tushare还没有数据的报告期（例如年报尚未披露）置为empty，到了重新检查的时间之后再次抓取，见crawl_queue
+
+    :param api_name: tushare接口名称，fina_indicator、balancesheet或者income
+    :param start: 开始年度
+    :param end: 结束年度（不含）
+    :param workers: 并发的线程数
+    :param batch: 每次领取的任务数
+    :return: 保存的记录数
+    """
+    assert api_name in TUSHARE_TABLES
+    crawl_queue.reset_running(api_name)
+    enqueue_code_periods(api_name, start, end)
+    crawl_queue.release_empty(api_name)
+    pro = get_pro_api()
+
+    with RateLimitedExecutor({api_name: TUSHARE_RATE_LIMITS[api_name]}, workers=workers) as executor, \
+            BulkWriter('ts', TUSHARE_TABLES[api_name]) as writer:
+        fetch = lambda job: pro.query(api_name, ts_code=job[0], period=job[1])
+        jobs = crawl_queue.claim(api_name, batch)
+        while jobs:
+            done: List[Tuple[str, str]] = []
+            empty: List[Tuple[str, str]] = []
+            for job, result in executor.map(api_name, fetch, jobs):
+                if isinstance(result, Exception):
+                    crawl_queue.mark_failed(api_name, [job], repr(result))
+                    print(f"{job} 抓取失败: {result!r}")
+                elif result.empty:
+                    empty.append(job)
+                else:
+                    writer.write(result.iloc[0].to_dict())  # 同一报告期有多条记录时，第一条为最新的
+                    done.append(job)
+            writer.flush()
+            crawl_queue.mark_done(api_name, done)
+            crawl_queue.mark_empty(api_name, empty)
+            print(f"{datetime.datetime.now()} {crawl_queue.counts(api_name)}")
+            jobs = crawl_queue.claim(api_name, batch)
+    security_master.register_sources()
+    snapshot.export_database('ts')
+    print(f"{api_name}: 保存{writer.stats['rows']}条, {crawl_queue.counts(api_name)}, {executor.stats}")
+    return writer.stats['rows']
 
 
 if __name__ == '__main__':
-    task_scheduler3('income', 2016, 2020)
+    crawl_statements('income', 2016, 2020)
@@ -0,0 +1,74 @@
+""" 回放录制响应的东方财富盈利预测接口
+
+回放crawl_eastmoney.record_fixtures录制的真实响应（FIXTURE_DIR下的page_<页码>.json），用于离线测试和基准测试
+crawl_eastmoney，不依赖爬虫自己的字段定义，因此接口格式或字段对应关系的错误能够被发现：
+    GET /?pageNumber=1&pageSize=100  ->  page_1.json的原始内容
+
+请求的页数多于录制的页数时（基准测试），循环回放录制的各页，并把其中的总页数改为请求的页数。
+"""
+import json
+import os
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional
+
+from src.stock_data.crawl_eastmoney import FIXTURE_DIR
+
+
+def load_fixtures(directory: str = FIXTURE_DIR) -> List[bytes]:
+    """
+    :return: 按页码排列的录制响应；没有录制文件时抛出FileNotFoundError
+    """
+    names = sorted((name for name in os.listdir(directory) if name.startswith('page_') and name.endswith('.json')),
+                   key=lambda name: int(name[len('page_'):-len('.json')])) if os.path.isdir(directory) else []
+    if not names:
+        raise FileNotFoundError(f"{directory} 中没有录制的响应，先运行 python -m src.stock_data.crawl_eastmoney record")
+    pages = []
+    for name in names:
+        with open(os.path.join(directory, name), 'rb') as f:
+            pages.append(f.read())
+    return pages
+
+
+def _with_total_pages(body: bytes, pages: int) -> bytes:
+    document = json.loads(body.decode('utf-8'))
+    document['result']['pages'] = pages
+    return json.dumps(document, ensure_ascii=False).encode('utf-8')
+
+
+def make_server(pages: Optional[int] = None, latency: float = 0.0, port: int = 0,
+                directory: str = FIXTURE_DIR) -> ThreadingHTTPServer:
+    """
+    创建回放服务器，调用者负责在线程中运行serve_forever，以及shutdown
+
+    :param pages: 总页数，默认为录制的页数；多于录制的页数时循环回放
+    :param latency: 每个请求的延迟（秒）
+    :param port: 端口，0代表任意空闲端口
+    :param directory: 录制文件所在的目录
+
+    :return: server，server.url为服务器的地址
+    """
+    recorded = load_fixtures(directory)
+    pages = pages or len(recorded)
+    bodies = recorded if pages == len(recorded) else [_with_total_pages(body, pages) for body in recorded]
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+            page = int(query.get('pageNumber', ['1'])[0])
+            time.sleep(latency)
+            content = bodies[(page - 1) % len(bodies)] if 1 <= page <= pages else b'{"result": null}'
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    server.url = f'http://127.0.0.1:{server.server_address[1]}/'
+    return server
@@ -0,0 +1,145 @@
+""" 数据库引擎注册表
+
+所有数据访问模块（API、批量任务和爬虫）共用同一个进程内的SQLAlchemy引擎，每个数据库一个。
+引擎在第一次使用时创建，并统一配置连接池和SQLite的pragma；数据库文件的路径不再依赖于当前工作目录。
+
+数据目录的确定顺序：
+1. 环境变量 RIM_DATA_DIR
+2. src/config.py 中的 data_dir
+3. 项目根目录下的 data 目录
+"""
+import os
+import threading
+from typing import Dict
+
+import sqlalchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+
+DATABASES: Dict[str, str] = {
+    'jq': 'jq.db',                  # 聚宽数据：securities, industries, company_info, market_value
+    'ts': 'ts.db',                  # tushare数据：indicator2018, financial_indicator, balancesheet, income
+    'em': 'em1.db',                 # 东方财富数据：profit_forecast
+    'em2': 'em2.db',                # 东方财富爬虫的输出
+    'indicator': 'indicator.db',    # 计算结果：profitability_index, operating_efficiency, rim_value, valuation_feature
+    'crawl': 'crawl.db',            # 爬虫的任务队列：crawl_job
+    'master': 'master.db',          # 证券主表：security_master
+}
+
+SQLITE_PRAGMAS = [
+    'journal_mode = WAL',           # 爬虫写入时，API仍然可以读取
+    'synchronous = NORMAL',         # WAL模式下足够安全，提交时不必每次fsync
+    'cache_size = -65536',          # 每个连接64MB页缓存
+    'temp_store = MEMORY',
+    'mmap_size = 268435456',        # 256MB内存映射读取
+]
+
+_engines: Dict[str, Engine] = {}
+_lock = threading.Lock()
+
+
+def get_data_dir() -> str:
+    """ 数据目录的绝对路径
+    """
+    data_dir = os.environ.get('RIM_DATA_DIR')
+    if data_dir is None:
+        try:
+            from src import config
+            data_dir = getattr(config, 'data_dir', None)
+        except ImportError:
+            data_dir = None
+    if data_dir is None:
+        data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'data')
+    return os.path.abspath(data_dir)
+
+
+def get_data_path(filename: str) -> str:
+    """ 数据目录下某个文件的绝对路径
+    """
+    return os.path.join(get_data_dir(), filename)
+
+
+def get_db_path(name: str) -> str:
+    """ 数据库文件的绝对路径
+
+    :param name: 数据库名称，见DATABASES，例如'ts'
+    """
+    return get_data_path(DATABASES[name])
+
+
+def get_db_version(name: str) -> str:
+    """ 数据库的版本，数据库被写入后版本即发生变化
+
+    版本由三部分组成：数据库文件的inode（文件被整个替换时变化）、PRAGMA schema_version（建表、删表、迁移时变化）
+    和PRAGMA user_version。user_version是写入计数，通过本模块的引擎提交写事务时在同一事务中加一，见_count_writes。
+    三者都保存在数据库文件本身（或者尚未checkpoint的WAL）中，与连接的打开、关闭和checkpoint无关；
+    文件的修改时间则不然：WAL模式下打开连接会创建-wal文件，最后一个连接关闭时又会checkpoint并删除它。
+
+    :param name: 数据库名称，见DATABASES，例如'ts'
+    :return: 版本字符串，例如'1234567.12.345'
+    """
+    path = get_db_path(name)
+    if not os.path.exists(path):
+        raise ValueError(f"{path} 不存在")
+    with get_engine(name).connect() as con:
+        schema_version, user_version = con.execute(sqlalchemy.text(
+            'SELECT schema_version, user_version FROM pragma_schema_version, pragma_user_version')).fetchone()
+    return f'{os.stat(path).st_ino}.{schema_version}.{user_version}'
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(f'PRAGMA {pragma}')
+    cursor.close()
+    connection_record.info['changes'] = dbapi_connection.total_changes
+
+
+def _count_writes(conn) -> None:
+    """ 提交事务之前，若本事务写入过记录（total_changes增加了），在同一事务中把user_version加一
+    """
+    dbapi_connection = conn.connection
+    if dbapi_connection.total_changes != dbapi_connection.info.get('changes', 0):
+        cursor = dbapi_connection.cursor()
+        user_version = cursor.execute('PRAGMA user_version').fetchone()[0]
+        cursor.execute(f'PRAGMA user_version = {user_version + 1}')
+        cursor.close()
+    dbapi_connection.info['changes'] = dbapi_connection.total_changes
+
+
+def _forget_changes(conn) -> None:
+    """ 回滚的写入不计数
+    """
+    conn.connection.info['changes'] = conn.connection.total_changes
+
+
+def get_engine(name: str) -> Engine:
+    """ 获取某个数据库的引擎，同一进程内每个数据库只创建一次
+
+    :param name: 数据库名称，见DATABASES，例如'ts'
+    :return: sqlalchemy engine
+    """
+    engine = _engines.get(name)
+    if engine is None:
+        with _lock:
+            engine = _engines.get(name)
+            if engine is None:
+                engine = sqlalchemy.create_engine(f'sqlite:///{get_db_path(name)}',
+                                                  poolclass=QueuePool, pool_size=5, max_overflow=10,
+                                                  connect_args={'check_same_thread': False, 'timeout': 30})
+                event.listen(engine, 'connect', _set_sqlite_pragmas)
+                event.listen(engine, 'commit', _count_writes)
+                event.listen(engine, 'rollback', _forget_changes)
+                _engines[name] = engine
+    return engine
+
+
+def dispose_engines() -> None:
+    """ 释放所有引擎的连接池，例如在fork出子进程之后
+    """
+    with _lock:
+        for engine in _engines.values():
+            engine.dispose()
+        _engines.clear()
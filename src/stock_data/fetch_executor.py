@@ -0,0 +1,140 @@
+""" 限流的并发抓取执行器
+
+tushare按接口限制每分钟的访问次数。执行器为每个接口维护一个令牌桶，用一个小的线程池并发地发出请求：
+只要令牌桶中有令牌，空闲的线程就立即发出下一个请求，从而用满允许的访问频率，而不是按固定的批次sleep。
+遇到超出限额或者网络等暂时性的错误时，按指数退避重试；重试多次仍然失败的任务作为失败结果返回，不会中断整个抓取。
+"""
+import json
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, Tuple
+
+
+# tushare超出访问频率时的错误信息，例如：抱歉，您每分钟最多访问该接口200次，...
+QUOTA_ERROR_MESSAGES = ('最多访问', '每分钟', '每小时')
+
+
+def is_quota_error(e: BaseException) -> bool:
+    """ 是否为超出接口访问频率的错误
+    """
+    return any(message in str(e) for message in QUOTA_ERROR_MESSAGES)
+
+
+def is_transient_error(e: BaseException) -> bool:
+    """ 是否为值得重试的错误：超出访问频率、网络错误（requests的异常均为OSError的子类）、服务器返回的不是JSON
+    """
+    return is_quota_error(e) or isinstance(e, (OSError, json.JSONDecodeError))
+
+
+class TokenBucket:
+    """ 线程安全的令牌桶，每per秒补充rate个令牌，最多积累capacity个
+
+    任意per秒之内至多发出 rate + capacity 个请求，所以rate应略低于接口的限额
+    """
+
+    def __init__(self, rate: float, per: float = 60.0, capacity: float = 1.0):
+        assert rate > 0 and per > 0 and capacity >= 1
+        self._interval = per / rate          # 每个令牌的秒数
+        self._capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self._capacity, self._tokens + (now - self._updated) / self._interval)
+        self._updated = now
+
+    def acquire(self) -> None:
+        """ 取得一个令牌，没有令牌时阻塞到下一个令牌补充为止
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) * self._interval
+            time.sleep(wait)
+
+    def drain(self) -> None:
+        """ 清空令牌，例如服务器报告超出限额时，让所有线程等待下一个令牌
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens = min(self._tokens, 0)
+
+
+class RateLimitedExecutor:
+    """ 按接口限流、带重试的并发执行器
+
+    :param rates: 接口名称 -> 每per秒允许的访问次数，例如{'income': 70}；未列出的接口不限流
+    :param workers: 线程数
+    :param per: 限流的时间窗口（秒）
+    :param max_retries: 最多重试的次数
+    :param backoff: 第一次重试前等待的秒数，之后每次加倍，最多等待per秒
+    :param retryable: 判断异常是否值得重试的函数
+
+    Examples:
+    --------
+    with RateLimitedExecutor({'income': 70}) as executor:
+        for (code, period), result in executor.map('income', lambda x: pro.income(ts_code=x[0], period=x[1]), jobs):
+            ...
+    """
+
+    def __init__(self, rates: Dict[str, float], workers: int = 4, per: float = 60.0, max_retries: int = 5,
+                 backoff: float = 2.0, retryable: Callable[[BaseException], bool] = is_transient_error):
+        self._buckets = {api: TokenBucket(rate, per) for api, rate in rates.items()}
+        self._pool = ThreadPoolExecutor(workers)
+        self._per = per
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self._retryable = retryable
+        self.stats = {'calls': 0, 'retries': 0, 'failures': 0}
+        self._stats_lock = threading.Lock()
+
+    def _count(self, key: str) -> None:
+        with self._stats_lock:
+            self.stats[key] += 1
+
+    def _call(self, api: str, fn: Callable, args: Tuple, kwargs: Dict) -> Any:
+        bucket: Optional[TokenBucket] = self._buckets.get(api)
+        for attempt in range(self._max_retries + 1):
+            if bucket is not None:
+                bucket.acquire()
+            self._count('calls')
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                if attempt == self._max_retries or not self._retryable(e):
+                    self._count('failures')
+                    raise
+                if bucket is not None and is_quota_error(e):
+                    bucket.drain()
+                self._count('retries')
+                delay = min(self._backoff * 2 ** attempt, self._per)
+                time.sleep(delay * random.uniform(0.5, 1.0))
+
+    def submit(self, api: str, fn: Callable, *args, **kwargs) -> Future:
+        """ 提交一个请求，返回Future；请求在取得api的令牌之后才发出
+        """
+        return self._pool.submit(self._call, api, fn, args, kwargs)
+
+    def map(self, api: str, fn: Callable, items: Iterable) -> Iterator[Tuple[Any, Any]]:
+        """ 对每个item调用fn(item)，按完成的顺序返回(item, 结果)；重试之后仍然失败的，结果为异常对象
+        """
+        futures = {self.submit(api, fn, item): item for item in items}
+        for future in as_completed(futures):
+            e = future.exception()
+            yield futures[future], (future.result() if e is None else e)
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._pool.shutdown(wait=wait)
+
+    def __enter__(self) -> 'RateLimitedExecutor':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.shutdown()
@@ -0,0 +1,188 @@
+""" 紧凑的财务数据面板
+
+缓存中的财务指标和报表原先是以(ts_code, end_date)字符串为多重索引、全部栏位为float64的DataFrame，
+每个uvicorn worker各持有一份。Panel改为：
+    codes           证券id -> ts_code，定长ASCII字节串（每个9字节），已排序，证券id即为其中的位置
+    offsets         证券id为i的行是offsets[i]:offsets[i+1]，int32；每一行的证券id不必保存
+    periods         全部报告期，已排序，int32，例如20181231
+    period_code     每一行的报告期在periods中的位置，int8（报告期超过127个时为int16）
+    data            各栏位，数值栏位降为float32，重复较多的文本栏位为category；行按(证券id, 报告期)排序
+按公司取数据是对codes的二分查找加上对offsets的切片；只在与pandas交界的地方（get、select、to_frame）才转换回字符串索引。
+除了栏位本身，每一行只多占1~2个字节，而DataFrame的多重索引每一行约占3个字节，
+因此只有一个数值栏位的表（例如financial_indicator）也能减少一半左右。
+
+用法：
+    python -m src.stock_data.panel          # 各数据集的内存报告：DataFrame vs Panel
+"""
+import sys
+from typing import Callable, Dict, Iterable
+
+import numpy as np
+import pandas as pd
+
+
+class Panel:
+    """ 以(证券id, 报告期)为行的紧凑面板，见模块说明
+    """
+    __slots__ = ('codes', 'offsets', 'periods', 'period_code', 'data')
+
+    def __init__(self, codes: np.ndarray, offsets: np.ndarray, periods: np.ndarray, period_code: np.ndarray,
+                 data: pd.DataFrame):
+        self.codes = codes
+        self.offsets = offsets
+        self.periods = periods
+        self.period_code = period_code
+        self.data = data
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame, numeric: Iterable[str] = ()) -> 'Panel':
+        """
+        :param df: 多重索引为ts_code/end_date的DataFrame，例如rim_db.load_financial_indicator的返回值
+        :param numeric: 数值栏位，读出来是文本时也转换为float32，例如schema.real_columns的返回值
+        :return: Panel
+        """
+        codes, security_id = np.unique(df.index.get_level_values(0).values.astype(str), return_inverse=True)
+        periods, period_code = np.unique(df.index.get_level_values(1).values.astype(str).astype(np.int64),
+                                         return_inverse=True)
+        order = np.lexsort((period_code, security_id))
+        numeric = set(numeric)
+        data = {column: _compact(df[column].values[order], column in numeric) for column in df.columns}
+        code_type = np.int8 if len(periods) <= np.iinfo(np.int8).max else np.int16
+        offsets = np.searchsorted(security_id[order], np.arange(len(codes) + 1), side='left').astype(np.int32)
+        return cls(codes.astype(np.bytes_), offsets, periods.astype(np.int32), period_code[order].astype(code_type),
+                   pd.DataFrame(data, columns=df.columns))
+
+    def __len__(self) -> int:
+        return len(self.period_code)
+
+    def _end_dates(self, rows) -> np.ndarray:
+        return self.periods[self.period_code[rows]].astype(str)
+
+    def _position(self, code: str) -> int:
+        key = code.encode('ascii', errors='replace')
+        i = int(np.searchsorted(self.codes, key))
+        if i == len(self.codes) or self.codes[i] != key:
+            raise KeyError(code)
+        return i
+
+    def __contains__(self, code: str) -> bool:
+        try:
+            self._position(code)
+            return True
+        except KeyError:
+            return False
+
+    def get(self, code: str) -> pd.DataFrame:
+        """
+        某个公司的全部数据，同 DataFrame.loc[code]
+
+        :param code: ts_code
+        :return: index为end_date（字符串）的DataFrame；不存在时抛出KeyError
+        """
+        i = self._position(code)
+        rows = slice(self.offsets[i], self.offsets[i + 1])
+        return self.data.iloc[rows].set_axis(pd.Index(self._end_dates(rows), name='end_date'), axis=0)
+
+    def select(self, codes: Iterable[str]) -> pd.DataFrame:
+        """
+        若干公司的数据，同 DataFrame.loc[codes]，不存在的公司被忽略
+
+        :return: 多重索引为ts_code/end_date的DataFrame
+        """
+        ids = [self._position(c) for c in codes if c in self]
+        rows = np.concatenate([np.arange(self.offsets[i], self.offsets[i + 1]) for i in ids]) \
+            if ids else np.array([], dtype=int)
+        return self._frame(rows)
+
+    def to_frame(self) -> pd.DataFrame:
+        """ 转换回多重索引为ts_code/end_date的DataFrame
+        """
+        return self._frame(np.arange(len(self)))
+
+    def _frame(self, rows: np.ndarray) -> pd.DataFrame:
+        security_id = np.repeat(np.arange(len(self.codes)), np.diff(self.offsets))
+        index = pd.MultiIndex.from_arrays([self.codes[security_id[rows]].astype(str), self._end_dates(rows)],
+                                          names=['ts_code', 'end_date'])
+        return self.data.iloc[rows].set_axis(index, axis=0)
+
+    def memory_usage(self) -> int:
+        """ 占用的内存（字节）
+        """
+        return int(self.offsets.nbytes + self.periods.nbytes + self.period_code.nbytes
+                   + self.codes.nbytes + self.data.memory_usage(deep=True).sum())
+
+
+def _compact(values: np.ndarray, numeric: bool):
+    """
+    栏位的紧凑表示：浮点数降为float32；数值栏位中的文本（未迁移的数据库中保存为TEXT）转换为float32，不是数字的视为空值；
+    重复较多的文本为category，几乎不重复的文本保持原样，因为这时category比原来的字符串还大
+
+    :param numeric: 是否为数值栏位
+    """
+    if values.dtype.kind == 'f':
+        return values.astype(np.float32)
+    if values.dtype.kind in 'biu':
+        return values
+    if numeric:
+        return pd.to_numeric(values, errors='coerce').astype(np.float32)
+    present = pd.notna(values)
+    if pd.unique(values[present]).size <= present.sum() // 2:
+        return pd.Categorical(values)
+    return values
+
+
+def memory_usage(obj) -> int:
+    """ 数据集占用的内存（字节），支持Panel、DataFrame、Series、dict和list（例如aqi_db中以security_id为下标的列表）
+    """
+    if isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(deep=True).sum())
+    if isinstance(obj, (pd.Series, pd.Index)):
+        return int(obj.memory_usage(deep=True))
+    if hasattr(obj, 'memory_usage'):
+        return obj.memory_usage()       # Panel、SecurityMaster
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(sys.getsizeof(k) + memory_usage(v) for k, v in obj.items())
+    if isinstance(obj, list):
+        return sys.getsizeof(obj) + sum(memory_usage(v) for v in obj if v is not None)
+    if isinstance(obj, tuple):
+        return sys.getsizeof(obj) + sum(sys.getsizeof(v) for v in obj)
+    return sys.getsizeof(obj)
+
+
+def memory_report(datasets: Dict[str, Callable[[], object]]) -> pd.DataFrame:
+    """
+    加载各个数据集并报告其占用的内存
+
+    :param datasets: 数据集名称 -> 加载函数，例如aqi_db.DATASETS
+    :return: index为数据集名称的DataFrame，栏位为type, rows, bytes；加载失败的数据集bytes为空
+    """
+    report = []
+    for name, loader in datasets.items():
+        try:
+            obj = loader()
+            report.append((name, type(obj).__name__, len(obj), memory_usage(obj)))
+        except Exception as e:
+            print(f"{name} 加载失败: {e!r}")
+            report.append((name, None, None, None))
+    return pd.DataFrame(report, columns=['dataset', 'type', 'rows', 'bytes']).set_index('dataset')
+
+
+if __name__ == "__main__":
+    from src.stock_data import rim_db, schema
+
+    frames = {
+        'financial_indicator': rim_db.load_financial_indicator,
+        'balancesheet': lambda: rim_db.load_ts_statement('balancesheet'),
+        'income': lambda: rim_db.load_ts_statement('income'),
+    }
+    for dataset, load in frames.items():
+        frame = load()
+        if frame is None:
+            continue
+        before = memory_usage(frame)
+        after = Panel.from_frame(frame, schema.real_columns('ts', dataset, frame.columns)).memory_usage()
+        print(f"{dataset}: {len(frame)}行, DataFrame {before / 2 ** 20:.1f}MB -> Panel {after / 2 ** 20:.1f}MB "
+              f"({after / before:.0%})")
+
+    from src import aqi_db
+    print(memory_report(aqi_db.DATASETS))
@@ -1,47 +1,38 @@
-from functools import lru_cache
-import datetime
+from collections import namedtuple
 from typing import Tuple, List, Optional
 
 import sqlalchemy
 from sqlalchemy import exc
 import pandas as pd
 
+from src.stock_data import engines, schema, snapshot
+from src.stock_data.panel import Panel
+from src.stock_data.versioned_cache import versioned_cache
+
 
 def get_securities():
-    return pd.read_sql('securities', con=sqlalchemy.create_engine('sqlite:///../../data/jq.db'))
+    return pd.read_sql('securities', con=engines.get_engine('jq'))
 
 
-@lru_cache(maxsize=1)
-def get_profit_forecast(today: str):
-    assert today is not None    # 这个参数是为了cache需要，只要在一个日子中，就不需要重复从数据库拿数据
-    df = pd.read_sql('profit_forecast', con=sqlalchemy.create_engine('sqlite:///../../data/em1.db'))\
+@versioned_cache('em')
+def get_profit_forecast():
+    return pd.read_sql('SELECT code, eps_2019, eps_2020, eps_2021 FROM profit_forecast', con=engines.get_engine('em'))\
         .set_index('code')\
-        .drop('index', axis=1)
-    return df[['eps_2019', 'eps_2020', 'eps_2021']].apply(pd.to_numeric, errors='coerce', downcast='float')
-
+        .apply(pd.to_numeric, errors='coerce')\
+        .astype('float32')
 
-@lru_cache(maxsize=1)
-def get_indicator2018(today: str):
-    assert today is not None    # 这个参数是为了cache需要，只要在一个日子中，就不需要重复从数据库拿数据
-    return pd.read_sql('indicator2018', con=sqlalchemy.create_engine('sqlite:///../../data/ts.db'))\
-        .set_index('ts_code')\
-        .drop('index', axis=1)
 
-
-def _today() -> str:
-    return datetime.datetime.now().strftime("%Y-%m-%d")
+@versioned_cache('ts')
+def get_indicator2018():
+    return snapshot.load_table('ts', 'indicator2018', ['ts_code', 'eps', 'bps'])\
+        .set_index('ts_code')
 
 
-@lru_cache(maxsize=1)
-def get_financial_indicator(today: str = _today()) -> pd.DataFrame:
+def load_financial_indicator() -> pd.DataFrame:
     """
     get the tushare financial indicator from ts.db
     That is a table with ts_code, end_date and grossprofit_margin column
-
-    Parameters
-    ----------
-    today : str
-        today这个参数是为了cache需要，只要在一个日子中，就不需要重复从数据库拿数据
+    每次调用都重新读取，保留float64精度，供批量计算使用
 
     Returns
     -------
@@ -49,37 +40,152 @@ def get_financial_indicator(today: str = _today()) -> pd.DataFrame:
         剔除了毛利率异常的数据（grossprofit_margin<=0 or grossprofit_margin>=100)
         按ts_code、end_date字典序排序
     """
-    return pd.read_sql('SELECT ts_code, end_date, grossprofit_margin FROM financial_indicator \
-                        WHERE 0 <= grossprofit_margin and grossprofit_margin <= 100\
-                        ORDER BY ts_code, end_date',
-                       con=sqlalchemy.create_engine('sqlite:///../../data/ts.db'))\
+    df = snapshot.load_table('ts', 'financial_indicator', ['ts_code', 'end_date', 'grossprofit_margin'])
+    return df[(0 <= df['grossprofit_margin']) & (df['grossprofit_margin'] <= 100)]\
+        .sort_values(['ts_code', 'end_date'])\
+        .set_index(['ts_code', 'end_date'])
+
+
+@versioned_cache('ts')
+def get_financial_indicator() -> Panel:
+    """
+    缓存的财务指标，内容同load_financial_indicator，以紧凑的Panel保存，ts.db被写入之后才会重新读取
+
+    :return: Panel，按公司取数据用get(ts_code)，转换为DataFrame用to_frame()
+    """
+    return Panel.from_frame(load_financial_indicator())
+
+
+Watermark = namedtuple('Watermark', ['rowid', 'rows', 'schema_version', 'ts_code', 'end_date'])
+Watermark.__doc__ = """ 财务指标表的水位，见get_financial_indicator_watermark
+rowid: 最大的rowid，表为空时为0
+rows: 行数
+schema_version: ts.db的PRAGMA schema_version，建表、删表、迁移时都会变化
+ts_code, end_date: rowid最大的那一行的主键，表为空时为None
+"""
+
+
+def get_financial_indicator_watermark() -> Watermark:
+    """
+    财务指标表当前的水位。新爬取的数据总是追加在表的末尾（upsert的记录也会得到新的rowid），
+    rowid大于上次处理时的rowid的即为新数据；其余栏位用于发现表被重建过，见is_appended_since
+
+    :return: Watermark
+    """
+    with engines.get_engine('ts').connect() as con:
+        schema_version = con.execute(sqlalchemy.text('PRAGMA schema_version')).scalar()
+        rowid, rows = con.execute(sqlalchemy.text('SELECT MAX(rowid), COUNT(*) FROM financial_indicator')).fetchone()
+        last = con.execute(sqlalchemy.text('SELECT ts_code, end_date FROM financial_indicator WHERE rowid = :rowid'),
+                           {'rowid': rowid}).fetchone() if rowid is not None else None
+    return Watermark(int(rowid or 0), int(rows), int(schema_version),
+                     *(None, None) if last is None else (str(last[0]), str(last[1])))
+
+
+def is_appended_since(previous: Watermark, current: Watermark) -> bool:
+    """
+    自previous以来，财务指标表是否只是追加（或upsert）了记录，即rowid大于previous.rowid的记录就是全部的变化
+    以下情形都会返回False，应当全量重新计算：
+    1. 表被删除、重建或迁移（schema_version变化），迁移和VACUUM都可能重新编排rowid；
+    2. 行数减少（有记录被删除）或者最大的rowid变小；
+    3. 上次水位所在的那一行的rowid变小或者不存在了，例如rowid被重新编排（upsert只会使其变大）。
+
+    :param previous: 上次计算时的水位，见read_profitability_watermark
+    :param current: 当前的水位，见get_financial_indicator_watermark
+    :return: 是否可以增量计算
+    """
+    if current.schema_version != previous.schema_version or current.rows < previous.rows \
+            or current.rowid < previous.rowid:
+        return False
+    if previous.ts_code is None:
+        return True
+    with engines.get_engine('ts').connect() as con:
+        rowid = con.execute(sqlalchemy.text('SELECT rowid FROM financial_indicator '
+                                            'WHERE ts_code = :ts_code AND end_date = :end_date'),
+                            {'ts_code': previous.ts_code, 'end_date': previous.end_date}).scalar()
+    return rowid is not None and rowid >= previous.rowid
+
+
+def get_financial_indicator_changed_codes(since_rowid: int) -> List[str]:
+    """
+    rowid大于since_rowid的财务指标（即新爬取的数据）所涉及的公司代码
+
+    :param since_rowid: 上次处理时的最大rowid
+    :return: 符合tushare要求的公司代码列表
+    """
+    return pd.read_sql(sqlalchemy.text('SELECT DISTINCT ts_code FROM financial_indicator WHERE rowid > :since'),
+                       con=engines.get_engine('ts'), params={'since': int(since_rowid)})['ts_code'].tolist()
+
+
+def get_financial_indicator_of(ts_codes: List[str]) -> pd.DataFrame:
+    """
+    读取若干公司的财务指标，格式同load_financial_indicator
+
+    :param ts_codes: 符合tushare要求的公司代码列表
+    :return: DataFrame，多重索引为ts_code/end_date，栏位为grossprofit_margin
+    """
+    sql = sqlalchemy.text('SELECT ts_code, end_date, grossprofit_margin FROM financial_indicator '
+                          'WHERE ts_code IN :codes AND 0 <= grossprofit_margin AND grossprofit_margin <= 100 '
+                          'ORDER BY ts_code, end_date')\
+        .bindparams(sqlalchemy.bindparam('codes', expanding=True))
+    return pd.read_sql(sql, con=engines.get_engine('ts'), params={'codes': list(ts_codes)})\
         .set_index(['ts_code', 'end_date'])
 
 
-@lru_cache(maxsize=1)
-def get_ts_statement(name: str, today: str = _today()) -> Optional[pd.DataFrame]:
+def load_roe(ts_code: str) -> pd.DataFrame:
+    """
+    读取某个公司各报告期的ROE，每次调用都从ts.db读取
+
+    :param ts_code: 符合tushare要求的公司代码
+    :return: DataFrame，index为end_date，栏位为roe；没有此公司的数据时为空表
+    """
+    return pd.read_sql(sqlalchemy.text('SELECT end_date, roe FROM financial_indicator WHERE ts_code = :code'),
+                       con=engines.get_engine('ts'), params={'code': ts_code})\
+        .set_index('end_date')
+
+
+def load_ts_statement(name: str, columns: Optional[Tuple[str, ...]] = None) -> Optional[pd.DataFrame]:
     """
-    get the statement from ts.db
+    get the statement from ts.db, 每次调用都重新读取，保留float64精度，供批量计算使用
 
     Parameters
     ----------
     name: str
         statement name, for example, 'balancesheet'
-    today : str
-        today这个参数是为了cache需要，只要在一个日子中，就不需要重复从数据库拿数据
+    columns : tuple of str, optional
+        只读取这些栏位，必须包含ts_code和end_date；默认读取全部栏位
 
     Returns
     -------
     table : DataFrame
     """
     try:
-        df = pd.read_sql(f'SELECT * FROM {name}', con=sqlalchemy.create_engine('sqlite:///../../data/ts.db')) \
+        df = snapshot.load_table('ts', name, columns) \
             .set_index(['ts_code', 'end_date'])
-    except exc.OperationalError as e:
+    except (exc.OperationalError, pd.io.sql.DatabaseError):
         df = None
     return df
 
 
+# get_ts_statement至多缓存多少组(报表, 栏位)
+STATEMENT_CACHE_SIZE = 8
+
+
+def get_ts_statement(name: str, columns: Optional[Tuple[str, ...]] = None) -> Optional[Panel]:
+    """
+    缓存的报表，内容同load_ts_statement，以紧凑的Panel保存，ts.db被写入之后才会重新读取
+    栏位不分先后，同一组栏位的不同顺序共用一个缓存项
+
+    :return: Panel；数据表不存在时返回None
+    """
+    return _get_ts_statement(name, None if columns is None else tuple(sorted(set(columns))))
+
+
+@versioned_cache('ts', maxsize=STATEMENT_CACHE_SIZE)
+def _get_ts_statement(name: str, columns: Optional[Tuple[str, ...]]) -> Optional[Panel]:
+    df = load_ts_statement(name, columns)
+    return None if df is None else Panel.from_frame(df, schema.real_columns('ts', name, df.columns))
+
+
 def get_financial_indicator_by_code(code: str) -> pd.DataFrame:
     """ 获取某个公司最近数年的财务指标
     输入假设：
@@ -87,36 +193,156 @@ def get_financial_indicator_by_code(code: str) -> pd.DataFrame:
     输出规定:
     列名同tushare的财务指标表格，包含了code的所有数据
     """
-    return get_financial_indicator().loc[code]
+    return get_financial_indicator().get(code)
 
 
-def save_profitability_index_to_db(data: List[Tuple[str, float, int, float, int]]) -> None:
+def save_profitability_index_to_db(index: pd.DataFrame, quantile_table: pd.DataFrame, watermark: Watermark) -> None:
     """
-    把各个公司代码、盈利增长指标、盈利增长百分位、盈利稳定指标、盈利稳定百分位等信息保存到数据库
+    把各个公司代码、盈利增长指标、盈利增长百分位、盈利稳定指标、盈利稳定百分位等信息，以及全市场的分位表保存到数据库
 
-    :param data: list of tuple
-                元组中第一项为公司代码，以后依次为ms, ms rank，mg，mg rank
+    :param index: DataFrame，index为公司代码，栏位依次为mg, mg_rank, ms, ms_rank
+    :param quantile_table: DataFrame，index为分位点的序号，栏位为mg和ms的分位表
+    :param watermark: 计算所依据的财务指标的水位，见get_financial_indicator_watermark
 
     :return: None
     """
-    p = pd.DataFrame(data, columns=['ts_code', 'mg', 'mg_rank', 'ms', 'ms_rank']).set_index('ts_code')
-    p.to_sql('profitability_index', con=sqlalchemy.create_engine('sqlite:///../../data/indicator.db'),
-             if_exists='replace')
+    with engines.get_engine('indicator').begin() as con:
+        index.to_sql('profitability_index', con=con, if_exists='replace')
+        quantile_table.to_sql('profitability_quantile', con=con, if_exists='replace')
+        pd.DataFrame([watermark._asdict()]).add_prefix('source_')\
+            .to_sql('profitability_state', con=con, if_exists='replace', index=False)
+
+
+def read_profitability_watermark() -> Optional[Watermark]:
+    """
+    上次计算盈利能力指标时所依据的财务指标的水位
 
+    :return: Watermark；若从未保存过，或者是只记录了rowid的旧版本状态，返回None
+    """
+    columns = ', '.join(f'source_{field}' for field in Watermark._fields)
+    try:
+        with engines.get_engine('indicator').connect() as con:
+            row = con.execute(sqlalchemy.text(f'SELECT {columns} FROM profitability_state')).fetchone()
+    except exc.OperationalError:
+        return None
+    if row is None:
+        return None
+    rowid, rows, schema_version, ts_code, end_date = row
+    return Watermark(int(rowid), int(rows), int(schema_version), ts_code, end_date)
 
-@lru_cache(maxsize=1)
-def read_profitability_index(today: str = _today()) -> pd.DataFrame:
+
+def load_profitability_index() -> pd.DataFrame:
     """
     从indicator数据库中读取盈利能力指标，包括了盈利增长指标和其全市场百分位，盈利稳定性指标和其全市场百分位
+    每次调用都重新读取，供批量计算使用
 
-    :param today: 日期字符串
-                    此参数主要是为了cache，一般盈利能力指标在日内是不会变化的
     :return: index为ts_code的DataFrame，有4各栏位mg, mg_rank, ms and ms_rank
     """
-    return pd.read_sql('profitability_index', con=sqlalchemy.create_engine('sqlite:///../../data/indicator.db'))\
+    return pd.read_sql('profitability_index', con=engines.get_engine('indicator'))\
+        .set_index('ts_code')
+
+
+@versioned_cache('indicator')
+def read_profitability_index() -> pd.DataFrame:
+    """
+    缓存的盈利能力指标，内容同load_profitability_index，indicator.db被写入之后才会重新读取
+    """
+    return load_profitability_index()
+
+
+@versioned_cache('indicator')
+def read_profitability_quantiles() -> pd.DataFrame:
+    """
+    从indicator数据库中读取全市场盈利增长指标和盈利稳定指标的分位表
+
+    :return: index为分位点序号的DataFrame，有2个栏位mg和ms，均为升序
+    """
+    return pd.read_sql('SELECT * FROM profitability_quantile ORDER BY percentile', con=engines.get_engine('indicator'))\
+        .set_index('percentile')
+
+
+def save_operating_efficiency_to_db(index: pd.DataFrame) -> None:
+    """
+    把各个公司最近年度的经营资产、经营负债、净经营资产、经营资产周转率及其增加值和行业排序保存到数据库
+
+    :param index: DataFrame，index为ts_code，栏位见operating_efficiency._rank_in_industry
+
+    :return: None
+    """
+    index.to_sql('operating_efficiency', con=engines.get_engine('indicator'), if_exists='replace')
+
+
+@versioned_cache('indicator')
+def read_operating_efficiency() -> pd.DataFrame:
+    """
+    从indicator数据库中读取经营效率指标，indicator.db被写入之后才会重新读取
+
+    :return: index为ts_code的DataFrame，栏位包括noa, ato, delta_ato, sw_l2, industry_rank, industry_count等
+    """
+    return pd.read_sql('operating_efficiency', con=engines.get_engine('indicator'))\
         .set_index('ts_code')
 
 
+def get_data_version(databases: Tuple[str, ...] = ('ts', 'em', 'jq')) -> str:
+    """
+    数据版本，由各个数据库的版本组成（见engines.get_db_version），任何一个数据库被写入后，版本号即发生变化
+
+    :param databases: 数据库名称，见engines.DATABASES
+    :return: 版本字符串，例如'ts=1234567.12.345,em=1234568.3.20,jq=1234569.8.7'
+    """
+    return ','.join(f'{name}={engines.get_db_version(name)}' for name in databases)
+
+
+def get_sw_industry() -> pd.DataFrame:
+    """
+    获取全市场上市公司的申万二级行业代码
+
+    :return: index为6位数公司代码的DataFrame，包含sw_l2栏位
+    """
+    df = pd.read_sql('SELECT code, sw_l2 FROM industries', con=engines.get_engine('jq'))
+    df['code'] = df['code'].str[:6]
+    return df.set_index('code')
+
+
+def get_sw_industry_roe() -> pd.DataFrame:
+    """
+    读入截止2018年申万二级行业的平均净资产收益率，数据来源同aqi_db.get_sw_industry_roe
+
+    :return: index为6位数申万行业代码的DataFrame，包含industry_name和industry_roe栏位
+    """
+    df = pd.read_csv(engines.get_data_path('wind_sw_industry_roe.csv'), encoding='GBK')[['代码', '行业名称', 'mean']]
+    df['代码'] = df['代码'].str[:6]
+    return pd.DataFrame({'industry_name': df['行业名称'].values, 'industry_roe': df['mean'].values / 100},
+                        index=pd.Index(df['代码'].values, name='sw_l2'))
+
+
+def get_market_value() -> pd.DataFrame:
+    """
+    获取全市场上市公司最近交易日的市值
+
+    :return: index为聚宽风格公司代码的DataFrame，包含market_cap栏位
+    """
+    return pd.read_sql('SELECT code, market_cap FROM market_value', con=engines.get_engine('jq'))\
+        .set_index('code')
+
+
+def save_rim_value_to_db(values: pd.DataFrame, features: pd.DataFrame, data_version: str) -> None:
+    """
+    把全市场的剩余收益估值和估值特征表保存到数据库；估值特征表取代了原先的rim_proposal表
+
+    :param values: 多重索引为code/rr/gr的DataFrame，栏位为bps2018及各项估值结果
+    :param features: index为code的DataFrame，栏位见business.rim.FEATURE_COLUMNS
+    :param data_version: 计算所依据的数据版本，见get_data_version
+
+    :return: None
+    """
+    engine = engines.get_engine('indicator')
+    values.assign(data_version=data_version).to_sql('rim_value', con=engine, if_exists='replace')
+    schema.replace_table('indicator', 'valuation_feature', features.assign(data_version=data_version).reset_index())
+    with engine.begin() as con:
+        con.execute(sqlalchemy.text('DROP TABLE IF EXISTS rim_proposal'))
+
+
 if __name__ == "__main__":
-    df = get_financial_indicator()
-    print(df)
+    panel = get_financial_indicator()
+    print(panel.to_frame())
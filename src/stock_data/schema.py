@@ -0,0 +1,223 @@
+""" 数据表的结构
+
+原先数据表都由DataFrame.to_sql隐式地创建：多出一个无意义的index栏位，数值经常被保存为TEXT，也没有任何索引。
+这里为爬虫写入的数据表声明结构：主键、TEXT和INTEGER栏位（其余栏位为REAL）以及额外的覆盖索引。
+BulkWriter和replace_table按照这里的结构建表；migrate把已有的数据库文件迁移到这里的结构。
+
+用法：
+    python -m src.stock_data.schema [数据库名称 ...]       # 迁移数据库，默认为ts、jq、em和em2
+"""
+import math
+from collections import namedtuple
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import pandas as pd
+import sqlalchemy
+
+from src.stock_data import engines
+
+TableSchema = namedtuple('TableSchema', ['key', 'text', 'integer', 'indexes', 'renames'])
+TableSchema.__new__.__defaults__ = ((), (), {}, {})
+TableSchema.__doc__ = """ 数据表的结构
+key: 主键的栏位
+text: TEXT栏位（主键的栏位、名称以_date结尾的栏位也是TEXT），'*'代表全部栏位
+integer: INTEGER栏位，其余栏位均为REAL
+indexes: 索引名称 -> 栏位
+renames: 迁移时需要改名的栏位，例如to_sql把DataFrame的index保存为'index'栏位
+"""
+
+_STATEMENT_TEXT = ('ann_date', 'f_ann_date', 'report_type', 'comp_type', 'end_type', 'update_flag')
+_FORECAST = TableSchema(key=('code',), text=('crawled_at',),
+                        integer=('number_of_reports', 'rank_buy', 'rank_increase', 'rank_neutral', 'rank_reduction',
+                                 'rank_sell_out'))
+
+SCHEMAS: Dict[Tuple[str, str], TableSchema] = {
+    ('ts', 'financial_indicator'): TableSchema(
+        key=('ts_code', 'end_date'), text=_STATEMENT_TEXT,
+        indexes={'ix_financial_indicator_gm': ('ts_code', 'end_date', 'grossprofit_margin')}),
+    ('ts', 'balancesheet'): TableSchema(key=('ts_code', 'end_date'), text=_STATEMENT_TEXT),
+    ('ts', 'income'): TableSchema(key=('ts_code', 'end_date'), text=_STATEMENT_TEXT,
+                                  indexes={'ix_income_revenue': ('ts_code', 'end_date', 'revenue')}),
+    ('ts', 'indicator2018'): TableSchema(key=('ts_code',), text=_STATEMENT_TEXT),
+    ('jq', 'securities'): TableSchema(key=('code',), text=('display_name', 'name', 'type'),
+                                      renames={'index': 'code'}),
+    ('jq', 'industries'): TableSchema(key=('code',), text=('*',)),
+    ('jq', 'company_info'): TableSchema(key=('code',), text=('*',)),
+    ('jq', 'market_value'): TableSchema(key=('code',), text=('day',)),
+    ('em', 'profit_forecast'): _FORECAST,
+    ('em2', 'profit_forecast'): _FORECAST,
+    ('indicator', 'valuation_feature'): TableSchema(key=('code',), text=('sw_l2', 'industry_name', 'data_version')),
+}
+
+# 迁移时视为空值的文本
+_NULL_TEXTS = {'', '-', '--', 'None', 'nan', 'NaN'}
+
+
+def get_schema(db: str, table: str) -> Optional[TableSchema]:
+    """ 数据表的结构，没有声明结构的数据表返回None
+    """
+    return SCHEMAS.get((db, table))
+
+
+def column_type(schema: TableSchema, column: str) -> str:
+    """ 栏位的SQLite类型：TEXT、INTEGER或者REAL
+    """
+    if column in schema.key or column in schema.text or '*' in schema.text or column.endswith('_date'):
+        return 'TEXT'
+    return 'INTEGER' if column in schema.integer else 'REAL'
+
+
+
+def real_columns(db: str, table: str, columns: Iterable[str]) -> List[str]:
+    """ columns中按结构应当是REAL的栏位；没有声明结构的数据表返回空列表
+    """
+    schema = get_schema(db, table)
+    return [] if schema is None else [column for column in columns if column_type(schema, column) == 'REAL']
+
+
+def _quote(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def create_table(con, table: str, schema: TableSchema, columns: Sequence[str],
+                 types: Optional[Dict[str, str]] = None) -> None:
+    """
+    按照结构建表和索引，主键的栏位排在最前面
+
+    :param con: sqlalchemy connection，在调用者的事务中执行
+    :param table: 表名
+    :param schema: 数据表的结构
+    :param columns: 栏位
+    :param types: 覆盖column_type推断的类型
+    """
+    types = types or {}
+    columns = list(schema.key) + [c for c in columns if c not in schema.key]
+    definitions = [f'{_quote(c)} {types.get(c, column_type(schema, c))}' + (' NOT NULL' if c in schema.key else '')
+                   for c in columns]
+    definitions.append(f"PRIMARY KEY ({', '.join(_quote(k) for k in schema.key)})")
+    con.execute(sqlalchemy.text(f"CREATE TABLE {_quote(table)} ({', '.join(definitions)})"))
+    create_indexes(con, table, schema)
+
+
+def create_indexes(con, table: str, schema: TableSchema) -> None:
+    for name, index_columns in schema.indexes.items():
+        con.execute(sqlalchemy.text(f'CREATE INDEX IF NOT EXISTS {_quote(name)} ON {_quote(table)} '
+                                    f"({', '.join(_quote(c) for c in index_columns)})"))
+
+
+def _to_text(value):
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return None
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))      # 例如被保存为REAL的日期20181231.0
+    value = str(value)
+    return None if value.strip() in _NULL_TEXTS else value
+
+
+def _convert(df: pd.DataFrame, schema: TableSchema) -> Tuple[pd.DataFrame, Dict[str, str]]:
+    """
+    把DataFrame的各栏位转换为结构规定的类型；若某个数值栏位中有无法转换的文本，保留为TEXT以免丢失数据
+
+    :return: 转换后的DataFrame（空值为None），以及实际采用的类型
+    """
+    types: Dict[str, str] = {}
+    converted = {}
+    for column in df.columns:
+        values = df[column]
+        sql_type = column_type(schema, column)
+        if sql_type != 'TEXT':
+            text = values if values.dtype.kind in 'biufc' else values.map(_to_text)
+            numeric = pd.to_numeric(text, errors='coerce')
+            if (numeric.isna() & text.notna()).any():
+                print(f"{column}: 存在无法转换为数值的数据，保留为TEXT")
+                sql_type = 'TEXT'
+            else:
+                values = numeric
+        if sql_type == 'TEXT':
+            values = values.map(_to_text)
+        types[column] = sql_type
+        converted[column] = values.astype(object).where(values.notna(), None)
+    return pd.DataFrame(converted, columns=df.columns), types
+
+
+def _insert(con, table: str, df: pd.DataFrame, chunksize: int = 10000) -> None:
+    columns = list(df.columns)
+    sql = f"INSERT OR REPLACE INTO {_quote(table)} ({', '.join(_quote(c) for c in columns)}) " \
+          f"VALUES ({', '.join(f':p{i}' for i in range(len(columns)))})"
+    for start in range(0, len(df), chunksize):
+        con.execute(sqlalchemy.text(sql),
+                    [{f'p{i}': v for i, v in enumerate(row)}
+                     for row in df.iloc[start:start + chunksize].itertuples(index=False, name=None)])
+
+
+def replace_table(db: str, table: str, df: pd.DataFrame) -> None:
+    """
+    在一个事务中用df替换整个数据表，表按照声明的结构创建；代替to_sql(if_exists='replace')
+
+    :param db: 数据库名称，见engines.DATABASES
+    :param table: 表名，必须在SCHEMAS中声明
+    :param df: DataFrame，栏位必须包含主键
+    """
+    schema = SCHEMAS[(db, table)]
+    df, types = _convert(df, schema)
+    with engines.get_engine(db).begin() as con:
+        con.execute(sqlalchemy.text(f'DROP TABLE IF EXISTS {_quote(table)}'))
+        create_table(con, table, schema, list(df.columns), types)
+        _insert(con, table, df)
+
+
+def _is_migrated(con, table: str, schema: TableSchema) -> bool:
+    info = con.execute(sqlalchemy.text(f'PRAGMA table_info({_quote(table)})')).fetchall()
+    primary_key = tuple(r[1] for r in sorted((r for r in info if r[5] > 0), key=lambda r: r[5]))
+    return primary_key == tuple(schema.key)
+
+
+def migrate_table(db: str, table: str) -> bool:
+    """
+    把已有的数据表迁移到声明的结构：去掉index栏位，转换类型，按主键去重（保留最后写入的记录），建立主键和索引
+    整个迁移在一个事务中完成
+
+    :return: 是否进行了迁移；数据表不存在或者已经迁移过时返回False
+    """
+    schema = SCHEMAS[(db, table)]
+    engine = engines.get_engine(db)
+    with engine.begin() as con:
+        if not engine.dialect.has_table(con, table) or _is_migrated(con, table, schema):
+            return False
+        df = pd.read_sql(sqlalchemy.text(f'SELECT * FROM {_quote(table)} ORDER BY rowid'), con=con)\
+            .rename(columns=schema.renames)
+        df = df.drop(columns=[c for c in ('index', 'level_0') if c in df.columns])
+        df, types = _convert(df, schema)
+        df = df.dropna(subset=list(schema.key)).drop_duplicates(subset=list(schema.key), keep='last')
+
+        tmp = f'{table}__migrating'
+        con.execute(sqlalchemy.text(f'DROP TABLE IF EXISTS {_quote(tmp)}'))
+        create_table(con, tmp, schema._replace(indexes={}), list(df.columns), types)
+        _insert(con, tmp, df)
+        con.execute(sqlalchemy.text(f'DROP TABLE {_quote(table)}'))
+        con.execute(sqlalchemy.text(f'ALTER TABLE {_quote(tmp)} RENAME TO {_quote(table)}'))
+        create_indexes(con, table, schema)
+    return True
+
+
+def migrate(databases: Iterable[str] = ('ts', 'jq', 'em', 'em2')) -> List[Tuple[str, str]]:
+    """
+    迁移数据库中所有声明了结构的数据表，然后VACUUM以回收空间（WAL日志模式见engines.SQLITE_PRAGMAS）
+
+    :return: 进行了迁移的(数据库名称, 表名)
+    """
+    migrated = []
+    for db in databases:
+        for (schema_db, table) in SCHEMAS:
+            if schema_db == db and migrate_table(db, table):
+                migrated.append((db, table))
+        with engines.get_engine(db).connect() as con:
+            con.execute(sqlalchemy.text('VACUUM'))
+    return migrated
+
+
+if __name__ == "__main__":
+    import sys
+
+    for db_name, table_name in migrate(sys.argv[1:] or ('ts', 'jq', 'em', 'em2')):
+        print(f"已迁移 {db_name}.{table_name}")
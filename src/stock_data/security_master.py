@@ -0,0 +1,267 @@
+""" 证券主表
+
+三个数据来源的证券代码格式各不相同：
+    聚宽        600000.XSHG, 000001.XSHE
+    tushare     600000.SH, 000001.SZ
+    东方财富     600000
+它们的前6位总是相同的。证券主表为各个数据来源出现过的每个证券分配一个稠密的整数id（security_id，从0开始），
+各数据集以security_id为索引之后，跨数据来源的关联就是数组下标运算，不再需要逐个拼接、截取和散列字符串。
+批量的代码转换（normalize、SecurityMaster.ids）都是向量化的。
+
+security_id保存在独立的master.db中，只增不改：新出现的证券追加在末尾，已有证券的id永远不变。
+因此各个数据集可以各自缓存、各自重新加载，而不会因为证券主表的重新加载而错位。
+
+登记新证券（写master.db）由写入数据的一方负责：爬虫在写入之后、批处理在计算之前调用register_sources，
+API启动时也登记一次；API读取数据时只读master.db（read_security_master、get_security_master）。
+
+用法：
+    python -m src.stock_data.security_master          # 登记新证券，并做基准测试：字符串关联 vs security_id关联
+"""
+import functools
+import sys
+from typing import Iterable, List
+
+import numpy as np
+import pandas as pd
+import sqlalchemy
+from sqlalchemy import exc
+
+from src.stock_data import engines
+from src.stock_data.versioned_cache import versioned_cache
+
+# 交易所 -> (tushare后缀, 聚宽后缀)
+EXCHANGES = {'SH': ('.SH', '.XSHG'), 'SZ': ('.SZ', '.XSHE')}
+_JQ_EXCHANGES = {jq: exchange for exchange, (_, jq) in EXCHANGES.items()}
+
+# 证券主表的代码来源：(数据库名称, SQL)
+CODE_SOURCES = [
+    ('jq', 'SELECT code FROM securities'),
+    ('ts', 'SELECT ts_code FROM indicator2018'),
+    ('ts', 'SELECT DISTINCT ts_code FROM financial_indicator'),
+    ('em', 'SELECT code FROM profit_forecast'),
+]
+
+_SCHEMA = '''CREATE TABLE IF NOT EXISTS security_master (
+    security_id INTEGER PRIMARY KEY,
+    code TEXT NOT NULL UNIQUE,
+    exchange TEXT NOT NULL)'''
+
+_REGISTER = '''INSERT OR IGNORE INTO security_master (security_id, code, exchange)
+    SELECT COALESCE(MAX(security_id) + 1, 0), :code, :exchange FROM security_master'''
+
+
+def normalize(codes: Iterable[str]) -> np.ndarray:
+    """
+    把任意格式的证券代码转换为6位数代码，向量化：numpy转换为定长的'<U6'时截去后缀
+
+    :param codes: 聚宽、tushare或东方财富格式的代码
+    :return: dtype为'<U6'的数组
+    """
+    if not isinstance(codes, (np.ndarray, pd.Index, pd.Series)):
+        codes = list(codes)
+    return np.asarray(codes, dtype=str).astype('U6')
+
+
+def default_exchange(code: str) -> str:
+    """ 根据6位数代码推断交易所，没有聚宽代码时使用：6开头的为上交所，其余为深交所
+    """
+    return 'SH' if code[0] == '6' else 'SZ'
+
+
+def to_ts_code(code: str) -> str:
+    """ 任意格式的代码转换为tushare风格
+    """
+    return code[:6] + EXCHANGES[default_exchange(code)][0]
+
+
+def to_ts_codes(codes: Iterable[str]) -> np.ndarray:
+    """ 批量转换为tushare风格，向量化，规则同to_ts_code
+    """
+    normalized = normalize(codes)
+    return np.char.add(normalized, np.where(np.char.startswith(normalized, '6'), '.SH', '.SZ')).astype(object)
+
+
+def to_jq_code(code: str) -> str:
+    """ 任意格式的代码转换为聚宽风格
+    """
+    return code[:6] + EXCHANGES[default_exchange(code)][1]
+
+
+class SecurityMaster:
+    """ 内存中的证券主表
+
+    :param codes: 6位数代码，codes[security_id]即为该证券的代码
+    :param exchanges: 每个证券的交易所，'SH'或'SZ'
+    """
+    __slots__ = ('codes', 'ts_codes', 'jq_codes', '_order', '_sorted', '_ids')
+
+    def __init__(self, codes: np.ndarray, exchanges: np.ndarray):
+        self.codes = np.asarray(codes, dtype='U6')
+        is_sh = np.asarray(exchanges) == 'SH'
+        self.ts_codes = np.char.add(self.codes, np.where(is_sh, '.SH', '.SZ')).astype(object)
+        self.jq_codes = np.char.add(self.codes, np.where(is_sh, '.XSHG', '.XSHE')).astype(object)
+        self._order = np.argsort(self.codes, kind='stable').astype(np.int32)
+        self._sorted = self.codes[self._order]
+        self._ids = {code: i for i, code in enumerate(self.codes.tolist())}
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def __contains__(self, code: str) -> bool:
+        return code[:6] in self._ids
+
+    def memory_usage(self) -> int:
+        """ 占用的内存（字节）
+        """
+        return int(self.codes.nbytes + self._order.nbytes + self._sorted.nbytes + sys.getsizeof(self._ids)
+                   + sum(sys.getsizeof(c) for c in self.ts_codes) + sum(sys.getsizeof(c) for c in self.jq_codes)
+                   + self.ts_codes.nbytes + self.jq_codes.nbytes)
+
+    def id_of(self, code: str) -> int:
+        """
+        :param code: 任意格式的证券代码
+        :return: security_id，不存在时抛出KeyError
+        """
+        return self._ids[code[:6]]
+
+    def ids(self, codes: Iterable[str]) -> np.ndarray:
+        """
+        批量转换为security_id，向量化
+
+        :param codes: 任意格式的证券代码
+        :return: int32数组，不存在的证券为-1
+        """
+        normalized = normalize(codes)
+        if len(self) == 0:
+            return np.full(len(normalized), -1, dtype=np.int32)
+        positions = np.searchsorted(self._sorted, normalized).clip(max=len(self) - 1)
+        return np.where(self._sorted[positions] == normalized, self._order[positions], -1).astype(np.int32)
+
+    def index_by_id(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        以security_id重新索引以证券代码为index的数据集，不在主表中的证券被剔除，代码重复时保留第一条
+
+        :param df: index为任意格式证券代码的DataFrame
+        :return: index为security_id（已排序）的DataFrame
+        """
+        ids = self.ids(df.index)
+        keep = ids >= 0
+        df = df[keep].set_axis(pd.Index(ids[keep], name='security_id'), axis=0)
+        return df[~df.index.duplicated(keep='first')].sort_index()
+
+
+def take(df: pd.DataFrame, ids: np.ndarray) -> pd.DataFrame:
+    """
+    按security_id取出index_by_id返回的数据集的若干行，即跨数据集的关联
+
+    :param df: index为security_id的DataFrame
+    :param ids: security_id数组，可以包含-1
+    :return: 行与ids一一对应、index为ids的DataFrame，不存在的行为空值
+    """
+    return df.reindex(pd.Index(ids, name='security_id'))
+
+
+@functools.lru_cache(maxsize=None)
+def _create_schema(path: str) -> None:
+    with engines.get_engine('master').begin() as con:
+        con.execute(sqlalchemy.text(_SCHEMA))
+
+
+def _engine():
+    _create_schema(engines.get_db_path('master'))
+    return engines.get_engine('master')
+
+
+def _read_codes(db: str, sql: str) -> List[str]:
+    try:
+        with engines.get_engine(db).connect() as con:
+            return [row[0] for row in con.execute(sqlalchemy.text(sql)) if row[0]]
+    except exc.OperationalError:
+        return []
+
+
+def register(codes: Iterable[str]) -> int:
+    """
+    为新出现的证券分配security_id，已登记的证券保持不变；聚宽代码的后缀决定交易所，否则按default_exchange推断
+
+    多个线程或进程可以同时登记：每一行的id在同一条INSERT语句中取为MAX(security_id) + 1，由SQLite的写锁串行化，
+    已被别人登记的代码被忽略（INSERT OR IGNORE），因此id总是稠密、唯一的
+
+    :param codes: 任意格式、可以重复的证券代码
+    :return: 新登记的证券数
+    """
+    codes = pd.Series(list(codes), dtype=object).astype(str)
+    df = pd.DataFrame({'code': normalize(codes.values), 'exchange': codes.str[6:].map(_JQ_EXCHANGES).values})\
+        .sort_values(['code', 'exchange'])\
+        .drop_duplicates('code')
+    with _engine().connect() as con:
+        known = {row[0] for row in con.execute(sqlalchemy.text('SELECT code FROM security_master'))}
+    new = df[~df['code'].isin(known)]
+    if len(new) == 0:
+        return 0        # 没有新证券时不写master.db
+    with _engine().begin() as con:
+        result = con.execute(sqlalchemy.text(_REGISTER),
+                             [{'code': code, 'exchange': exchange if isinstance(exchange, str) else default_exchange(code)}
+                              for code, exchange in new.itertuples(index=False, name=None)])
+        return max(result.rowcount, 0)
+
+
+def register_sources() -> int:
+    """ 登记CODE_SOURCES中新出现的证券，写入数据之后调用
+
+    :return: 新登记的证券数
+    """
+    return register(code for db, sql in CODE_SOURCES for code in _read_codes(db, sql))
+
+
+def read_security_master() -> SecurityMaster:
+    """ 读取证券主表，只读，不登记新证券；每次调用都重新读取
+    """
+    df = pd.read_sql('SELECT code, exchange FROM security_master ORDER BY security_id', con=_engine())
+    return SecurityMaster(df['code'].values, df['exchange'].values)
+
+
+def load_security_master() -> SecurityMaster:
+    """ 批处理使用：登记CODE_SOURCES中新出现的证券，然后读取证券主表，每次调用都重新读取
+    """
+    register_sources()
+    return read_security_master()
+
+
+@versioned_cache('master')
+def get_security_master() -> SecurityMaster:
+    """ 缓存的证券主表，只读，master.db被写入（登记了新证券）之后才会重新读取
+    """
+    return read_security_master()
+
+
+if __name__ == "__main__":
+    import time
+
+    start = time.perf_counter()
+    print(f"证券主表: {len(load_security_master())}个证券, {time.perf_counter() - start:.3f}s")
+
+    rng = np.random.default_rng(0)
+    ts_codes = [to_ts_code(f'{n:06d}') for n in rng.choice(np.arange(1, 700000), 4000, replace=False)]
+    master = SecurityMaster(normalize(ts_codes), np.array([default_exchange(c) for c in ts_codes]))
+    forecast = pd.DataFrame({'eps': rng.normal(size=4000)}, index=[c[:6] for c in ts_codes]).sample(frac=1)
+    indicator = pd.DataFrame({'bps': rng.normal(size=4000)}, index=ts_codes)
+
+    start = time.perf_counter()
+    for _ in range(20):
+        joined = indicator.set_axis(indicator.index.map(lambda x: x[:6]), axis=0).join(forecast, how='inner')
+    string_join = (time.perf_counter() - start) / 20
+
+    forecast_by_id, indicator_by_id = master.index_by_id(forecast), master.index_by_id(indicator)
+    eps = np.full(len(master), np.nan)
+    eps[forecast_by_id.index.values] = forecast_by_id['eps'].values
+    start = time.perf_counter()
+    for _ in range(20):
+        joined_by_id = indicator_by_id.assign(eps=eps[indicator_by_id.index.values])
+    id_join = (time.perf_counter() - start) / 20
+    assert np.allclose(joined['eps'].values, joined_by_id['eps'].values)
+    print(f"4000个证券的关联: 字符串 {string_join * 1000:.2f}ms, security_id {id_join * 1000:.2f}ms")
+
+    start = time.perf_counter()
+    normalized = normalize(ts_codes * 25)
+    print(f"normalize {len(normalized)}个代码: {(time.perf_counter() - start) * 1000:.2f}ms")
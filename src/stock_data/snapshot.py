@@ -0,0 +1,147 @@
+""" 数据表的列式快照
+
+每次爬取数据之后，把ts.db、jq.db、em1.db中的数据表导出到数据目录下的snapshot目录，每一列保存为一个.npy文件：
+    snapshot/<数据库名称>/<表名>/meta.json
+    snapshot/<数据库名称>/<表名>/<列序号>.npy
+    snapshot/<数据库名称>/<表名>/<列序号>.null.npy     文本列的空值掩码（仅当此列存在空值时）
+
+读取时只加载需要的列，数值列以内存映射的方式打开；若快照的数据版本与数据库不一致（即数据库在导出之后又被写入），
+则视为过期，直接从SQLite读取。数据版本是整个数据库文件的，写入一个表会使同一数据库中所有表的快照过期，
+因此各爬虫函数在结束时用export_database导出所写的整个数据库。
+"""
+import json
+import os
+import shutil
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+import sqlalchemy
+
+from src.stock_data import engines
+
+
+def _table_dir(db: str, table: str) -> str:
+    return os.path.join(engines.get_data_dir(), 'snapshot', db, table)
+
+
+def export_table(db: str, table: str) -> None:
+    """
+    把数据库中的某个表导出为列式快照
+
+    :param db: 数据库名称，见engines.DATABASES，例如'ts'
+    :param table: 表名，例如'balancesheet'
+    :return: None
+    """
+    version = engines.get_db_version(db)
+    df = pd.read_sql(f'SELECT * FROM {table}', con=engines.get_engine(db))
+
+    target = _table_dir(db, table)
+    tmp = f'{target}.{os.getpid()}.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+
+    nullable: List[bool] = []
+    for i, column in enumerate(df.columns):
+        values = df[column]
+        if values.dtype.kind in 'biufcmM':
+            values = np.asarray(values)
+            nullable.append(False)
+        else:
+            mask = np.asarray(values.isna())
+            if mask.any():
+                np.save(os.path.join(tmp, f'{i}.null.npy'), mask)
+            values = np.array(values.where(~mask, '').astype(str).tolist(), dtype=str)
+            nullable.append(bool(mask.any()))
+        np.save(os.path.join(tmp, f'{i}.npy'), values)
+
+    with open(os.path.join(tmp, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump({'version': version, 'rows': len(df), 'columns': list(df.columns), 'nullable': nullable},
+                  f, ensure_ascii=False)
+
+    # 先移走旧的快照再换入新的，读取者在这个间隙中会回退到SQLite
+    old = f'{target}.{os.getpid()}.old'
+    if os.path.exists(target):
+        os.rename(target, old)
+    os.rename(tmp, target)
+    shutil.rmtree(old, ignore_errors=True)
+
+
+def export_database(db: str) -> None:
+    """
+    把数据库中的所有表导出为列式快照
+
+    :param db: 数据库名称，见engines.DATABASES，例如'ts'
+    :return: None
+    """
+    for table in sqlalchemy.inspect(engines.get_engine(db)).get_table_names():
+        export_table(db, table)
+
+
+def read_columns(db: str, table: str, columns: Optional[Sequence[str]] = None) -> Optional[Dict[str, np.ndarray]]:
+    """
+    从快照中读取某个表的若干列
+
+    :param db: 数据库名称，见engines.DATABASES，例如'ts'
+    :param table: 表名，例如'balancesheet'
+    :param columns: 需要的列，默认为全部
+
+    :return: dict，键为列名，值为数组；数值列是只读的内存映射数组，文本列是object数组，空值为None
+             若快照不存在或已过期，返回None
+    """
+    directory = _table_dir(db, table)
+    try:
+        with open(os.path.join(directory, 'meta.json'), encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta['version'] != engines.get_db_version(db):
+            return None
+
+        positions = {column: i for i, column in enumerate(meta['columns'])}
+        rtn: Dict[str, np.ndarray] = {}
+        for column in (meta['columns'] if columns is None else columns):
+            i = positions[column]
+            values = np.load(os.path.join(directory, f'{i}.npy'), mmap_mode='r')
+            if values.dtype.kind == 'U':
+                values = values.astype(object)
+                if meta['nullable'][i]:
+                    values[np.load(os.path.join(directory, f'{i}.null.npy'))] = None
+            rtn[column] = values
+        return rtn
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def load_table(db: str, table: str, columns: Optional[Sequence[str]] = None) -> pd.DataFrame:
+    """
+    读取某个表，优先使用列式快照，快照不存在或已过期时从SQLite读取
+
+    :param db: 数据库名称，见engines.DATABASES，例如'ts'
+    :param table: 表名，例如'balancesheet'
+    :param columns: 需要的列，默认为全部
+
+    :return: DataFrame，内容同 pd.read_sql('SELECT <columns> FROM <table>')
+    """
+    data = read_columns(db, table, columns)
+    if data is not None:
+        return pd.DataFrame(data, columns=list(data.keys()))
+    return pd.read_sql(f"SELECT {'*' if columns is None else ', '.join(columns)} FROM {table}",
+                       con=engines.get_engine(db))
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+
+    db_name, table_name = sys.argv[1:3] if len(sys.argv) >= 3 else ('ts', 'balancesheet')
+
+    start = time.perf_counter()
+    pd.read_sql(f'SELECT * FROM {table_name}', con=engines.get_engine(db_name))
+    print(f"SQLite读取{db_name}.{table_name}: {time.perf_counter() - start:.3f}s")
+
+    start = time.perf_counter()
+    export_table(db_name, table_name)
+    print(f"导出快照: {time.perf_counter() - start:.3f}s")
+
+    start = time.perf_counter()
+    load_table(db_name, table_name)
+    print(f"快照读取: {time.perf_counter() - start:.3f}s")
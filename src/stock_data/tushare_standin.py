@@ -0,0 +1,181 @@
+""" 模拟tushare的本地服务器
+
+按照tushare pro的HTTP协议（POST JSON：api_name, token, params, fields；返回code, msg, data.fields, data.items）
+返回确定性的模拟数据（stock_basic返回codes中的公司，报表接口在latest_period之后的报告期没有数据），并模拟tushare的限制：
+1. 每个接口在per秒的滑动窗口内至多访问limit次，超出时返回tushare同样的错误信息；
+2. 报表接口以failure_rate的概率返回502（暂时性错误）；
+3. 每个请求有latency秒的延迟。
+
+用于在不消耗tushare积分的情况下测试fetch_executor和爬虫。设置环境变量TUSHARE_HTTP_URL之后，
+crawl_tushare.get_pro_api返回访问此服务器的StandinApi，见tests/test_crawl_tushare.py。
+
+用法：
+    python -m src.stock_data.tushare_standin            # 运行基准测试：串行抓取 vs RateLimitedExecutor
+"""
+import json
+import random
+import threading
+import time
+import urllib.request
+import zlib
+from collections import defaultdict, deque
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Deque, Dict, List, Optional
+
+import pandas as pd
+
+STATEMENT_FIELDS: Dict[str, List[str]] = {
+    'fina_indicator': ['ts_code', 'ann_date', 'end_date', 'eps', 'bps', 'roe', 'grossprofit_margin'],
+    'balancesheet': ['ts_code', 'ann_date', 'end_date', 'comp_type', 'total_assets', 'inventories', 'acct_payable'],
+    'income': ['ts_code', 'ann_date', 'end_date', 'comp_type', 'revenue', 'n_income'],
+}
+STOCK_BASIC_FIELDS = ['ts_code', 'symbol', 'name', 'area', 'industry', 'list_date']
+
+
+def _stock_basic_row(ts_code: str) -> Dict[str, str]:
+    return {'ts_code': ts_code, 'symbol': ts_code[:6], 'name': f'公司{ts_code[:6]}', 'area': '深圳',
+            'industry': '银行', 'list_date': '20000101'}
+
+
+def _fake_row(api_name: str, ts_code: str, period: str) -> list:
+    rng = random.Random(zlib.crc32(f'{api_name}{ts_code}{period}'.encode()))
+    values = {'ts_code': ts_code, 'ann_date': f'{int(period[:4]) + 1}0330', 'end_date': period, 'comp_type': '1'}
+    return [values[field] if field in values else round(rng.uniform(0, 100), 4)
+            for field in STATEMENT_FIELDS[api_name]]
+
+
+def make_server(limit: int = 200, per: float = 60.0, failure_rate: float = 0.0, latency: float = 0.0,
+                port: int = 0, codes: Optional[List[str]] = None,
+                latest_period: str = '20191231') -> ThreadingHTTPServer:
+    """
+    创建模拟服务器，调用者负责在线程中运行serve_forever，以及shutdown
+
+    :param limit: 每个接口在per秒内允许的访问次数
+    :param per: 限流的时间窗口（秒）
+    :param failure_rate: 报表接口返回502的概率
+    :param latency: 每个请求的延迟（秒）
+    :param port: 端口，0代表任意空闲端口
+    :param codes: stock_basic返回的公司代码，默认为000001.SZ ~ 000100.SZ
+    :param latest_period: 已经披露的最新报告期，之后的报告期返回空表
+
+    :return: server，server.url为服务器的地址，server.stats记录了请求、限流和失败的次数
+    """
+    history: Dict[str, Deque[float]] = defaultdict(deque)
+    lock = threading.Lock()
+    stats = {'requests': 0, 'throttled': 0, 'failed': 0}
+    codes = [f'{i:06d}.SZ' for i in range(1, 101)] if codes is None else codes
+
+    def admit(api_name: str) -> bool:
+        with lock:
+            stats['requests'] += 1
+            now = time.monotonic()
+            calls = history[api_name]
+            while calls and calls[0] <= now - per:
+                calls.popleft()
+            if len(calls) >= limit:
+                stats['throttled'] += 1
+                return False
+            calls.append(now)
+            return True
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            api_name, params = body['api_name'], body.get('params', {})
+            time.sleep(latency)
+            if api_name in STATEMENT_FIELDS and random.random() < failure_rate:
+                with lock:
+                    stats['failed'] += 1
+                self._reply(502, b'<html>502 Bad Gateway</html>', 'text/html')
+                return
+            if not admit(api_name):
+                result = {'code': 40203, 'msg': f'抱歉，您每分钟最多访问该接口{limit}次', 'data': None}
+            elif api_name == 'stock_basic':
+                fields = [f.strip() for f in body.get('fields', '').split(',') if f.strip()] or STOCK_BASIC_FIELDS
+                result = {'code': 0, 'msg': '', 'data': {
+                    'fields': fields, 'items': [[_stock_basic_row(code)[f] for f in fields] for code in codes]}}
+            elif api_name not in STATEMENT_FIELDS:
+                result = {'code': 40101, 'msg': f'接口名称{api_name}不存在', 'data': None}
+            else:
+                disclosed = params['period'] <= latest_period
+                result = {'code': 0, 'msg': '', 'data': {
+                    'fields': STATEMENT_FIELDS[api_name],
+                    'items': [_fake_row(api_name, params['ts_code'], params['period'])] if disclosed else []}}
+            self._reply(200, json.dumps(result, ensure_ascii=False).encode('utf-8'), 'application/json')
+
+        def _reply(self, status: int, content: bytes, content_type: str):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    server.url = f'http://127.0.0.1:{server.server_address[1]}'
+    server.stats = stats
+    return server
+
+
+def query(url: str, api_name: str, fields: str = '', **params) -> pd.DataFrame:
+    """ 与tushare的DataApi.query相同的协议，用于在没有安装tushare的环境中访问模拟服务器
+    """
+    data = json.dumps({'api_name': api_name, 'token': '', 'params': params, 'fields': fields}).encode('utf-8')
+    request = urllib.request.Request(url, data=data, headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request, timeout=10) as response:
+        result = json.loads(response.read().decode('utf-8'))
+    if result['code'] != 0:
+        raise Exception(result['msg'])
+    return pd.DataFrame(result['data']['items'], columns=result['data']['fields'])
+
+
+class StandinApi:
+    """ 用法与tushare的pro_api()相同的客户端：pro.query('income', ...)或者pro.income(...)，访问模拟服务器
+    """
+
+    def __init__(self, url: str):
+        self.url = url
+
+    def query(self, api_name: str, fields: str = '', **params) -> pd.DataFrame:
+        return query(self.url, api_name, fields, **params)
+
+    def __getattr__(self, api_name: str):
+        return partial(self.query, api_name)
+
+
+if __name__ == "__main__":
+    from src.stock_data.fetch_executor import RateLimitedExecutor
+
+    # 把tushare的每分钟限额按比例缩小到每5秒，使基准测试在几十秒内完成
+    LIMIT, PER, JOBS = 50, 5.0, 400
+    jobs = [(f'{i:06d}.SZ', f'{y}1231') for i in range(JOBS // 4) for y in range(2016, 2020)]
+
+    def fetch(url, job):
+        return query(url, 'income', ts_code=job[0], period=job[1])
+
+    srv = make_server(limit=LIMIT, per=PER, failure_rate=0.02, latency=0.3)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+
+    # 旧的做法：串行，每次请求都要等待上一个请求返回，一个异常就会中断整个抓取
+    start, ok = time.perf_counter(), 0
+    for job in jobs[:LIMIT]:
+        try:
+            fetch(srv.url, job)
+            ok += 1
+        except Exception:
+            pass
+    print(f"串行: {ok}/{LIMIT} 成功, {LIMIT / (time.perf_counter() - start):.1f} 次/秒")
+
+    time.sleep(PER)
+    start = time.perf_counter()
+    with RateLimitedExecutor({'income': LIMIT - 1}, workers=4, per=PER, backoff=0.2) as executor:
+        results = list(executor.map('income', partial(fetch, srv.url), jobs))
+    elapsed = time.perf_counter() - start
+    failures = sum(isinstance(r, Exception) for _, r in results)
+    print(f"RateLimitedExecutor: {len(results) - failures}/{len(results)} 成功, {len(results) / elapsed:.1f} 次/秒, "
+          f"允许的上限 {LIMIT / PER:.1f} 次/秒, 执行器统计 {executor.stats}, 服务器统计 {srv.stats}")
+    srv.shutdown()
@@ -0,0 +1,148 @@
+""" 以数据版本为键的缓存
+
+取代以日期字符串为键的 lru_cache(maxsize=1)：
+1. 缓存项记录了加载时数据库的版本（见engines.get_db_version），数据库被写入后缓存即过期，而不是等到第二天；
+2. 缓存项过期后，在后台线程中重新加载，加载完成后原子地替换旧的缓存项；重新加载期间，调用者继续得到旧的数据，
+   不会因为重新加载而阻塞。只有第一次调用（缓存中还没有数据）时才同步加载。
+3. 检查数据版本需要对每个数据库执行一次查询（见engines.get_db_version），对于每次请求都要调用的查询而言代价过高，
+   因此同一个缓存项至多每check_interval秒检查一次版本，命中缓存只是一次字典查找。
+4. refresh_all一次检查所有缓存项，过期的在后台重新加载，并报告内存中的数据是否都已是最新版本，
+   API的响应缓存（见response_cache）据此决定能否以数据版本作为响应的ETag。
+5. 缓存的键是补齐了默认值的参数，f()、f('2018')和f(year='2018')是同一个缓存项，不会互相淘汰。
+"""
+import functools
+import inspect
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Tuple
+
+from src.stock_data import engines
+
+# 每个被装饰函数的refresh函数，见refresh_all
+_refreshers: List[Callable[[Dict[str, str]], bool]] = []
+
+# 每个被装饰函数的cache_clear函数，见clear_all
+_clearers: List[Callable[[], None]] = []
+
+
+def versioned_cache(*databases: str, maxsize: int = 1, check_interval: float = 1.0) -> Callable:
+    """
+    装饰器，缓存函数的返回值，直到其所依赖的数据库被写入
+
+    :param databases: 函数所依赖的数据库名称，见engines.DATABASES，例如'ts'
+    :param maxsize: 至多缓存多少组不同参数的返回值，应不少于调用者所用的参数组合数
+    :param check_interval: 同一个缓存项至多每隔多少秒检查一次数据版本，为0时每次调用都检查
+    :return: 装饰器
+
+    Examples:
+    --------
+    @versioned_cache('jq')
+    def get_securities() -> pd.DataFrame:
+        ...
+    """
+
+    def decorator(fn: Callable) -> Callable:
+        entries: OrderedDict = OrderedDict()        # 参数 -> (数据版本, 返回值)
+        arguments: dict = {}                        # 参数 -> (args, kwargs)，供refresh重新加载
+        checked: dict = {}                          # 参数 -> 下一次检查数据版本的时间
+        reloading = set()                           # 正在后台重新加载的参数
+        lock = threading.Lock()
+        signature = inspect.signature(fn)
+        arity = len(signature.parameters) if all(
+            p.kind in (p.POSITIONAL_ONLY, p.POSITIONAL_OR_KEYWORD) for p in signature.parameters.values()) else -1
+
+        def normalize(args, kwargs) -> Tuple[tuple, dict]:
+            if not kwargs and len(args) == arity:     # 已经是完整的位置参数，不必绑定
+                return args, kwargs
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            return bound.args, bound.kwargs
+
+        def current_version() -> Tuple[str, ...]:
+            return tuple(engines.get_db_version(db) for db in databases)
+
+        def store(key, version, value) -> None:
+            with lock:
+                entries[key] = (version, value)
+                entries.move_to_end(key)
+                while len(entries) > maxsize:
+                    evicted = entries.popitem(last=False)[0]
+                    checked.pop(evicted, None)
+                    arguments.pop(evicted, None)
+
+        def reload(key, version, args, kwargs) -> None:
+            try:
+                store(key, version, fn(*args, **kwargs))
+            except Exception as e:
+                print(f"{fn.__name__}{args} 重新加载失败: {e!r}")
+            finally:
+                with lock:
+                    reloading.discard(key)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            args, kwargs = normalize(args, kwargs)
+            key = args + tuple(sorted(kwargs.items()))
+            now = time.monotonic()
+            entry = entries.get(key)
+            if entry is not None and now < checked.get(key, 0):
+                return entry[1]
+            version = current_version()
+            checked[key] = now + check_interval
+            arguments[key] = (args, kwargs)
+            with lock:
+                entry = entries.get(key)
+                if entry is not None:
+                    entries.move_to_end(key)
+                    if entry[0] != version and key not in reloading:
+                        reloading.add(key)
+                        threading.Thread(target=reload, args=(key, version, args, kwargs), daemon=True).start()
+                    return entry[1]
+            value = fn(*args, **kwargs)
+            store(key, version, value)
+            return value
+
+        def refresh(versions: Dict[str, str]) -> bool:
+            version = tuple(versions[db] for db in databases)
+            current = True
+            with lock:
+                for key, (entry_version, _) in entries.items():
+                    if key in reloading:
+                        current = False
+                    elif entry_version != version:
+                        current = False
+                        reloading.add(key)
+                        args, kwargs = arguments[key]
+                        threading.Thread(target=reload, args=(key, version, args, kwargs), daemon=True).start()
+            return current
+
+        def cache_clear() -> None:
+            with lock:
+                entries.clear()
+                checked.clear()
+                arguments.clear()
+
+        _refreshers.append(refresh)
+        _clearers.append(cache_clear)
+        wrapper.cache_clear = cache_clear
+        return wrapper
+
+    return decorator
+
+
+def refresh_all(versions: Dict[str, str]) -> bool:
+    """
+    检查所有被versioned_cache装饰的函数的所有缓存项，过期的缓存项在后台重新加载
+
+    :param versions: 数据库名称 -> 版本，须包含被装饰函数所依赖的全部数据库，见engines.get_db_version
+    :return: 所有缓存项是否都是versions版本的数据（没有过期的，也没有正在重新加载的）
+    """
+    return all([refresh(versions) for refresh in _refreshers])
+
+
+def clear_all() -> None:
+    """ 清空所有被versioned_cache装饰的函数的缓存，例如切换了数据目录之后，下一次调用同步加载
+    """
+    for cache_clear in _clearers:
+        cache_clear()
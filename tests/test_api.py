@@ -0,0 +1,100 @@
+""" 用临时数据目录测试API的各个接口
+
+运行（在项目根目录下）：
+    python -m unittest tests.test_api
+"""
+import os
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+import pandas as pd
+from fastapi.testclient import TestClient
+
+from src import api
+from src.stock_data import engines, security_master
+from src.stock_data.versioned_cache import clear_all
+
+FINANCIAL_INDICATOR = pd.DataFrame({
+    'ts_code': ['000001.SZ'] * 3 + ['600000.SH'] * 3,
+    'end_date': ['20161231', '20171231', '20181231'] * 2,
+    'ann_date': ['20170301', '20180301', '20190301'] * 2,
+    'grossprofit_margin': [30.0, 31.0, 32.0, 20.0, 21.0, 22.0],
+    'roe': [10.0, 11.0, 12.0, 8.0, 9.0, 10.0],
+})
+
+
+def write_tables(data_dir: str, db: str, tables: dict) -> None:
+    """ 在数据目录下的某个数据库中写入若干表
+
+    :param tables: 表名 -> DataFrame
+    """
+    with sqlite3.connect(os.path.join(data_dir, engines.DATABASES[db])) as con:
+        for table, df in tables.items():
+            df.to_sql(table, con, index=False)
+    con.close()
+
+
+class ApiTestCase(unittest.TestCase):
+    """ 每个测试使用一个新的临时数据目录，不启动预热，数据集在第一次请求时加载
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.data_dir = directory.name
+        patcher = mock.patch.dict(os.environ, {'RIM_DATA_DIR': self.data_dir})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        engines.dispose_engines()
+        self.addCleanup(engines.dispose_engines)
+        clear_all()
+        self.addCleanup(clear_all)
+        self.client = TestClient(api.app)
+
+
+class YearsRoeTest(ApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        write_tables(self.data_dir, 'ts', {'financial_indicator': FINANCIAL_INDICATOR})
+
+    def test_known_and_unknown_code(self):
+        for code in ('000001', '600000', '999999'):
+            response = self.client.get('/profitability/8yr-roe/', params={'code': code})
+            self.assertEqual(response.status_code, 200, code)
+
+
+class UnknownCodeTest(ApiTestCase):
+    """ 000001有全部数据，000002只在证券列表中，999999不存在：后两者都应当是404
+    """
+
+    def setUp(self):
+        super().setUp()
+        write_tables(self.data_dir, 'jq', {
+            'securities': pd.DataFrame({'code': ['000001.XSHE', '000002.XSHE'], 'display_name': ['平安银行', '万科A'],
+                                        'name': ['PAYH', 'WKA']}),
+            'company_info': pd.DataFrame({'code': ['000001.XSHE'], 'website': [''], 'province': ['广东'],
+                                          'city': ['深圳'], 'industry_1': ['金融'], 'industry_2': ['银行'],
+                                          'main_business': ['银行业务']}),
+            'market_value': pd.DataFrame({'code': ['000001.XSHE'], 'market_cap': [2000.0], 'pe_ratio': [8.0],
+                                          'pb_ratio': [0.9], 'ps_ratio': [2.0], 'pcf_ratio': [5.0]}),
+        })
+        write_tables(self.data_dir, 'ts', {
+            'indicator2018': pd.DataFrame({'ts_code': ['000001.SZ'], 'eps': [1.45], 'bps': [11.8]})})
+        write_tables(self.data_dir, 'em', {
+            'profit_forecast': pd.DataFrame({'code': ['000001'], 'eps_2019': [1.6], 'eps_2020': [1.8],
+                                             'eps_2021': [2.1]})})
+        security_master.register_sources()
+
+    def test_single_code_endpoints(self):
+        for path in ('/profit-forecast/', '/financial-indicator/', '/v1.0/a_public_company_info'):
+            self.assertEqual(self.client.get(path, params={'code': '000001'}).status_code, 200, path)
+            for code in ('000002', '999999'):
+                response = self.client.get(path, params={'code': code})
+                self.assertEqual(response.status_code, 404, (path, code))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+""" 用录制的真实响应（tests/fixtures/eastmoney）测试东方财富盈利预测爬虫
+
+运行（在项目根目录下）：
+    python -m unittest tests.test_crawl_eastmoney
+录制文件（目前是脱敏的样本）的说明见tests/fixtures/eastmoney/README.md
+"""
+import json
+import os
+import re
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from src.stock_data import crawl_eastmoney, eastmoney_standin, engines
+
+FIXTURES = sorted(os.path.join(crawl_eastmoney.FIXTURE_DIR, name)
+                  for name in (os.listdir(crawl_eastmoney.FIXTURE_DIR)
+                               if os.path.isdir(crawl_eastmoney.FIXTURE_DIR) else [])
+                  if name.startswith('page_') and name.endswith('.json'))
+
+_RATINGS = ('number_of_reports', 'rank_buy', 'rank_increase', 'rank_neutral', 'rank_reduction', 'rank_sell_out')
+_EPS = ('eps_2018', 'eps_2019', 'eps_2020', 'eps_2021')
+
+
+@unittest.skipUnless(FIXTURES, 'no recorded eastmoney responses, see tests/fixtures/eastmoney/README.md')
+class RecordedResponseTest(unittest.TestCase):
+
+    def test_fields_exist_in_recorded_items(self):
+        for path in FIXTURES:
+            with open(path, encoding='utf-8') as f:
+                items = json.load(f)['result']['data']
+            self.assertTrue(items, path)
+            for item in items:
+                self.assertLessEqual(set(crawl_eastmoney.FORECAST_FIELDS), set(item), path)
+                self.assertLessEqual({field for pair in crawl_eastmoney.EPS_FIELDS for field in pair}, set(item), path)
+
+    def test_parse_page(self):
+        for path in FIXTURES:
+            with open(path, encoding='utf-8') as f:
+                pages, rows = crawl_eastmoney.parse_page(f.read())
+            self.assertGreaterEqual(pages, len(FIXTURES), path)
+            self.assertTrue(rows, path)
+            for row in rows:
+                self.assertRegex(str(row['code']), re.compile(r'^\d{6}$'))
+                for column in _RATINGS:
+                    self.assertTrue(row[column] is None or float(row[column]) >= 0, (path, row))
+                for column in _EPS:
+                    self.assertTrue(row[column] is None or isinstance(row[column], (int, float)), (path, row))
+                self.assertTrue(any(row[column] is not None for column in _EPS), (path, row))
+
+    def test_eps_saved_by_year(self):
+        for path in FIXTURES:
+            with open(path, encoding='utf-8') as f:
+                items = {item['SECURITY_CODE']: item for item in json.load(f)['result']['data']}
+                f.seek(0)
+                rows = crawl_eastmoney.parse_page(f.read())[1]
+            for row in rows:
+                item = items[row['code']]
+                for year_field, eps_field in crawl_eastmoney.EPS_FIELDS:
+                    if int(item[year_field]) in crawl_eastmoney.EPS_YEARS:
+                        self.assertEqual(row[f'eps_{int(item[year_field])}'], item[eps_field], (path, row))
+
+    def test_crawl_from_standin(self):
+        with tempfile.TemporaryDirectory() as data_dir, mock.patch.dict(os.environ, {'RIM_DATA_DIR': data_dir}):
+            engines.dispose_engines()
+            server = eastmoney_standin.make_server()
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            try:
+                n = crawl_eastmoney.crawl_profit_forecast(server.url, workers=2)
+            finally:
+                server.shutdown()
+                engines.dispose_engines()
+        expected = set()
+        for path in FIXTURES:
+            with open(path, encoding='utf-8') as f:
+                expected.update(row['code'] for row in crawl_eastmoney.parse_page(f.read())[1])
+        self.assertEqual(n, len(expected))
+
+
+class ParsePageTest(unittest.TestCase):
+
+    def test_out_of_range_page(self):
+        self.assertEqual(crawl_eastmoney.parse_page('{"result": null}'), (0, []))
+
+    def test_years_without_columns_are_rejected(self):
+        page = {'result': {'pages': 1, 'data': [{'SECURITY_CODE': '000001', 'YEAR1': 2025, 'EPS1': 1.0,
+                                                 'YEAR2': 2026, 'EPS2': 1.1, 'YEAR3': 2027, 'EPS3': 1.2,
+                                                 'YEAR4': 2028, 'EPS4': 1.3}]}}
+        with self.assertRaises(ValueError):
+            crawl_eastmoney.parse_page(json.dumps(page))
+
+    def test_partially_overlapping_years(self):
+        page = {'result': {'pages': 1, 'data': [{'SECURITY_CODE': '000001', 'YEAR1': '2020', 'EPS1': 1.0,
+                                                 'YEAR2': '2021', 'EPS2': 1.1, 'YEAR3': '2022', 'EPS3': 1.2,
+                                                 'YEAR4': '2023', 'EPS4': 1.3}]}}
+        row = crawl_eastmoney.parse_page(json.dumps(page))[1][0]
+        self.assertEqual((row['eps_2018'], row['eps_2019'], row['eps_2020'], row['eps_2021']), (None, None, 1.0, 1.1))
+
+
+if __name__ == '__main__':
+    unittest.main()
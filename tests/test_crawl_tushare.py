@@ -0,0 +1,100 @@
+""" 用tushare_standin的模拟服务器测试tushare报表爬虫：抓取、中断后继续、失败后重试
+
+运行（在项目根目录下）：
+    python -m unittest tests.test_crawl_tushare
+"""
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import unittest
+from functools import partial
+from unittest import mock
+
+from src.stock_data import crawl_queue, crawl_tushare, engines, tushare_standin
+from src.stock_data.fetch_executor import RateLimitedExecutor
+
+CODES = [f'{i:06d}.SZ' for i in range(1, 6)]
+# 2016 ~ 2019年度，2019年报尚未披露
+START, END, LATEST_PERIOD = 2016, 2020, '20181231'
+DISCLOSED = [(code, f'{year}1231') for code in CODES for year in range(START, 2019)]
+
+
+class CrawlStatementsTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.data_dir = directory.name
+        for patcher in (mock.patch.dict(os.environ, {'RIM_DATA_DIR': self.data_dir}),
+                        # 不按tushare的每分钟限额等待，重试也不等待
+                        mock.patch.dict(crawl_tushare.TUSHARE_RATE_LIMITS, {'income': 60000}),
+                        mock.patch.object(crawl_tushare, 'RateLimitedExecutor',
+                                          partial(RateLimitedExecutor, backoff=0.01))):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        engines.dispose_engines()
+        self.addCleanup(engines.dispose_engines)
+
+    def serve(self, failure_rate: float = 0.0) -> None:
+        """ 启动模拟服务器，并让crawl_tushare访问它
+        """
+        self.server = server = tushare_standin.make_server(failure_rate=failure_rate, codes=CODES,
+                                                           latest_period=LATEST_PERIOD)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        patcher = mock.patch.dict(os.environ, {'TUSHARE_HTTP_URL': server.url})
+        patcher.start()
+        self.addCleanup(server.shutdown)
+        self.addCleanup(patcher.stop)
+
+    def crawl(self, failure_rate: float = 0.0) -> int:
+        self.serve(failure_rate)
+        return crawl_tushare.crawl_statements('income', START, END, workers=2, batch=4)
+
+    def stored_rows(self) -> dict:
+        with sqlite3.connect(engines.get_db_path('ts')) as con:
+            rows = con.execute('SELECT ts_code, end_date, revenue FROM income').fetchall()
+        con.close()
+        return {(code, period): revenue for code, period, revenue in rows}
+
+    def test_crawl(self):
+        self.assertEqual(self.crawl(), len(DISCLOSED))
+        rows = self.stored_rows()
+        self.assertEqual(set(rows), set(DISCLOSED))
+        revenue = tushare_standin.STATEMENT_FIELDS['income'].index('revenue')
+        for (code, period), value in rows.items():
+            self.assertAlmostEqual(value, tushare_standin._fake_row('income', code, period)[revenue])
+        counts = crawl_queue.counts('income')
+        self.assertEqual((counts[crawl_queue.DONE], counts[crawl_queue.EMPTY], counts[crawl_queue.FAILED]),
+                         (len(DISCLOSED), len(CODES), 0))
+        # 全部完成之后再次运行不会重复抓取
+        self.assertEqual(self.crawl(), 0)
+
+    def test_resume_after_interruption(self):
+        self.serve()
+        crawl_tushare.enqueue_code_periods('income', START, END)
+        claimed = crawl_queue.claim('income', 3)     # 领取了任务的进程在保存之前被中断
+        self.assertEqual(crawl_queue.counts('income')[crawl_queue.RUNNING], len(claimed))
+        self.assertEqual(self.crawl(), len(DISCLOSED))
+        self.assertEqual(set(self.stored_rows()), set(DISCLOSED))
+        self.assertEqual(crawl_queue.counts('income')[crawl_queue.RUNNING], 0)
+
+    def test_transient_errors_are_retried(self):
+        random.seed(0)
+        with mock.patch.object(crawl_tushare, 'RateLimitedExecutor',
+                               partial(RateLimitedExecutor, backoff=0.001, max_retries=8)):
+            self.assertEqual(self.crawl(failure_rate=0.3), len(DISCLOSED))
+        self.assertGreater(self.server.stats['failed'], 0)
+        self.assertEqual(set(self.stored_rows()), set(DISCLOSED))
+
+    def test_failed_jobs_are_retried(self):
+        self.assertEqual(self.crawl(failure_rate=1.0), 0)
+        self.assertEqual(crawl_queue.counts('income')[crawl_queue.FAILED], len(CODES) * (END - START))
+        self.assertEqual(crawl_queue.retry_failed('income'), len(CODES) * (END - START))
+        self.assertEqual(self.crawl(), len(DISCLOSED))
+        self.assertEqual(set(self.stored_rows()), set(DISCLOSED))
+
+
+if __name__ == '__main__':
+    unittest.main()
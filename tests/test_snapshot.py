@@ -0,0 +1,71 @@
+""" 测试列式快照在导出的进程退出之后仍然有效
+
+运行（在项目根目录下）：
+    python -m unittest tests.test_snapshot
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import sqlalchemy
+
+from src.stock_data import engines, snapshot
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 在子进程中：写入数据表，在写入者的连接仍然打开时导出快照，然后退出（最后一个连接关闭时checkpoint并删除-wal文件）
+_CRAWL = """
+import pandas as pd
+from src.stock_data import engines, snapshot
+engine = engines.get_engine('ts')
+with engine.connect() as con:
+    pd.DataFrame({'ts_code': ['000001.SZ', '600000.SH'], 'end_date': ['20181231', '20181231'],
+                  'roe': [12.0, 10.0]}).to_sql('financial_indicator', engine, index=False)
+    snapshot.export_database('ts')
+"""
+
+
+class SnapshotVersionTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.data_dir = directory.name
+        patcher = mock.patch.dict(os.environ, {'RIM_DATA_DIR': self.data_dir})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        engines.dispose_engines()
+        self.addCleanup(engines.dispose_engines)
+        subprocess.run([sys.executable, '-c', _CRAWL], cwd=ROOT_DIR, check=True,
+                       env=dict(os.environ, PYTHONPATH=ROOT_DIR))
+
+    def test_read_back_after_exporter_exits(self):
+        self.assertFalse(os.path.exists(engines.get_db_path('ts') + '-wal'))
+        columns = snapshot.read_columns('ts', 'financial_indicator')
+        self.assertIsNotNone(columns)
+        np.testing.assert_array_equal(columns['roe'], [12.0, 10.0])
+
+    def test_opening_connections_keeps_snapshot_fresh(self):
+        version = engines.get_db_version('ts')
+        with engines.get_engine('ts').connect() as con:
+            con.execute(sqlalchemy.text('SELECT COUNT(*) FROM financial_indicator')).scalar()
+            self.assertEqual(engines.get_db_version('ts'), version)
+            self.assertIsNotNone(snapshot.read_columns('ts', 'financial_indicator'))
+        engines.dispose_engines()
+        self.assertEqual(engines.get_db_version('ts'), version)
+        self.assertIsNotNone(snapshot.read_columns('ts', 'financial_indicator'))
+
+    def test_write_makes_snapshot_stale(self):
+        version = engines.get_db_version('ts')
+        with engines.get_engine('ts').begin() as con:
+            con.execute(sqlalchemy.text("UPDATE financial_indicator SET roe = 13 WHERE ts_code = '000001.SZ'"))
+        self.assertNotEqual(engines.get_db_version('ts'), version)
+        self.assertIsNone(snapshot.read_columns('ts', 'financial_indicator'))
+
+
+if __name__ == '__main__':
+    unittest.main()